@@ -0,0 +1,177 @@
+"""
+Bank points and DEM sampling with numpy and rasterio, without arcpy.
+Transects are straight lines given by their first and last point. Each half of a transect
+runs from the centroid to one end, and the points across the river are placed along the
+part of the half that is outside the river polygon, starting where it leaves the polygon.
+This gives the same points as River.add_river_bank2().
+"""
+import numpy as np
+import rasterio
+from raster_tiles import Tiled_raster
+
+
+def polygon_edges(rings: list) -> np.ndarray:
+    """Collects the edges of polygon rings.
+
+    Args:
+        rings (list): Iterable of rings, each an array with shape (points, 2). Rings don't need to be closed.
+
+    Returns:
+        np.ndarray: Array with shape (edges, 4) with x0, y0, x1, y1 for every edge
+    """
+    edges = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)
+        if len(ring) < 2:
+            continue
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack((ring, ring[:1]))
+        edges.append(np.hstack((ring[:-1], ring[1:])))
+    return np.vstack(edges) if len(edges) > 0 else np.zeros((0, 4))
+
+
+def inside_polygon(x: np.ndarray, y: np.ndarray, edges: np.ndarray, chunk_size: int = 2**22) -> np.ndarray:
+    """Even-odd test of points against polygon edges.
+
+    Args:
+        x (np.ndarray): x-coordinates
+        y (np.ndarray): y-coordinates
+        edges (np.ndarray): Output from polygon_edges()
+        chunk_size (int, optional): Max number of point and edge pairs tested at once. Defaults to 2**22.
+
+    Returns:
+        np.ndarray: True for points inside the polygon
+    """
+    inside = np.zeros(len(x), dtype=bool)
+    step = max(1, chunk_size // max(len(edges), 1))
+    x0, y0, x1, y1 = (edges[:, i][None, :] for i in range(4))
+    for start in range(0, len(x), step):
+        px = x[start:start+step, None]
+        py = y[start:start+step, None]
+        spans = (y0 > py) != (y1 > py)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            crossing = spans & (px < x0 + (py - y0) * (x1 - x0) / (y1 - y0))
+        inside[start:start+step] = crossing.sum(axis=1) % 2 == 1
+    return inside
+
+
+def first_outside(start: np.ndarray, end: np.ndarray, edges: np.ndarray, chunk_size: int = 2**22) -> np.ndarray:
+    """Finds where each line segment first is outside the polygon.
+
+    Args:
+        start (np.ndarray): Start points with shape (lines, 2)
+        end (np.ndarray): End points with shape (lines, 2)
+        edges (np.ndarray): Output from polygon_edges()
+        chunk_size (int, optional): Max number of line and edge pairs tested at once. Defaults to 2**22.
+
+    Returns:
+        np.ndarray: Fraction of the way from start to end, 0 if start is outside, NaN if the whole segment is inside
+    """
+    fraction = np.where(inside_polygon(start[:, 0], start[:, 1], edges, chunk_size), np.nan, 0.0)
+    todo = np.flatnonzero(np.isnan(fraction))
+    step = max(1, chunk_size // max(len(edges), 1))
+    for chunk in np.array_split(todo, max(1, -(-len(todo) // step))):
+        if len(chunk) == 0:
+            continue
+        a, b = start[chunk], end[chunk]
+        # only edges that can reach the lines in this chunk
+        low = np.minimum(a, b).min(axis=0)
+        high = np.maximum(a, b).max(axis=0)
+        near = (np.maximum(edges[:, 0], edges[:, 2]) >= low[0]) & (np.minimum(edges[:, 0], edges[:, 2]) <= high[0]) \
+            & (np.maximum(edges[:, 1], edges[:, 3]) >= low[1]) & (np.minimum(edges[:, 1], edges[:, 3]) <= high[1])
+        e = edges[near]
+        if len(e) == 0:
+            # no edge is close enough, so the lines are inside all the way
+            continue
+        r = (b - a)[:, None, :]
+        s = (e[:, 2:] - e[:, :2])[None, :, :]
+        offset = e[None, :, :2] - a[:, None, :]
+        denom = r[..., 0] * s[..., 1] - r[..., 1] * s[..., 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = (offset[..., 0] * s[..., 1] - offset[..., 1] * s[..., 0]) / denom
+            u = (offset[..., 0] * r[..., 1] - offset[..., 1] * r[..., 0]) / denom
+        hit = (denom != 0) & (u >= 0) & (u < 1) & (t > 0) & (t <= 1)
+        fraction[chunk] = np.where(hit.any(axis=1), np.where(hit, t, np.inf).min(axis=1), np.nan)
+    return fraction
+
+
+def bank_points(first: np.ndarray, last: np.ndarray, edges: np.ndarray, distances: tuple[int]) -> np.ndarray:
+    """Places points across the river along transects, on both sides of the river polygon.
+
+    Args:
+        first (np.ndarray): First point of every transect with shape (transects, 2), the left side
+        last (np.ndarray): Last point of every transect with shape (transects, 2), the right side
+        edges (np.ndarray): Edges of the dissolved river polygon, from polygon_edges()
+        distances (tuple[int]): Distances from the river bank
+
+    Returns:
+        np.ndarray: Coordinates with shape (transects, distances, 2, 2). Axis 2 is the side, 0 = 'r' and 1 = 'l', and axis 3 is x and y.
+    """
+    first = np.asarray(first, dtype=np.float64)
+    last = np.asarray(last, dtype=np.float64)
+    centroid = (first + last) / 2
+    distances = np.asarray(distances, dtype=np.float64)
+    points = np.full((len(first), len(distances), 2, 2), np.nan)
+    for side, end in enumerate((last, first)):
+        fraction = first_outside(centroid, end, edges)
+        bank = centroid + fraction[:, None] * (end - centroid)
+        length = np.hypot(*(end - bank).T)
+        # positions beyond the end of the line stay at the end, like positionAlongLine
+        with np.errstate(invalid='ignore', divide='ignore'):
+            along = np.where(length[:, None] > 0, np.minimum(distances[None, :], length[:, None]) / length[:, None], 0)
+        points[:, :, side] = bank[:, None, :] + along[..., None] * (end - bank)[:, None, :]
+    return points
+
+
+def sample_raster(raster: any, x: np.ndarray, y: np.ndarray, method: str = 'nearest', band: int = 1, tile_size: int = 1024, memory_budget: int = 256 * 2**20) -> np.ndarray:
+    """Samples raster values at points, reading only the tiles the points fall in.
+
+    Args:
+        raster (any): Path to a raster GDAL can read, or an open rasterio dataset
+        x (np.ndarray): x-coordinates
+        y (np.ndarray): y-coordinates
+        method (str, optional): 'nearest' uses the cell the point is in, 'bilinear' interpolates between the four closest cell centers. Defaults to 'nearest'.
+        band (int, optional): Band number, starting at 1. Defaults to 1.
+        tile_size (int, optional): Width and height of tiles read at once. Defaults to 1024.
+        memory_budget (int, optional): Bytes for cached tiles. Defaults to 256 MB.
+
+    Returns:
+        np.ndarray: Values with the same shape as x, NaN for NoData or points outside the raster
+    """
+    dataset = rasterio.open(raster) if isinstance(raster, str) else raster
+    tiles = Tiled_raster(dataset, tile_size, memory_budget)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    col, row = ~dataset.transform * (x.reshape(-1), y.reshape(-1))
+    col, row = np.asarray(col), np.asarray(row)
+
+    def cell_values(rows, cols):
+        values = np.full(rows.shape, np.nan)
+        valid = (rows >= 0) & (rows < dataset.height) & (cols >= 0) & (cols < dataset.width)
+        values[valid] = tiles[band-1, rows[valid], cols[valid]]
+        if dataset.nodatavals[band-1] != None:
+            values[values == dataset.nodatavals[band-1]] = np.nan
+        return values
+
+    finite = np.isfinite(col) & np.isfinite(row)
+    col, row = np.where(finite, col, -1), np.where(finite, row, -1)
+    if method == 'nearest':
+        values = cell_values(np.floor(row).astype(np.int64), np.floor(col).astype(np.int64))
+    elif method == 'bilinear':
+        col, row = col - 0.5, row - 0.5
+        col0, row0 = np.floor(col).astype(np.int64), np.floor(row).astype(np.int64)
+        dx, dy = col - col0, row - row0
+        total = np.zeros(len(col))
+        weights = np.zeros(len(col))
+        # cells with NoData are left out and the other weights scaled up
+        for d_row, d_col, weight in ((0, 0, (1-dx)*(1-dy)), (0, 1, dx*(1-dy)), (1, 0, (1-dx)*dy), (1, 1, dx*dy)):
+            values = cell_values(row0 + d_row, col0 + d_col)
+            known = ~np.isnan(values) & (weight > 0)
+            total[known] += values[known] * weight[known]
+            weights[known] += weight[known]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(weights > 0, total / weights, np.nan)
+    else:
+        raise ValueError(f"Unknown sampling method '{method}'")
+    values[~finite] = np.nan
+    return values.reshape(x.shape)
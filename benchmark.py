@@ -0,0 +1,376 @@
+"""
+Benchmarks of the analysis stages on synthetic data, without arcpy or the project data.
+A synthetic river valley is generated at each size: a DEM sloping down the valley with a winding river,
+the river polygon, points along the river with transects, buildings and roads, and the composite
+D8/class flow raster like raster_merge.py makes. Each stage is then timed on its own:
+    bank_sampling      bank points along the transects and DEM sampling, bank_sampling.py
+    cross_section      gradient, cross-section slope and area and longest water, River
+    critical_points    River.find_critical_points() for all scenarios
+    hydrology          hydrology.fill_and_direction() of the DEM, the Fill() and FlowDirection() of raster_merge.py
+    raster_merge       composite_raster.build_composite() from the D8 raster and the polygons
+    flow_tracing       Flood_path.analyze_scenarios() for every number of workers
+    export             flow paths simplified and written as a GeoPackage, path_export.py
+
+Run with:
+    python benchmark.py --sizes 256 512 1024 --repeat 3 --workers 1 4 --output benchmark.json
+
+The JSON output has the timings of every size, and for every stage a scaling curve over the number
+of cells with the exponent of a power law fitted to it, so 1 is linear in the raster size.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.transform import rowcol
+import bank_sampling
+import composite_raster
+import hydrology
+import path_export
+from river_geometry import River
+from river_table import River_table
+from critical_paths import Flood_path, D8_CODES, D8_OFFSETS
+
+STAGES = ('bank_sampling', 'cross_section', 'critical_points', 'hydrology', 'raster_merge', 'flow_tracing', 'export')
+SCENARIOS = {5: 1.5, 100: 3.0} # return period and mean water surface above the river bed
+DISTANCES = tuple(range(0, 41, 4))
+
+
+def d8_directions(dem: np.ndarray, cell_size: float = 1.0) -> np.ndarray:
+    """D8 flow direction with the codes of the ArcGIS FlowDirection tool, towards the steepest drop.
+    Cells without a lower neighbour get 0, which ends a flow path.
+
+    Args:
+        dem (np.ndarray): Elevation raster
+        cell_size (float, optional): Width and height of cells. Defaults to 1.0.
+
+    Returns:
+        np.ndarray: D8 codes as uint8
+    """
+    n_rows, n_cols = dem.shape
+    padded = np.pad(dem, 1, constant_values=np.inf)
+    best = np.zeros(dem.shape)
+    direction = np.zeros(dem.shape, dtype=np.uint8)
+    for code in D8_CODES:
+        d_row, d_col = D8_OFFSETS[code]
+        neighbour = padded[1+d_row:1+d_row+n_rows, 1+d_col:1+d_col+n_cols]
+        drop = (dem - neighbour) / (cell_size * np.hypot(d_row, d_col))
+        steeper = drop > best
+        best = np.where(steeper, drop, best)
+        direction[steeper] = code
+    return direction
+
+
+def write_raster(path: str, array: np.ndarray, transform: Affine) -> None:
+    """Writes a single band GeoTIFF.
+
+    Args:
+        path (str): Output file
+        array (np.ndarray): Values
+        transform (Affine): Affine transform of the raster
+    """
+    with rasterio.open(path, 'w', driver='GTiff', height=array.shape[0], width=array.shape[1], count=1, dtype=array.dtype.name, transform=transform) as dataset:
+        dataset.write(array, 1)
+
+
+def ribbon(line: np.ndarray, centre: callable, offset: float, half_width: float) -> dict:
+    """Polygon along the river at an offset from its center line, like a river or road.
+
+    Args:
+        line (np.ndarray): x-coordinates along the polygon
+        centre (callable): y-coordinate of the river center for x
+        offset (float): Distance north of the center
+        half_width (float): Half the width of the polygon
+
+    Returns:
+        dict: GeoJSON-like polygon
+    """
+    upper = np.column_stack((line, centre(line) + offset + half_width))
+    lower = np.column_stack((line[::-1], centre(line[::-1]) + offset - half_width))
+    ring = np.concatenate((upper, lower, upper[:1]))
+    return {'type': 'Polygon', 'coordinates': [ring.tolist()]}
+
+
+def synthetic_river(size: int, seed: int = 0, point_distance: float = 4, river_width: float = 12, directory: str = None) -> dict:
+    """Generates a river valley with size x size cells of 1 m. The river runs from west to east, winding
+    around the middle of the raster, with points every point_distance meters along it.
+
+    Args:
+        size (int): Width and height of the rasters in cells
+        seed (int, optional): Seed of the random buildings, roads and water surfaces. Defaults to 0.
+        point_distance (float, optional): Distance between points along the river. Defaults to 4.
+        river_width (float, optional): Width of the river polygon. Defaults to 12.
+        directory (str, optional): Where the DEM and composite raster are written. Defaults to None = a temporary directory.
+
+    Returns:
+        dict: 'dem', 'direction' and 'classes' rasters, 'polygons' of the river, buildings and roads, 'transform', 'edges' of the river polygon,
+        'orig_id' and 'ends' of the transects, 'table' with the points, and paths of the 'dem_path', 'direction_path' and 'flow_path' files
+    """
+    rng = np.random.default_rng(seed)
+    if directory == None:
+        directory = tempfile.mkdtemp(prefix='cpd_benchmark_')
+    transform = Affine(1, 0, 0, 0, -1, size)
+    x = np.arange(size) + 0.5
+    y = size - np.arange(size)[:, None] - 0.5
+    amplitude, period = size / 8, size / 2
+
+    def centre(x):
+        return size / 2 + amplitude * np.sin(2 * np.pi * x / period)
+
+    # valley sloping to the east and up from the river, with the river bed a meter below the banks
+    across = np.abs(y - centre(x)[None, :])
+    river = across < river_width / 2
+    dem = 100 - 0.01 * x[None, :] + 0.05 * across + 0.002 * across**1.5 - np.where(river, 1.0, 0.0)
+    dem += rng.normal(0, 0.001, dem.shape)
+    direction = d8_directions(dem)
+    dem_path = os.path.join(directory, 'dem.tif')
+    write_raster(dem_path, dem.astype(np.float32), transform)
+    direction_path = os.path.join(directory, 'd8.tif')
+    write_raster(direction_path, direction, transform)
+
+    # polygons of the river, of roads along the river, one within the bank points and one further up the valley side, and of buildings
+    line = np.linspace(0, size, size + 1)
+    polygons = {'river': [ribbon(line, centre, 0, river_width / 2)], 'road': [], 'building': []}
+    for offset in (river_width / 2 + 16, size / 6):
+        for side in (-1, 1):
+            polygons['road'].append(ribbon(line, centre, side * offset, 1.5))
+    for _ in range(size**2 // 4000):
+        left, top = rng.integers(0, size-8, 2)
+        right, bottom = left + rng.integers(3, 8), top - rng.integers(3, 8)
+        polygons['building'].append({'type': 'Polygon', 'coordinates': [[(left, top), (right, top), (right, bottom), (left, bottom), (left, top)]]})
+    flow_path = os.path.join(directory, 'flow.tif')
+    composite_raster.build_composite(flow_path, direction_path, polygons['river'], polygons['building'], polygons['road'])
+    with rasterio.open(flow_path) as dataset:
+        classes = dataset.read(2)
+    edges = bank_sampling.polygon_edges([np.array(polygons['river'][0]['coordinates'][0])])
+
+    # points and transects along the river, split in segments of about 200 points
+    px = np.arange(point_distance / 2, size - point_distance / 2, point_distance)
+    py = centre(px)
+    tangent = np.column_stack((np.ones(len(px)), 2 * np.pi * amplitude / period * np.cos(2 * np.pi * px / period)))
+    tangent /= np.hypot(*tangent.T)[:, None]
+    normal = np.column_stack((-tangent[:, 1], tangent[:, 0]))
+    half = river_width / 2 + DISTANCES[-1] + 10
+    centre_xy = np.column_stack((px, py))
+    ends = np.stack((centre_xy + normal * half, centre_xy - normal * half), axis=1)
+    ids = np.arange(1, len(px) + 1)
+    table = River_table(ids, DISTANCES)
+    table.add_field('River_Segment', ((ids - 1) // 200 + 1).tolist())
+    table.add_field('River_Sequence', ((ids - 1) % 200 + 1).tolist())
+    table.add_field('Length', np.full(len(ids), float(point_distance)))
+    rows, cols = rowcol(transform, px, py)
+    elevation = dem[np.asarray(rows), np.asarray(cols)]
+    table.add_field('Elevation', elevation)
+    for q, depth in SCENARIOS.items():
+        table.add_field(f'Q{q}_wse_diff', depth + rng.normal(0, 0.3, len(ids)))
+    return {'dem': dem, 'direction': direction, 'classes': classes, 'polygons': polygons, 'transform': transform, 'edges': edges,
+            'orig_id': ids, 'ends': ends, 'table': table, 'dem_path': dem_path, 'direction_path': direction_path,
+            'flow_path': flow_path, 'directory': directory}
+
+
+def make_river(data: dict) -> River:
+    """Creates a River with the synthetic points, without running the geoprocessing.
+
+    Args:
+        data (dict): Output from synthetic_river()
+
+    Returns:
+        River: River with self.data from the synthetic points
+    """
+    river = River(data['directory'], 'benchmark', 'river_polygon', os.path.basename(data['dem_path']))
+    river.distance_tupl = DISTANCES
+    river.scenarios = {q: f'wse{q}' for q in SCENARIOS}
+    river.data = data['table'].take(np.arange(len(data['table'])))
+    names = tuple(f'Q{q}' for q in SCENARIOS)
+    river.add_no_data(('Gradient', 'slope_area_r', 'slope_area_l') + tuple(f'longest_water_{q}_{side}' for q in names for side in ('l', 'r')))
+    river.segment_index()
+    return river
+
+
+def timed(function: callable, repeat: int) -> tuple[dict, any]:
+    """Runs a function repeat times.
+
+    Args:
+        function (callable): Function without arguments
+        repeat (int): Number of runs
+
+    Returns:
+        tuple[dict, any]: Timings with 'min', 'median' and 'runs' in seconds, and the output of the last run
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = function()
+        runs.append(time.perf_counter() - start)
+    return {'min': min(runs), 'median': float(np.median(runs)), 'runs': runs}, output
+
+
+def run_size(size: int, repeat: int = 3, workers: tuple[int] = (1,), seed: int = 0, stages: tuple[str] = STAGES) -> dict:
+    """Benchmarks every stage at one size. Each stage gets its input from the stages before it,
+    which are run once untimed if they are not benchmarked.
+
+    Args:
+        size (int): Width and height of the rasters in cells
+        repeat (int, optional): Runs of every stage. Defaults to 3.
+        workers (tuple[int], optional): Numbers of worker processes for flow tracing. Defaults to (1,).
+        seed (int, optional): Seed of the synthetic data. Defaults to 0.
+        stages (tuple[str], optional): Stages to benchmark. Defaults to STAGES.
+
+    Returns:
+        dict: 'size', 'counts' of cells, points and paths, and 'stages' with the timings of every stage
+    """
+    with tempfile.TemporaryDirectory(prefix='cpd_benchmark_') as directory:
+        generate_st = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data = synthetic_river(size, seed, directory=directory)
+        result = {'size': size, 'generate_time': time.perf_counter() - generate_st, 'stages': {}}
+        river = make_river(data)
+        names = tuple(f'Q{q}' for q in SCENARIOS)
+        # the progress lines of the stages are for batch runs
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            def sample():
+                points, values = river.sample_banks(data['ends'], data['edges'], dem_path=data['dem_path'])
+                river.set_bank_points(data['orig_id'], points, values)
+            if 'bank_sampling' in stages:
+                result['stages']['bank_sampling'], _ = timed(sample, repeat)
+            else:
+                sample()
+
+            def cross_section():
+                for segment in river.segment_index():
+                    river.calculate_gradient(segment)
+                    river.add_xsection_data(segment)
+                river.add_longest_water(names)
+            if 'cross_section' in stages:
+                result['stages']['cross_section'], _ = timed(cross_section, repeat)
+            else:
+                cross_section()
+
+            def critical():
+                return river.find_critical_points(tuple(SCENARIOS))
+            if 'critical_points' in stages:
+                result['stages']['critical_points'], scenarios = timed(critical, repeat)
+            else:
+                scenarios = critical()
+
+            def condition():
+                hydrology.fill_and_direction(data['dem_path'], os.path.join(directory, 'conditioned.tif'), tile_size=max(64, size // 4),
+                                             workers=max(workers))
+            if 'hydrology' in stages:
+                result['stages']['hydrology'], _ = timed(condition, repeat)
+
+            def merge():
+                polygons = data['polygons']
+                composite_raster.build_composite(os.path.join(directory, 'merged.tif'), data['direction_path'], polygons['river'],
+                                                 polygons['building'], polygons['road'], workers=max(workers))
+            if 'raster_merge' in stages:
+                result['stages']['raster_merge'], _ = timed(merge, repeat)
+
+            # bank points are found in the flow raster from their coordinates, like service.py
+            oid = river.data.bank_oid.reshape(-1)
+            xy = river.data.bank_xy.reshape(-1, 2)
+            keep = (oid >= 0) & np.isfinite(xy).all(axis=1)
+            rows, cols = (np.asarray(x, dtype=np.int64) for x in rowcol(data['transform'], xy[keep, 0], xy[keep, 1]))
+            inside = (rows >= 0) & (rows < size) & (cols >= 0) & (cols < size)
+            cells = dict(zip(oid[keep][inside].tolist(), zip(rows[inside].tolist(), cols[inside].tolist())))
+            points = {x: cells[x] for x in sorted(set(x for crit in scenarios.values() for x in crit if x in cells))}
+            scenarios = {q: {x: y for x, y in crit.items() if x in cells} for q, crit in scenarios.items()}
+            flood_path = Flood_path.from_array(np.stack((data['direction'], data['classes'])), data['transform'])
+            if 'flow_tracing' in stages:
+                result['stages']['flow_tracing'] = {}
+                for count in workers:
+                    def trace():
+                        return flood_path.analyze_scenarios(points, scenarios, duplicate_paths=True, workers=count, as_arcpy=False)
+                    timing, paths = timed(trace, repeat)
+                    timing['trace_time'] = flood_path.trace_time
+                    timing['resolve_time'] = flood_path.resolve_time
+                    result['stages']['flow_tracing'][str(count)] = timing
+            else:
+                paths = flood_path.analyze_scenarios(points, scenarios, duplicate_paths=True, as_arcpy=False)
+
+            if 'export' in stages:
+                def export():
+                    for q in paths:
+                        path_export.write_paths(paths[q], os.path.join(directory, f'paths_{q}.gpkg'))
+                result['stages']['export'], _ = timed(export, repeat)
+
+        result['counts'] = {'cells': size * size, 'points': len(river.data), 'bank_points': int((river.data.bank_oid >= 0).sum()),
+                            'candidates': len(points), 'paths': {str(q): len(x) for q, x in paths.items()},
+                            'path_cells': {str(q): int(sum(len(y[0]) for y in x.values())) for q, x in paths.items()}}
+    return result
+
+
+def scaling(results: list[dict]) -> dict:
+    """Scaling curves of the median time of every stage over the number of cells, with the exponent of a fitted power law.
+
+    Args:
+        results (list[dict]): Output from run_size() for several sizes
+
+    Returns:
+        dict: Stage, or 'flow_tracing_{workers}', as key and 'cells', 'median' and 'exponent' as value
+    """
+    curves = {}
+    for result in results:
+        for stage, timing in result['stages'].items():
+            for name, value in ({f'{stage}_{x}': y for x, y in timing.items()} if stage == 'flow_tracing' else {stage: timing}).items():
+                curve = curves.setdefault(name, {'cells': [], 'median': []})
+                curve['cells'].append(result['counts']['cells'])
+                curve['median'].append(value['median'])
+    for curve in curves.values():
+        cells, median = np.log(curve['cells']), np.log(np.maximum(curve['median'], 1e-9))
+        curve['exponent'] = float(np.polyfit(cells, median, 1)[0]) if len(set(curve['cells'])) > 1 else None
+    return curves
+
+
+def main(sizes: tuple[int], repeat: int = 3, workers: tuple[int] = (1,), seed: int = 0, stages: tuple[str] = STAGES, output: str = None) -> dict:
+    """Runs the benchmark at every size and writes the results as JSON.
+
+    Args:
+        sizes (tuple[int]): Width and height of the rasters in cells
+        repeat (int, optional): Runs of every stage. Defaults to 3.
+        workers (tuple[int], optional): Numbers of worker processes for flow tracing. Defaults to (1,).
+        seed (int, optional): Seed of the synthetic data. Defaults to 0.
+        stages (tuple[str], optional): Stages to benchmark. Defaults to STAGES.
+        output (str, optional): JSON file. Defaults to None = only printed.
+
+    Returns:
+        dict: 'meta' with the machine and settings, 'results' of every size and 'scaling' from scaling()
+    """
+    results = []
+    for size in sizes:
+        print(f"Benchmarking {size} x {size} cells")
+        result = run_size(size, repeat, workers, seed, stages)
+        for stage, timing in result['stages'].items():
+            for name, value in ({f'{stage} ({x} workers)': y for x, y in timing.items()} if stage == 'flow_tracing' else {stage: timing}).items():
+                print(f"    {name:<28} {value['median']:.4f} s")
+        results.append(result)
+    report = {'meta': {'time': datetime.now().isoformat(), 'platform': platform.platform(), 'python': platform.python_version(),
+                       'numpy': np.__version__, 'rasterio': rasterio.__version__, 'cpus': os.cpu_count(),
+                       'sizes': list(sizes), 'repeat': repeat, 'workers': list(workers), 'seed': seed, 'stages': list(stages)},
+              'results': results, 'scaling': scaling(results)}
+    print("Scaling exponent over cells")
+    for name, curve in report['scaling'].items():
+        print(f"    {name:<28} {curve['exponent']}")
+    if output != None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+# worker processes import this module, so the benchmark only runs in the main process
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the analysis stages on synthetic data")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+    main(tuple(args.sizes), args.repeat, tuple(args.workers), args.seed, tuple(args.stages), args.output)
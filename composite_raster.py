@@ -0,0 +1,257 @@
+"""
+Builds the composite flow raster for Flood_path without arcpy, like raster_merge.py.
+Band 1 is the D8 flow direction and band 2 the class of every cell, with the same priority as the Con() chain
+in raster_merge.py: river 3 over buildings 2, expanded by one cell, over roads 1, and 0 (NoData) elsewhere.
+Polygons are rasterized by cell center like PolygonToRaster.
+
+The raster is built block by block on the grid of the flow direction raster, so only a few blocks are in
+memory at a time, and blocks can be built in worker processes. Blocks are written as they are done to a
+tiled and compressed GeoTIFF, without intermediate rasters.
+
+Run with:
+    python composite_raster.py flow_dir.tif output.tif --river river.geojson --building buildings.geojson --road roads.geojson --workers 4
+"""
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import arcpy
+except ImportError: # the builder runs without ArcGIS
+    arcpy = None
+import numpy as np
+import rasterio
+from rasterio import features, windows
+from rasterio.windows import Window
+
+CLASSES = {'road': 1, 'building': 2, 'river': 3}
+
+
+def geometry_bounds(geometry: dict) -> tuple[float, float, float, float]:
+    """Bounding box of a GeoJSON-like geometry.
+
+    Args:
+        geometry (dict): Geometry with 'coordinates'
+
+    Returns:
+        tuple[float, float, float, float]: Min x, min y, max x and max y
+    """
+    coords = geometry['coordinates']
+    # polygons and multipolygons are nested lists of points
+    while len(coords) > 0 and isinstance(coords[0], (list, tuple)) and isinstance(coords[0][0], (list, tuple)):
+        coords = [point for part in coords for point in part]
+    xy = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    if len(xy) == 0:
+        return (np.inf, np.inf, -np.inf, -np.inf)
+    return (*xy.min(axis=0), *xy.max(axis=0))
+
+
+def read_features(source: any, workspace: str = None) -> list[dict]:
+    """Reads polygons as GeoJSON-like geometries.
+
+    Args:
+        source (any): Path to a GeoJSON file, name of a feature class in workspace (needs arcpy),
+            or an iterable of geometries as dicts or objects with __geo_interface__, like shapely or arcpy geometries
+        workspace (str, optional): gdb with the feature class. Defaults to None.
+
+    Returns:
+        list[dict]: Geometries
+    """
+    if source == None:
+        return []
+    if isinstance(source, str) and source.lower().endswith(('.geojson', '.json')):
+        with open(source) as f:
+            data = json.load(f)
+        items = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+        return [x['geometry'] if x.get('type') == 'Feature' else x for x in items if x.get('geometry', x) != None]
+    if isinstance(source, str):
+        if arcpy == None:
+            raise ValueError(f"Reading the feature class '{source}' needs arcpy, use a GeoJSON file")
+        if workspace != None:
+            arcpy.env.workspace = workspace
+        with arcpy.da.SearchCursor(source, ['SHAPE@']) as cursor:
+            return [row[0].__geo_interface__ for row in cursor if row[0] != None]
+    return [x.__geo_interface__ if hasattr(x, '__geo_interface__') else x for x in source]
+
+
+def prepare_layers(river: any, building: any, road: any, workspace: str = None) -> dict[str: tuple[list, np.ndarray]]:
+    """Reads the polygons of every layer and their bounding boxes.
+
+    Args:
+        river (any): River polygons, see read_features()
+        building (any): Building polygons, see read_features()
+        road (any): Road polygons, see read_features()
+        workspace (str, optional): gdb with the feature classes. Defaults to None.
+
+    Returns:
+        dict[str: tuple[list, np.ndarray]]: Layer name as key, and geometries and bounds with shape (geometries, 4) as value
+    """
+    layers = {}
+    for name, source in (('river', river), ('building', building), ('road', road)):
+        geometries = read_features(source, workspace)
+        bounds = np.array([geometry_bounds(x) for x in geometries], dtype=np.float64).reshape(-1, 4)
+        layers[name] = (geometries, bounds)
+    return layers
+
+
+def rasterize_layer(layer: tuple[list, np.ndarray], window: Window, transform: any) -> np.ndarray:
+    """Rasterizes the polygons of a layer that reach into a window.
+
+    Args:
+        layer (tuple[list, np.ndarray]): Geometries and bounds from prepare_layers()
+        window (Window): Window in the grid of transform, can reach outside the raster
+        transform (any): Affine transform of the raster
+
+    Returns:
+        np.ndarray: True for cells with the center inside a polygon
+    """
+    geometries, bounds = layer
+    shape = (int(window.height), int(window.width))
+    left, bottom, right, top = windows.bounds(window, transform)
+    near = np.flatnonzero((bounds[:, 0] <= right) & (bounds[:, 2] >= left) & (bounds[:, 1] <= top) & (bounds[:, 3] >= bottom))
+    if len(near) == 0:
+        return np.zeros(shape, dtype=bool)
+    return features.rasterize(((geometries[i], 1) for i in near.tolist()), out_shape=shape, transform=windows.transform(window, transform),
+                              fill=0, dtype='uint8').astype(bool)
+
+
+def block_classes(layers: dict[str: tuple[list, np.ndarray]], window: Window, transform: any, shape: tuple[int, int], expand: int = 1) -> np.ndarray:
+    """Class band of one block. Buildings are rasterized with a margin of expand cells, so the expansion
+    reaches across block edges, but not from outside the raster, like Expand() on the raster of the extent.
+
+    Args:
+        layers (dict[str: tuple[list, np.ndarray]]): Output from prepare_layers()
+        window (Window): Block in the raster
+        transform (any): Affine transform of the raster
+        shape (tuple[int, int]): Rows and columns of the raster
+        expand (int, optional): Cells buildings are expanded by, in all eight directions. Defaults to 1.
+
+    Returns:
+        np.ndarray: Classes as uint8
+    """
+    height, width = int(window.height), int(window.width)
+    classes = np.zeros((height, width), dtype=np.uint8)
+    classes[rasterize_layer(layers['road'], window, transform)] = CLASSES['road']
+    padded = Window(window.col_off - expand, window.row_off - expand, width + 2 * expand, height + 2 * expand)
+    building = rasterize_layer(layers['building'], padded, transform)
+    rows = np.arange(padded.row_off, padded.row_off + padded.height)
+    cols = np.arange(padded.col_off, padded.col_off + padded.width)
+    building &= ((rows >= 0) & (rows < shape[0]))[:, None] & ((cols >= 0) & (cols < shape[1]))[None, :]
+    expanded = np.zeros((height, width), dtype=bool)
+    for d_row in range(2 * expand + 1):
+        for d_col in range(2 * expand + 1):
+            expanded |= building[d_row:d_row+height, d_col:d_col+width]
+    classes[expanded] = CLASSES['building']
+    classes[rasterize_layer(layers['river'], window, transform)] = CLASSES['river']
+    return classes
+
+
+def blocks(shape: tuple[int, int], block_size: int) -> list[Window]:
+    """Splits a raster into square blocks, row by row.
+
+    Args:
+        shape (tuple[int, int]): Rows and columns of the raster
+        block_size (int): Width and height of blocks in cells
+
+    Returns:
+        list[Window]: Window of every block
+    """
+    return [Window(col, row, min(block_size, shape[1] - col), min(block_size, shape[0] - row))
+            for row in range(0, shape[0], block_size) for col in range(0, shape[1], block_size)]
+
+
+# flow direction raster and polygons of a worker process, set once by init_block_worker()
+worker_flow_dir = None
+worker_layers = None
+worker_expand = 1
+
+
+def init_block_worker(flow_dir: str, layers: dict[str: tuple[list, np.ndarray]], expand: int) -> None:
+    """Opens the flow direction raster and stores the polygons in a worker process.
+
+    Args:
+        flow_dir (str): Path to the D8 flow direction raster
+        layers (dict[str: tuple[list, np.ndarray]]): Output from prepare_layers()
+        expand (int): Cells buildings are expanded by
+    """
+    global worker_flow_dir, worker_layers, worker_expand
+    worker_flow_dir = rasterio.open(flow_dir)
+    worker_layers = layers
+    worker_expand = expand
+
+
+def build_block(window: Window) -> tuple[Window, np.ndarray]:
+    """Builds both bands of one block with the raster and polygons of this process.
+
+    Args:
+        window (Window): Block in the raster
+
+    Returns:
+        tuple[Window, np.ndarray]: The window, and the block as uint8 with shape (2, rows, cols)
+    """
+    direction = worker_flow_dir.read(1, window=window, masked=True)
+    # NoData and values that are not D8 codes end a flow path, and are written as 0
+    direction = np.where(np.ma.getmaskarray(direction) | (direction < 1) | (direction > 128), 0, direction.filled(0)).astype(np.uint8)
+    classes = block_classes(worker_layers, window, worker_flow_dir.transform, worker_flow_dir.shape, worker_expand)
+    return window, np.stack((direction, classes))
+
+
+def build_composite(output: str, flow_dir: str, river: any, building: any, road: any, workspace: str = None,
+                    block_size: int = 2048, workers: int = 1, expand: int = 1, tile_size: int = 256) -> None:
+    """Builds the composite flow raster block by block and writes it as a tiled, compressed two band GeoTIFF.
+    The output has the grid of the flow direction raster, which is the snap raster and extent in raster_merge.py.
+
+    Args:
+        output (str): Path to the GeoTIFF
+        flow_dir (str): Path to the D8 flow direction raster, with codes 1 to 128
+        river (any): River polygons, see read_features()
+        building (any): Building polygons, see read_features()
+        road (any): Road polygons, see read_features()
+        workspace (str, optional): gdb with the feature classes, when they are read with arcpy. Defaults to None.
+        block_size (int, optional): Width and height of blocks in cells, a multiple of tile_size. Defaults to 2048.
+        workers (int, optional): Worker processes building blocks. Defaults to 1 = build them here.
+        expand (int, optional): Cells buildings are expanded by. Defaults to 1.
+        tile_size (int, optional): Width and height of the GeoTIFF tiles. Defaults to 256.
+    """
+    block_size = max(tile_size, block_size // tile_size * tile_size)
+    print("Reading polygons")
+    layers = prepare_layers(river, building, road, workspace)
+    with rasterio.open(flow_dir) as dataset:
+        shape = dataset.shape
+        profile = {'driver': 'GTiff', 'height': shape[0], 'width': shape[1], 'count': 2, 'dtype': 'uint8', 'nodata': 0,
+                   'crs': dataset.crs, 'transform': dataset.transform, 'tiled': True, 'blockxsize': tile_size,
+                   'blockysize': tile_size, 'compress': 'deflate', 'predictor': 2, 'BIGTIFF': 'IF_SAFER'}
+    windows_list = blocks(shape, block_size)
+    print(f"Building {len(windows_list)} blocks")
+    with rasterio.open(output, 'w', **profile) as out:
+        if workers <= 1:
+            init_block_worker(flow_dir, layers, expand)
+            for window in windows_list:
+                out.write(build_block(window)[1], window=window)
+            worker_flow_dir.close()
+            return
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_block_worker, initargs=(flow_dir, layers, expand)) as pool:
+            # a few blocks per worker are in flight, so memory stays bounded on large rasters
+            pending = []
+            for window in windows_list:
+                pending.append(pool.submit(build_block, window))
+                if len(pending) >= 2 * workers:
+                    window_done, data = pending.pop(0).result()
+                    out.write(data, window=window_done)
+            for future in pending:
+                window_done, data = future.result()
+                out.write(data, window=window_done)
+
+
+# worker processes import this module, so the builder only runs in the main process
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Composite flow raster from a D8 raster and river, building and road polygons")
+    parser.add_argument('flow_dir', help="D8 flow direction raster")
+    parser.add_argument('output', help="two band GeoTIFF")
+    parser.add_argument('--river', required=True)
+    parser.add_argument('--building')
+    parser.add_argument('--road')
+    parser.add_argument('--workspace', help="gdb with the feature classes, read with arcpy")
+    parser.add_argument('--block-size', type=int, default=2048)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+    build_composite(args.output, args.flow_dir, args.river, args.building, args.road, args.workspace, args.block_size, args.workers)
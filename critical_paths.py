@@ -1,198 +1,1248 @@
-import arcpy
+from __future__ import annotations
+import os
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+try:
+    import arcpy
+except ImportError: # the query service and workers can run without ArcGIS
+    arcpy = None
+import numpy as np
 import rasterio
+from rasterio.transform import AffineTransformer
+from rasterio.windows import Window
+from raster_tiles import Tiled_raster, Block_array
+import instrumentation
+import path_export
+import point_import
+
+# Row and column offset for every D8 code, indexed by the code itself. Codes that are not
+# a single direction (0, 3, 5, ...) are marked invalid and end the path like nodata.
+D8_CODES = (1, 2, 4, 8, 16, 32, 64, 128)
+D8_OFFSETS = np.zeros((129, 2), dtype=np.int64)
+D8_VALID = np.zeros(129, dtype=bool)
+for _code, _offset in zip(D8_CODES, ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1))):
+    D8_OFFSETS[_code] = _offset
+    D8_VALID[_code] = True
+
+
+def trace_paths(raster: any, rows: any, cols: any, max_steps: int = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Traces the D8 flow path of many start cells at once.
+    All active paths are advanced one cell per iteration, and a path stops when it reaches
+    a cell with class 3 (river) or 4 (nodata). A direction outside the D8 codes, or a step
+    off the raster, repeats the current cell with class 4, as the original loop did.
+    A path caught in a flow loop, which the original loop never left, ends the same way when it steps back
+    onto its checkpoint, the cell it was on at the last step number that is a power of two (Brent's method).
+    So a loop is found within about four times the steps to it and around it.
+
+    Args:
+        raster (any): Array with D8 codes in band 0 and classes in band 1, indexed [band, row, col]
+        rows (any): Row index of every start cell
+        cols (any): Column index of every start cell
+        max_steps (int, optional): Stops paths after this many steps. Defaults to None = number of cells, which a path
+            can't reach without a loop.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Row, column and class of every path cell, 
+        grouped path by path, and offsets so that path i is [offsets[i]:offsets[i+1]].
+    """
+    n_rows, n_cols = raster.shape[1:]
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    num_paths = len(rows)
+    if max_steps == None:
+        max_steps = n_rows * n_cols
+    ids = np.arange(num_paths)
+    target = np.asarray(raster[1, rows, cols])
+    checkpoint = rows * n_cols + cols
+    step_ids, step_rows, step_cols, step_targets = [ids], [rows], [cols], [target]
+    step = 0
+    while len(ids) > 0:
+        active = (target != 3) & (target != 4)
+        ids, rows, cols, checkpoint = ids[active], rows[active], cols[active], checkpoint[active]
+        if len(ids) == 0:
+            break
+        step += 1
+        direction = np.asarray(raster[0, rows, cols]).astype(np.int64)
+        code = np.where((direction >= 1) & (direction <= 128), direction, 0)
+        new_rows = rows + D8_OFFSETS[code, 0]
+        new_cols = cols + D8_OFFSETS[code, 1]
+        valid = D8_VALID[code] & (new_rows >= 0) & (new_rows < n_rows) & (new_cols >= 0) & (new_cols < n_cols)
+        valid &= new_rows * n_cols + new_cols != checkpoint
+        if step >= max_steps:
+            valid[:] = False
+        rows = np.where(valid, new_rows, rows)
+        cols = np.where(valid, new_cols, cols)
+        if step & (step - 1) == 0:
+            checkpoint = rows * n_cols + cols
+        target = np.where(valid, np.asarray(raster[1, rows, cols]), 4)
+        step_ids.append(ids)
+        step_rows.append(rows)
+        step_cols.append(cols)
+        step_targets.append(target)
+
+    # Steps are recorded in order, so a stable sort on path id keeps every path in flow order
+    order = np.argsort(np.concatenate(step_ids), kind='stable')
+    offsets = np.zeros(num_paths+1, dtype=np.int64)
+    np.cumsum(np.bincount(np.concatenate(step_ids), minlength=num_paths), out=offsets[1:])
+    return np.concatenate(step_rows)[order], np.concatenate(step_cols)[order], np.concatenate(step_targets)[order], offsets
+
+
+def trace_tiles(raster: Tiled_raster, rows: any, cols: any, max_steps: int = None, stats: dict = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Traces flow paths like trace_paths(), but one tile at a time, for rasters that are read in tiles because they don't fit in memory.
+    The paths in a tile are advanced until they end or step into another tile, where they are queued in the frontier of that tile.
+    Tiles are visited in sweeps over the tile numbers, forward and then backward, and the whole frontier of a tile is traced on a visit.
+    A tile that is still in the cache is traced again first when paths flow back into it, which reads nothing, and otherwise the sweep
+    goes on to the next tile with a frontier. So every sweep reads a tile at most once, and the tiles read are bounded by the sweeps
+    times the tiles with paths in them. Memory is the tile cache and the frontiers, not the raster.
+
+    Args:
+        raster (Tiled_raster): Raster read in tiles, with D8 codes in band 0 and classes in band 1
+        rows (any): Row index of every start cell
+        cols (any): Column index of every start cell
+        max_steps (int, optional): Stops paths after this many steps. Defaults to None = number of cells.
+        stats (dict, optional): Gets 'tile_loads', the tiles read, 'tile_sweeps', and 'tile_load_bound', the sweeps times the tiles with paths. Defaults to None.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Output like trace_paths()
+    """
+    n_rows, n_cols = raster.shape[1:]
+    tile_size = raster.tile_size
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    num_paths = len(rows)
+    if max_steps == None:
+        max_steps = n_rows * n_cols
+    # frontier of every tile, as parts with the path id, row, column and step number of the cell each path arrives on
+    frontier = {}
+
+    def queue(ids, rows, cols, steps):
+        tile_ids = (rows // tile_size) * raster.tiles_x + cols // tile_size
+        order = np.argsort(tile_ids, kind='stable')
+        tile_ids, first = np.unique(tile_ids[order], return_index=True)
+        for tile_id, part in zip(tile_ids.tolist(), np.split(order, first[1:])):
+            frontier.setdefault(tile_id, []).append((ids[part], rows[part], cols[part], steps[part]))
+
+    queue(np.arange(num_paths), rows, cols, np.zeros(num_paths, dtype=np.int64))
+    # checkpoint of every path for finding flow loops, like in trace_paths()
+    checkpoint = rows * n_cols + cols
+    empty = np.zeros(0, dtype=np.int64)
+    step_ids, step_nums, step_rows, step_cols, step_targets = [empty], [empty], [empty], [empty], [np.zeros(0, dtype=raster.dtype)]
+    misses = raster.misses
+    # tile number the sweep has come to, and 1 for a forward sweep or -1 for a backward sweep
+    position, heading, sweeps = -1, 1, 1
+    visited = set()
+    while len(frontier) > 0:
+        cached = [x for x in frontier if x in raster.cache]
+        if len(cached) > 0:
+            tile_id = cached[0]
+        else:
+            ahead = [x for x in frontier if (x - position) * heading > 0]
+            if len(ahead) == 0:
+                # all frontiers are behind the sweep, so the next sweep goes the other way
+                heading, sweeps = -heading, sweeps + 1
+                ahead = list(frontier)
+            tile_id = min(ahead, key=lambda x: x * heading)
+            position = tile_id
+        visited.add(tile_id)
+        parts = frontier.pop(tile_id)
+        ids, rows, cols, steps = (np.concatenate([part[i] for part in parts]) for i in range(4))
+        data = raster.tile(tile_id)
+        row_off = (tile_id // raster.tiles_x) * tile_size
+        col_off = (tile_id % raster.tiles_x) * tile_size
+        tile_rows, tile_cols = data.shape[1:]
+        target = data[1, rows - row_off, cols - col_off]
+        while len(ids) > 0:
+            step_ids.append(ids)
+            step_nums.append(steps)
+            step_rows.append(rows)
+            step_cols.append(cols)
+            step_targets.append(target)
+            active = (target != 3) & (target != 4)
+            ids, rows, cols, steps = ids[active], rows[active], cols[active], steps[active] + 1
+            direction = data[0, rows - row_off, cols - col_off].astype(np.int64)
+            code = np.where((direction >= 1) & (direction <= 128), direction, 0)
+            new_rows = rows + D8_OFFSETS[code, 0]
+            new_cols = cols + D8_OFFSETS[code, 1]
+            valid = D8_VALID[code] & (new_rows >= 0) & (new_rows < n_rows) & (new_cols >= 0) & (new_cols < n_cols) & (steps < max_steps)
+            valid &= new_rows * n_cols + new_cols != checkpoint[ids]
+            moved = valid & (steps & (steps - 1) == 0)
+            checkpoint[ids[moved]] = new_rows[moved] * n_cols + new_cols[moved]
+            # the path ends here, and the cell is repeated with class 4
+            if not valid.all():
+                ended = ~valid
+                step_ids.append(ids[ended])
+                step_nums.append(steps[ended])
+                step_rows.append(rows[ended])
+                step_cols.append(cols[ended])
+                step_targets.append(np.full(ended.sum(), 4, dtype=raster.dtype))
+            inside = valid & (new_rows >= row_off) & (new_rows < row_off + tile_rows) & (new_cols >= col_off) & (new_cols < col_off + tile_cols)
+            leaving = valid & ~inside
+            if leaving.any():
+                queue(ids[leaving], new_rows[leaving], new_cols[leaving], steps[leaving])
+            ids, rows, cols, steps = ids[inside], new_rows[inside], new_cols[inside], steps[inside]
+            target = data[1, rows - row_off, cols - col_off]
+
+    if stats != None:
+        stats.update({'tile_loads': raster.misses - misses, 'tile_sweeps': sweeps, 'tile_load_bound': sweeps * len(visited)})
+    # Steps of a path are recorded in different tiles, so paths are put in flow order by step number
+    ids = np.concatenate(step_ids)
+    order = np.lexsort((np.concatenate(step_nums), ids))
+    offsets = np.zeros(num_paths+1, dtype=np.int64)
+    np.cumsum(np.bincount(ids, minlength=num_paths), out=offsets[1:])
+    return np.concatenate(step_rows)[order], np.concatenate(step_cols)[order], np.concatenate(step_targets)[order], offsets
+
+
+def downstream_index(raster: any) -> dict[str: np.ndarray]:
+    """Resolves, for every cell in the raster, where its flow path ends and where it first
+    crosses a road or building (class 1 or 2). Uses pointer jumping, where each pass doubles the
+    number of steps every cell has resolved, so the whole raster is done in log2(path length) passes.
+    Distances are counted in steps of trace_paths(), so a path ending on an invalid direction
+    includes the repeated last cell.
+
+    Args:
+        raster (any): Array with D8 codes in band 0 and classes in band 1, indexed [band, row, col]
+
+    Returns:
+        dict[str: np.ndarray]: Raster shaped arrays 'terminal' and 'first_crit' with the flat index of the cell
+        (-1 if none, or if the path is caught in a flow loop), and 'terminal_dist' and 'first_crit_dist' with the number of steps to it.
+    """
+    n_rows, n_cols = raster.shape[1:]
+    size = n_rows * n_cols
+    cells = np.arange(size, dtype=np.int64)
+    rows, cols = np.divmod(cells, n_cols)
+    target = np.asarray(raster[1]).reshape(-1)
+    direction = np.asarray(raster[0]).reshape(-1).astype(np.int64)
+    code = np.where((direction >= 1) & (direction <= 128), direction, 0)
+    new_rows = rows + D8_OFFSETS[code, 0]
+    new_cols = cols + D8_OFFSETS[code, 1]
+    valid = D8_VALID[code] & (new_rows >= 0) & (new_rows < n_rows) & (new_cols >= 0) & (new_cols < n_cols)
+    end = (target == 3) | (target == 4)
+    step = ~end & valid
+    # cells that stop on an invalid direction repeat themselves once before ending
+    end_steps = np.where(~end & ~valid, 1, 0)
+    del rows, cols, direction, code
+
+    jump = np.where(step, new_rows * n_cols + new_cols, cells)
+    hops = step.astype(np.int64)
+    del new_rows, new_cols, valid
+    first_crit = np.where((target == 1) | (target == 2), cells, -1)
+    first_crit_dist = np.zeros(size, dtype=np.int64)
+    for _ in range(int(np.ceil(np.log2(max(size, 2)))) + 1):
+        found = (first_crit < 0) & (first_crit[jump] >= 0)
+        first_crit = np.where(found, first_crit[jump], first_crit)
+        first_crit_dist = np.where(found, hops + first_crit_dist[jump], first_crit_dist)
+        hops = hops + hops[jump]
+        next_jump = jump[jump]
+        if np.array_equal(next_jump, jump):
+            break
+        jump = next_jump
+
+    # paths that have not reached an end cell by now are caught in a flow loop
+    looped = step[jump]
+    terminal = np.where(looped, -1, jump)
+    terminal_dist = np.where(looped, -1, hops + end_steps[jump])
+    first_crit_dist = np.where(first_crit < 0, -1, first_crit_dist)
+    shape = (n_rows, n_cols)
+    return {'terminal': terminal.reshape(shape), 'terminal_dist': terminal_dist.reshape(shape),
+            'first_crit': first_crit.reshape(shape), 'first_crit_dist': first_crit_dist.reshape(shape)}
+
+
+# raster of a worker process, set up once by init_trace_worker()
+worker_raster = None
+worker_memory = None
+
+
+def init_trace_worker(name: str, shape: tuple, dtype: str, path: str, tile_size: int, memory_budget: int) -> None:
+    """Gives a worker process access to the raster, either the shared memory block
+    from Flood_path.share_raster() or its own tiled reader when the raster is read in tiles.
+
+    Args:
+        name (str): Name of the shared memory block, or None to read tiles from path
+        shape (tuple): Shape of the shared array
+        dtype (str): Data type of the shared array
+        path (str): Path to the raster, when name is None
+        tile_size (int): Width and height of tiles in cells
+        memory_budget (int): Bytes for tiles in this worker
+    """
+    global worker_raster, worker_memory
+    if name != None:
+        worker_memory = shared_memory.SharedMemory(name=name)
+        worker_raster = np.ndarray(shape, dtype=dtype, buffer=worker_memory.buf)
+    else:
+        worker_raster = Tiled_raster(rasterio.open(path), tile_size, memory_budget)
+
+
+def release_memory(memory: shared_memory.SharedMemory) -> None:
+    """Closes a shared memory block in this process and unlinks it, so it is freed once the workers close it too."""
+    memory.close()
+    memory.unlink()
+
+
+def share_arrays(arrays: dict[str: np.ndarray]) -> tuple[shared_memory.SharedMemory, list[tuple]]:
+    """Copies arrays to one new shared memory block, so worker processes can read them without a copy each.
+    The caller closes and unlinks the block when the workers are done.
+
+    Args:
+        arrays (dict[str: np.ndarray]): Arrays by name
+
+    Returns:
+        tuple[shared_memory.SharedMemory, list[tuple]]: The block, and the name, shape, data type and byte offset of every array for attach_arrays()
+    """
+    layout = []
+    size = 0
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        layout.append((name, array.shape, array.dtype.str, size))
+        # every array starts on 8 bytes
+        size += -(-array.nbytes // 8) * 8
+    memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for name, shape, dtype, offset in layout:
+        np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset)[...] = arrays[name]
+    return memory, layout
+
+
+def attach_arrays(memory: shared_memory.SharedMemory, layout: list[tuple]) -> dict[str: np.ndarray]:
+    """Arrays in a shared memory block from share_arrays(), as views of the block.
+
+    Args:
+        memory (shared_memory.SharedMemory): The block, opened by name in a worker process
+        layout (list[tuple]): Output from share_arrays()
+
+    Returns:
+        dict[str: np.ndarray]: Arrays by name
+    """
+    return {name: np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset) for name, shape, dtype, offset in layout}
+
+
+def trace_chunk(starts: np.ndarray) -> tuple[tuple, dict]:
+    """Runs trace_paths() on a chunk of start cells in a worker process, or trace_tiles() when the worker reads tiles.
+
+    Args:
+        starts (np.ndarray): Row and column of every start cell, with shape (cells, 2)
+
+    Returns:
+        tuple[tuple, dict]: Output from trace_paths(), and the tile loads from trace_tiles(), empty if the raster is shared
+    """
+    stats = {}
+    if isinstance(worker_raster, Tiled_raster):
+        return trace_tiles(worker_raster, starts[:, 0], starts[:, 1], stats=stats), stats
+    return trace_paths(worker_raster, starts[:, 0], starts[:, 1]), stats
+
+
+def gather_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Index of every element in a set of ranges, like np.concatenate([np.arange(a, a+n) for a, n in zip(starts, lengths)]).
+
+    Args:
+        starts (np.ndarray): First index of every range
+        lengths (np.ndarray): Number of elements in every range
+
+    Returns:
+        np.ndarray: Indexes of the ranges, in order
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) > 0 else 0, dtype=np.int64) + np.repeat(starts - ends + lengths, lengths)
+
+
+def cut_pieces(pieces: list[tuple[int, int, bool]], first: int, last: int = None) -> list[tuple[int, int, bool]]:
+    """Cuts a part out of a path that is stored as pieces of the trace buffer, without copying cells.
+
+    Args:
+        pieces (list[tuple[int, int, bool]]): Start and stop in the buffer of every piece, and whether the first cell
+            of the piece is left out of the critical cells, because it repeats the last cell of the piece before it
+        first (int): Position along the path where the part starts
+        last (int, optional): Position along the path where the part stops. Defaults to None = at the end.
+
+    Returns:
+        list[tuple[int, int, bool]]: Pieces of the part
+    """
+    part = []
+    position = 0
+    for start, stop, skip in pieces:
+        size = stop - start
+        low = max(first - position, 0)
+        high = size if last == None else min(last - position, size)
+        if low < high:
+            part.append((start + low, start + high, skip and low == 0))
+        position += size
+    return part
+
+
+def piece_cells(buffer: np.ndarray, pieces: list[tuple[int, int, bool]]) -> np.ndarray:
+    """Cells of a path stored as pieces, a view of the buffer if it is one piece."""
+    if len(pieces) == 1:
+        return buffer[pieces[0][0]:pieces[0][1]]
+    return np.concatenate([buffer[start:stop] for start, stop, _ in pieces])
+
+
+def piece_critical(critical: np.ndarray, pieces: list[tuple[int, int, bool]]) -> np.ndarray:
+    """Positions along a path stored as pieces of the cells that are critical in the buffer mask."""
+    positions = []
+    position = 0
+    for start, stop, skip in pieces:
+        found = np.flatnonzero(critical[start:stop])
+        positions.append(found[found > 0] + position if skip else found + position)
+        position += stop - start
+    return np.concatenate(positions) if len(positions) > 0 else np.zeros(0, dtype=np.int64)
+
+
+def read_rows(raster: any, row: int, num_rows: int) -> np.ndarray:
+    """Reads all bands of a block of rows.
+
+    Args:
+        raster (any): Array, Tiled_raster or open rasterio dataset
+        row (int): First row
+        num_rows (int): Number of rows
+
+    Returns:
+        np.ndarray: Array indexed [band, row, col]
+    """
+    if isinstance(raster, Tiled_raster):
+        raster = raster.dataset
+    if isinstance(raster, np.ndarray):
+        return raster[:, row:row+num_rows]
+    return raster.read(window=Window(0, row, raster.width, num_rows))
+
+
+def changed_cells(old: any, new: any, block_rows: int = 1024) -> np.ndarray:
+    """Finds the cells where the D8 code or class differs between two versions of the flow raster,
+    like the composite raster from raster_merge.py before and after new buildings or roads.
+    The rasters are compared in blocks of rows, so neither is read in full at once.
+
+    Args:
+        old (any): Path to the old raster, or an array, Tiled_raster or open rasterio dataset
+        new (any): Path to the new raster, or an array, Tiled_raster or open rasterio dataset
+        block_rows (int, optional): Rows compared at a time. Defaults to 1024.
+
+    Returns:
+        np.ndarray: Flat raster index of the changed cells, ascending
+    """
+    opened = [rasterio.open(x) for x in (old, new) if isinstance(x, str)]
+    old, new = (rasterio.open(x) if isinstance(x, str) else x for x in (old, new))
+    try:
+        old_shape = old.shape if isinstance(old, (np.ndarray, Tiled_raster)) else (old.count,) + old.shape
+        new_shape = new.shape if isinstance(new, (np.ndarray, Tiled_raster)) else (new.count,) + new.shape
+        if tuple(old_shape) != tuple(new_shape):
+            raise ValueError(f"The rasters have different shapes, {tuple(old_shape)} and {tuple(new_shape)}")
+        n_rows, n_cols = new_shape[1:]
+        changed = []
+        for row in range(0, n_rows, block_rows):
+            num_rows = min(block_rows, n_rows - row)
+            diff = (read_rows(old, row, num_rows) != read_rows(new, row, num_rows)).any(axis=0)
+            changed.append(np.flatnonzero(diff) + row * n_cols)
+    finally:
+        for dataset in opened:
+            dataset.close()
+    return np.concatenate(changed) if len(changed) > 0 else np.zeros(0, dtype=np.int64)
+
+
+class Path_index:
+    """Raster shaped index of which stored flow path owns each cell, and the first position of the cell along it.
+    Paths that end on another path share that cell, so the other owners of a cell are kept in self.shared.
+    The owner is always the path that was stored first, as a scan through the stored paths in order would find.
+    """
+
+    def __init__(self, shape: tuple[int, int], sparse: bool = False) -> None:
+        """Create an empty index.
+
+        Args:
+            shape (tuple[int, int]): Rows and columns of the raster
+            sparse (bool, optional): Only allocate memory for blocks of cells that paths pass through. Defaults to False.
+        """
+        size = shape[0] * shape[1]
+        # order of storing and position along a path both fit in 32 bits, which halves the index
+        if sparse:
+            self.owner = Block_array(size, -1, np.int32)
+            self.position = Block_array(size, 0, np.int32)
+            self.is_shared = Block_array(size, False, bool)
+        else:
+            self.owner = np.full(size, -1, dtype=np.int32)
+            self.position = np.zeros(size, dtype=np.int32)
+            self.is_shared = np.zeros(size, dtype=bool)
+        self.shared = {}
+        self.keys = {}
+        self.order = {}
+        self.count = 0
+
+    def add(self, key: int, cells: np.ndarray, start: int = 0) -> None:
+        """Adds the cells of a path to the index. Cells that already belong to the path keep their first position.
+
+        Args:
+            key (int): ID of the path
+            cells (np.ndarray): Flat raster index of the cells
+            start (int, optional): Position of the first cell along the path. Defaults to 0.
+        """
+        if key not in self.keys:
+            self.keys[key] = self.count
+            self.order[self.count] = key
+            self.count += 1
+        order = self.keys[key]
+        cells, first = np.unique(cells, return_index=True)
+        owner = self.owner[cells]
+        free = owner < 0
+        self.owner[cells[free]] = order
+        self.position[cells[free]] = first[free] + start
+        taken = ~free & (owner != order)
+        for cell, pos in zip(cells[taken].tolist(), (first[taken] + start).tolist()):
+            owners = self.shared.setdefault(cell, [])
+            if order not in (x[0] for x in owners):
+                owners.append((order, pos))
+                self.is_shared[cell] = True
+
+    def remove(self, key: int, cells: np.ndarray, start: int = 0) -> None:
+        """Removes cells from a path when it is truncated or deleted.
+        Cells with a first position before start stay, as they are still on the path.
+
+        Args:
+            key (int): ID of the path
+            cells (np.ndarray): Flat raster index of the removed cells
+            start (int, optional): Position where the path is cut. Defaults to 0 = whole path.
+        """
+        order = self.keys[key]
+        cells = np.unique(cells)
+        owned = cells[(self.owner[cells] == order) & (self.position[cells] >= start)]
+        # Cells that had other owners go to the path that was stored first
+        promoted = owned[self.is_shared[owned]]
+        self.owner[owned[~self.is_shared[owned]]] = -1
+        for cell in promoted.tolist():
+            self.owner[cell], self.position[cell] = self.shared[cell].pop(0)
+            if len(self.shared[cell]) == 0:
+                del self.shared[cell]
+                self.is_shared[cell] = False
+        for cell in cells[(self.owner[cells] != order) & self.is_shared[cells]].tolist():
+            owners = [x for x in self.shared[cell] if not (x[0] == order and x[1] >= start)]
+            if len(owners) > 0:
+                self.shared[cell] = owners
+            else:
+                del self.shared[cell]
+                self.is_shared[cell] = False
+        if start == 0:
+            del self.order[self.keys.pop(key)]
+
+    def find(self, cell: int) -> tuple[int, int]:
+        """Finds the path that owns a cell.
+
+        Args:
+            cell (int): Flat raster index of the cell
+
+        Returns:
+            tuple[int, int]: ID of the path and position of the cell along it, or None if no path owns the cell.
+        """
+        order = self.owner[cell]
+        if order < 0:
+            return None
+        return self.order[int(order)], int(self.position[cell])
+
 
 class Flood_path:
     
-    def __init__(self, workspace: str, raster: str, point_fc: str) -> None:
+    def __init__(self, workspace: str, raster: str, point_fc: str, memory_budget: int = None, tile_size: int = 512) -> None:
         """Create a flood-path object for identification of critical points.
 
         Args:
             workspace (str): Path to gdb
             raster (str): Name or path to raster with D8 and vector layers
             point_fc (str): Name of fc in gdb with cross-sectional points
+            memory_budget (int, optional): Bytes for raster tiles. Reads tiles on demand instead of the whole raster, and traces paths
+                tile by tile, for rasters larger than memory. Defaults to None = read all.
+            tile_size (int, optional): Width and height of tiles in cells when memory_budget is set. Defaults to 512.
         """
-        arcpy.env.overwriteOutput = True
-        arcpy.env.workspace = workspace
+        if arcpy != None:
+            arcpy.env.overwriteOutput = True
+            arcpy.env.workspace = workspace
+        self.raster = raster
+        self.memory_budget = memory_budget
         self.f = rasterio.open(raster)
-        self.f_arr = self.f.read()
+        self.transform = self.f.transform
+        if memory_budget != None:
+            self.f_arr = Tiled_raster(self.f, tile_size, memory_budget)
+        else:
+            self.f_arr = self.f.read()
+        self.init_state(point_fc)
+
+    @classmethod
+    def from_array(cls, f_arr: np.ndarray, transform: any, point_fc: str = None) -> Flood_path:
+        """Create a flood-path object from a raster that is already read, like one loaded by geometry_cache.
+        Doesn't open files or need arcpy, but self.import_data() needs point_fc, and arcpy for a feature class.
+
+        Args:
+            f_arr (np.ndarray): Array with D8 codes in band 0 and classes in band 1
+            transform (any): Affine transform of the raster
+            point_fc (str, optional): Name of fc in gdb with cross-sectional points. Defaults to None.
+
+        Returns:
+            Flood_path: Flood-path object for the raster
+        """
+        flood_path = cls.__new__(cls)
+        flood_path.raster = None
+        flood_path.memory_budget = None
+        flood_path.f = AffineTransformer(transform)
+        flood_path.transform = transform
+        flood_path.f_arr = f_arr
+        flood_path.init_state(point_fc)
+        return flood_path
+
+    def init_state(self, point_fc: str) -> None:
+        """Sets the attributes that don't depend on where the raster comes from.
+
+        Args:
+            point_fc (str): Name of fc in gdb with cross-sectional points, or None
+        """
         self.point_fc = point_fc
-        self.spatial_ref = arcpy.Describe(self.point_fc).spatialReference
+        # a dataset has the crs of the raster, a transformer from from_array() has none
+        self.crs = getattr(self.f, 'crs', None)
+        self.spatial_ref = arcpy.Describe(self.point_fc).spatialReference if arcpy != None and point_fc != None else None
         self.num_crit = 0
+        self.downstream = None
+        self.memory = None
+        self.memory_finalizer = None
+        self.workers = 1
+        self.trace_time = 0
+        self.resolve_time = 0
+        self.traces = None
+        self.retraced = 0
+        # raster statistics of the paths of each scenario, from self.path_accuracy()
+        self.scenario_accuracy = {}
+        self.building_labels = {}
+        # paths of each scenario from the last self.resolve(), as one array of cells with offsets
+        self.resolved = {}
+        # stage timings and counters, shared with River by default
+        self.recorder = instrumentation.recorder
 
-    def __flow_dir(self, index: tuple[int, int], raster: any) -> tuple[tuple[int, int], int]:
-        """Private method called by self.analyze() that finds next index in raster based on flow direction.
-
-        Args:
-            index (tuple[int, int]): x- and y-index reference in raster matrix.
-            raster (any): Numpy array with three dimensions
-
-        Returns:
-            tuple[tuple[int, int], int]: The next index for processing, as well as the target value.
-        """
-        direction = raster[0, index[0], index[1]]
-        col = 0
-        row = 0
-        if direction == 1:
-            row = 0
-            col = 1
-        elif direction == 2:
-            row = 1
-            col = 1
-        elif direction == 4:
-            row = 1
-            col = 0
-        elif direction == 8:
-            row = 1
-            col = -1
-        elif direction == 16:
-            row = 0
-            col = -1
-        elif direction == 32:
-            row = -1
-            col = -1
-        elif direction == 64:
-            row = -1
-            col = 0
-        elif direction == 128:
-            row = -1
-            col = 1
-        elif direction < 1 or direction > 128:
-            return (index[0]+row, index[1]+col), 4
-        new_row = index[0]+row
-        new_col = index[1]+col
-        return (new_row, new_col), raster[1, new_row, new_col]
-
-
-
-    def import_data(self, crit_points=None) -> dict[int: tuple[int, int]]:
-        """Imports data and converts latlong points to array index
+    def build_downstream_index(self) -> None:
+        """Optional precomputation of where every cell in self.f_arr drains to, stored in self.downstream.
+        This reads the whole raster, also when tiles are read on demand. When present, self.analyze() only traces candidate points that are critical in the
+        first_point and duplicate_paths modes, since the other points can't make a path.
+        """
+        print("Building downstream index")
+        self.downstream = downstream_index(self.f_arr)
+
+    def is_critical(self, rows: any, cols: any) -> np.ndarray:
+        """Looks up whether the flow path from cells passes a road or building. Needs self.build_downstream_index().
+
+        Args:
+            rows (any): Row index of cells
+            cols (any): Column index of cells
+
+        Returns:
+            np.ndarray: True where the flow path is critical
+        """
+        return self.downstream['first_crit'][rows, cols] >= 0
+
+    def share_raster(self) -> None:
+        """Moves self.f_arr to shared memory, so worker processes can read it without a copy each.
+        Done once, and self.f_arr is a view of the shared memory after. The memory is released with self.close(),
+        at the end of a with block, or with the object if neither is done.
+        """
+        if self.memory != None or isinstance(self.f_arr, Tiled_raster):
+            return
+        self.memory = shared_memory.SharedMemory(create=True, size=self.f_arr.nbytes)
+        self.memory_finalizer = weakref.finalize(self, release_memory, self.memory)
+        shared = np.ndarray(self.f_arr.shape, dtype=self.f_arr.dtype, buffer=self.memory.buf)
+        shared[:] = self.f_arr
+        self.f_arr = shared
+
+    def close(self) -> None:
+        """Closes and unlinks the shared memory from self.share_raster(). self.f_arr is a view of it, so the raster
+        can't be read after, and this is done when the analysis is finished, after the export and statistics.
+        """
+        if self.memory == None:
+            return
+        # the view has to go before the memory can be closed
+        self.f_arr = None
+        self.memory_finalizer()
+        self.memory = None
+
+    def __enter__(self) -> Flood_path:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def worker_args(self, workers: int) -> tuple:
+        """Arguments of init_trace_worker(), which give worker processes the raster in shared memory, or their own tiles
+        with a part of the memory budget when the raster is read in tiles.
+
+        Args:
+            workers (int): Number of worker processes
+
+        Returns:
+            tuple: Arguments of init_trace_worker()
+        """
+        if isinstance(self.f_arr, Tiled_raster):
+            return (None, None, None, self.raster, self.f_arr.tile_size, self.memory_budget // workers)
+        self.share_raster()
+        return (self.memory.name, self.f_arr.shape, self.f_arr.dtype.str, None, None, None)
+
+    def trace_pool(self, workers: int) -> ProcessPoolExecutor:
+        """Starts worker processes with the raster set up by init_trace_worker(), for self.trace().
+        The caller shuts the pool down, which a with block does.
+
+        Args:
+            workers (int): Number of worker processes
+
+        Returns:
+            ProcessPoolExecutor: The pool
+        """
+        return ProcessPoolExecutor(max_workers=workers, initializer=init_trace_worker, initargs=self.worker_args(workers))
+
+    def trace(self, starts: np.ndarray, workers: int = 1, chunk_size: int = None, pool: ProcessPoolExecutor = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Traces flow paths with trace_paths(), split in chunks over a pool of worker processes when workers > 1.
+        Every path is traced on its own, and chunks are put back in order, so the result is the same for any number of workers.
+        Workers read the raster from shared memory, or read their own tiles with a part of the memory budget.
+        When the raster is read in tiles, paths are traced tile by tile with trace_tiles(), and the tiles read are counted against their bound.
+
+        Args:
+            starts (np.ndarray): Row and column of every start cell, with shape (cells, 2)
+            workers (int, optional): Number of worker processes. Defaults to 1 = trace here.
+            chunk_size (int, optional): Start cells per chunk. Defaults to None, which gives about four chunks per worker.
+            pool (ProcessPoolExecutor, optional): Pool from self.trace_pool() to use, for many calls in a row. Defaults to None = start a pool for this call.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Output from trace_paths()
+        """
+        start_time = time.perf_counter()
+        if workers <= 1 or len(starts) < 2:
+            stats = {}
+            if isinstance(self.f_arr, Tiled_raster):
+                result = trace_tiles(self.f_arr, starts[:, 0], starts[:, 1], stats=stats)
+            else:
+                result = trace_paths(self.f_arr, starts[:, 0], starts[:, 1])
+            all_stats = [stats]
+        else:
+            if chunk_size == None:
+                chunk_size = max(1, -(-len(starts) // (workers * 4)))
+            chunks = [starts[i:i+chunk_size] for i in range(0, len(starts), chunk_size)]
+            if pool != None:
+                results, all_stats = zip(*pool.map(trace_chunk, chunks))
+            else:
+                with self.trace_pool(workers) as pool:
+                    results, all_stats = zip(*pool.map(trace_chunk, chunks))
+            lengths = np.concatenate([np.diff(x[3]) for x in results])
+            offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            result = tuple(np.concatenate([x[i] for x in results]) for i in range(3)) + (offsets,)
+        self.trace_time = time.perf_counter() - start_time
+        self.recorder.count('paths_traced', len(starts))
+        self.recorder.count('cells_traversed', len(result[0]))
+        for stats in all_stats:
+            for name, value in stats.items():
+                self.recorder.count(name, value)
+        if any(len(x) > 0 for x in all_stats):
+            loads, bound = (sum(x[name] for x in all_stats) for name in ('tile_loads', 'tile_load_bound'))
+            print(f"Tiles read while tracing: {loads} of at most {bound}")
+        return result
+
+    def import_data(self, crit_points=None, as_arrays: bool = False) -> dict[int: tuple[int, int]]:
+        """Imports data and converts latlong points to array index.
+        All points of self.point_fc are read at once with point_import.read_points(), so it can also be a GeoPackage or
+        Parquet file, and the candidates are selected by ID with np.isin.
 
         Args:
            crit_points (dict[int: int], optional): A dict of points the be used, with critical percentage as value. Defaults to None = all points.
+           as_arrays (bool, optional): Return arrays instead of a dict, which self.analyze_scenarios() takes the same way. Defaults to False.
         
         Returns:
-            dict[int: tuple[int, int]]: Key is ID of point, value is x an y.
+            dict[int: tuple[int, int]]: Key is ID of point, value is row and column, in ID order. With as_arrays, the IDs,
+            and the row and column with shape (points, 2).
         """
         self.crit_points = crit_points
-        output_points = {}
-        if crit_points != None:
-            with arcpy.da.SearchCursor(self.point_fc, ['Shape@XY', 'OBJECTID'], f"OBJECTID IN {tuple(crit_points)}") as cursor:
-                for row in cursor:
-                    output_points[row[1]] = row[0]
-            output_points = {x: self.f.index(output_points[x][0], output_points[x][1]) for x in output_points}
-        else:
-            with arcpy.da.SearchCursor(self.point_fc, ['Shape@XY', 'OBJECTID']) as cursor:
-                for row in cursor:
-                    output_points[row[1]] = row[0]
-            output_points = {x: self.f.index(output_points[x][0], output_points[x][1]) for x in output_points}
-        return output_points
+        with self.recorder.stage('import_data'):
+            ids, xy = point_import.read_points(self.point_fc)
+            self.recorder.count('cursor_rows', len(ids))
+            if crit_points != None:
+                keep = np.isin(ids, np.fromiter(crit_points, dtype=np.int64, count=len(crit_points)))
+                ids, xy = ids[keep], xy[keep]
+            ids, starts = self.cell_index(ids, xy)
+        if as_arrays:
+            return ids, starts
+        return dict(zip(ids.tolist(), (tuple(x) for x in starts.tolist())))
 
+    def cell_index(self, ids: np.ndarray, xy: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Converts the coordinates of points to raster cells with one inverse transform, and leaves out points
+        without coordinates or outside the raster, which can't be traced.
 
-    def analyze(self, points: dict[int: tuple[int, int]], duplicate_paths: bool = False, first_point: bool = False) -> dict[int: arcpy.Array, int]:
+        Args:
+            ids (np.ndarray): ID of every point
+            xy (np.ndarray): Coordinates with shape (points, 2)
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: IDs of the points in the raster, and their row and column with shape (points, 2)
+        """
+        valid = np.isfinite(xy).all(axis=1)
+        ids, xy = ids[valid], xy[valid]
+        if len(ids) == 0:
+            return ids, np.zeros((0, 2), dtype=np.int64)
+        rows, cols = (np.asarray(x, dtype=np.int64) for x in rasterio.transform.rowcol(self.transform, xy[:, 0], xy[:, 1]))
+        inside = (rows >= 0) & (rows < self.f_arr.shape[1]) & (cols >= 0) & (cols < self.f_arr.shape[2])
+        if not inside.all() or not valid.all():
+            print(f"{(~valid).sum() + (~inside).sum()} points are outside the flow raster and are left out")
+        return ids[inside], np.column_stack((rows[inside], cols[inside]))
+
+
+    def analyze(self, points: dict[int: tuple[int, int]], duplicate_paths: bool = False, first_point: bool = False, workers: int = 1) -> dict[int: arcpy.Array, int]:
         """Evaluates candidate critical points by their downstream flow path.
         
         Args:
             points (dict[int: tuple[int, int]]): Output from import method
             duplaicate_points (bool, optional): Whether or not to break when a path is already marked as critical. Defaults to false.
             first_point (bool, optional): First point that flows into a critical path is used, not most critical.
+            workers (int, optional): Worker processes for tracing. Paths are always merged here, in the order of points. Defaults to 1.
 
         Returns:
             dict[int: (arcpy.Array, int)]: Key: objectID of critical point on riverbank. Value: tuple with arcpy array with flow path points and id of point on centerline.
         """
-        def get_duplicate_key(paths, point):
-            for key, value in paths.items():
-                if point in value[0]:
-                    return key
-                # otherwise return None
-
-        length = len(points)
-        paths = {}
-        for i, p in enumerate(points):
-            if i < length:
-                print(f"Analyzing point {i} of {length}", end="\r")
-            else:
-                print(f"Analyzing point {i} of {length}")
-            point = points[p]
-            path = [point]
-            crit_points = []
-            target = self.f_arr[1, point[0], point[1]]
-            critical = target in (1, 2)
-            while True:
-                if target == 1 or target == 2:
-                    critical = True
-                    try:
-                        crit_points.append(point)
-                    except:
-                        crit_points.append(points[p])
-                if not (first_point or duplicate_paths):
-                    idx = get_duplicate_key(paths, path[-1])
-                    if idx:
-                        if paths[idx][1] > self.crit_points[p]:
-                            first_crit_idx = paths[idx][0].index(paths[idx][2][0])
-                            last_crit_idx = paths[idx][0].index(paths[idx][2][-1])
-                            current_idx = paths[idx][0].index(path[-1])
-                            if current_idx < last_crit_idx:
-                                paths[p] = [path + paths[idx][0][current_idx:], self.crit_points[p], crit_points + [x for x in paths[idx][0][current_idx:] if x in paths[idx][2]]]
-                                # crit_keys_reversed.insert(0, p)
-                            elif critical:
-                                paths[p] = [path, self.crit_points[p], crit_points]
-                                # crit_keys_reversed.insert(0, p)
-                                break
-                            else:
-                                break
-                            if first_crit_idx <= current_idx:
-                                paths[idx][0] = paths[idx][0][:current_idx+1]
-                                paths[idx][2] = [x for x in paths[idx][2] if x in paths[idx][0]]
-                            else:    
-                                del paths[idx]
-                                # crit_keys_reversed.remove(idx)
-                        elif critical:
-                            paths[p] = [path, self.crit_points[p], crit_points]
-                            # crit_keys_reversed.insert(0, p)
-                        break
-                elif not duplicate_paths:
-                    if any(point in paths[x][0] for x in paths):
-                        if critical:
-                            paths[p] = [path, self.crit_points[p], crit_points]
-                            # crit_keys_reversed.insert(0, p)
-                        break
-                if target == 4:
-                    if critical:
-                        paths[p] = [path, self.crit_points[p], crit_points]
-                        # crit_keys_reversed.insert(0, p)
-                    break
-                if target == 3:
+        return self.analyze_scenarios(points, {None: self.crit_points}, duplicate_paths, first_point, workers)[None]
+
+    def analyze_scenarios(self, points: dict[int: tuple[int, int]], scenarios: dict[int: dict[int: int]], duplicate_paths: bool = False, first_point: bool = False, workers: int = 1, as_arcpy: bool = True) -> dict[int: dict[int: arcpy.Array, int]]:
+        """Evaluates candidate critical points for several discharge scenarios like self.analyze(), but traces
+        every point once and merges the shared traces for each scenario. Import the points of all scenarios
+        with self.import_data() first. The critical points and number of paths of each scenario are kept in
+        self.scenario_points and self.scenario_num, and self.crit_points and self.crit_num are from the last scenario.
+        The traces are kept in self.traces, and can be saved with self.save_traces() for self.update().
+
+        Args:
+            points (dict[int: tuple[int, int]]): Output from import method, the dict or the arrays with as_arrays
+            scenarios (dict[int: dict[int: int]]): Scenario as key and critical percentage of its candidate points as value, like River.find_critical_points() with several q
+            duplicate_paths (bool, optional): Whether or not to break when a path is already marked as critical. Defaults to false.
+            first_point (bool, optional): First point that flows into a critical path is used, not most critical.
+            workers (int, optional): Worker processes for tracing. Defaults to 1.
+            as_arcpy (bool, optional): Return paths as arcpy arrays. False returns arrays of x and y with shape (cells, 2), which doesn't need arcpy. Defaults to True.
+
+        Returns:
+            dict[int: dict[int: (arcpy.Array, int)]]: Scenario as key and output like self.analyze() as value
+        """
+        with self.recorder.stage('analyze'):
+            with self.recorder.stage('trace_paths'):
+                self.trace_points(points, scenarios, duplicate_paths, first_point, workers)
+            with self.recorder.stage('resolve_paths'):
+                return self.resolve(as_arcpy)
+
+    def trace_points(self, points: dict[int: tuple[int, int]], scenarios: dict[int: dict[int: int]], duplicate_paths: bool = False, first_point: bool = False, workers: int = 1) -> None:
+        """Traces the candidate points of all scenarios once, and keeps the traces in self.traces for self.resolve().
+        self.traces has the point IDs, start cells, which points are traced, and the flat cell index and class of
+        every path cell, with path i at [offsets[i]:offsets[i+1]] and no cells for points that are not traced.
+
+        Args:
+            points (dict[int: tuple[int, int]]): Output from import method, the dict or the arrays with as_arrays
+            scenarios (dict[int: dict[int: int]]): Scenario as key and critical percentage of its candidate points as value
+            duplicate_paths (bool, optional): Mode of self.analyze(). Defaults to false.
+            first_point (bool, optional): Mode of self.analyze(). Defaults to false.
+            workers (int, optional): Worker processes for tracing. Defaults to 1.
+        """
+        if isinstance(points, tuple):
+            keys, starts = np.asarray(points[0], dtype=np.int64), np.asarray(points[1], dtype=np.int64).reshape(-1, 2)
+        else:
+            keys = np.array(list(points), dtype=np.int64)
+            starts = np.array([points[p] for p in points], dtype=np.int64).reshape(-1, 2)
+        # Points that are not critical can only change the result by merging into other paths
+        wanted = np.zeros(len(keys), dtype=bool)
+        for crit in scenarios.values():
+            wanted |= True if crit == None else np.isin(keys, np.fromiter(crit, dtype=np.int64, count=len(crit)))
+        traced = wanted & self.may_be_critical(starts, duplicate_paths or first_point)
+        print(f"Tracing {traced.sum()} flow paths")
+        self.workers = workers
+        self.store_traces(keys, starts, wanted, traced, self.trace(starts[traced], workers), scenarios, duplicate_paths, first_point)
+
+    def store_traces(self, keys: np.ndarray, starts: np.ndarray, wanted: np.ndarray, traced: np.ndarray, trace: tuple, scenarios: dict[int: dict[int: int]],
+                     duplicate_paths: bool = False, first_point: bool = False) -> None:
+        """Keeps traces in self.traces for self.resolve(), with no cells for the points that are not traced.
+
+        Args:
+            keys (np.ndarray): ID of every point, in the order they are resolved
+            starts (np.ndarray): Row and column of every start cell, with shape (points, 2)
+            wanted (np.ndarray): True for points that are a candidate in a scenario
+            traced (np.ndarray): True for points that are traced
+            trace (tuple): Output from self.trace() for the traced points, in order
+            scenarios (dict[int: dict[int: int]]): Scenario as key and critical percentage of its candidate points as value
+            duplicate_paths (bool, optional): Mode of self.analyze(). Defaults to false.
+            first_point (bool, optional): Mode of self.analyze(). Defaults to false.
+        """
+        rows, cols, targets, trace_offsets = trace
+        lengths = np.zeros(len(keys), dtype=np.int64)
+        lengths[traced] = np.diff(trace_offsets)
+        offsets = np.zeros(len(keys)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        self.traces = {'keys': keys, 'starts': starts, 'wanted': wanted, 'traced': traced,
+                       'cells': rows * self.f_arr.shape[2] + cols, 'targets': targets, 'offsets': offsets,
+                       'scenarios': scenarios, 'duplicate_paths': duplicate_paths, 'first_point': first_point}
+
+    def may_be_critical(self, starts: np.ndarray, modes: bool) -> np.ndarray:
+        """Finds the start cells that need a trace. Only paths that are critical are needed in the
+        first_point and duplicate_paths modes, which self.downstream tells without tracing.
+
+        Args:
+            starts (np.ndarray): Row and column of every start cell, with shape (cells, 2)
+            modes (bool): True in the first_point or duplicate_paths mode
+
+        Returns:
+            np.ndarray: True for start cells that are traced
+        """
+        if self.downstream != None and modes and len(starts) > 0:
+            return self.is_critical(starts[:, 0], starts[:, 1])
+        return np.ones(len(starts), dtype=bool)
+
+    def resolve(self, as_arcpy: bool = True) -> dict[int: dict[int: arcpy.Array, int]]:
+        """Merges the traces in self.traces to the flow paths of each scenario, in the order of the points.
+
+        Args:
+            as_arcpy (bool, optional): Return paths as arcpy arrays, see self.analyze_scenarios(). Defaults to True.
+
+        Returns:
+            dict[int: dict[int: (arcpy.Array, int)]]: Scenario as key and output like self.analyze() as value
+        """
+        def store(key, pieces):
+            paths[key] = [pieces, self.crit_points[key]]
+            if index != None:
+                index.add(key, piece_cells(trace_cells, pieces))
+
+        resolve_st = time.perf_counter()
+        keys = self.traces['keys'].tolist()
+        traced, offsets = self.traces['traced'], self.traces['offsets']
+        trace_cells = self.traces['cells']
+        trace_crit = (self.traces['targets'] == 1) | (self.traces['targets'] == 2)
+        duplicate_paths, first_point = self.traces['duplicate_paths'], self.traces['first_point']
+        tiled = isinstance(self.f_arr, Tiled_raster)
+
+        results = {}
+        self.scenario_points = {}
+        self.scenario_num = {}
+        for q, crit_points in self.traces['scenarios'].items():
+            if q != None:
+                print(f"Resolving scenario {q}")
+            self.crit_points = crit_points
+            selected = [(i, p) for i, p in enumerate(keys) if crit_points == None or p in crit_points]
+            length = len(selected)
+            index = None if duplicate_paths else Path_index(self.f_arr.shape[1:], sparse=tiled)
+            paths = {}
+            merged, truncated, removed = 0, 0, 0
+            for j, (i, p) in enumerate(selected):
+                self.recorder.progress("Analyzing point", j+1, length)
+                if not traced[i]:
+                    continue
+                start, stop = int(offsets[i]), int(offsets[i+1])
+                if duplicate_paths:
+                    if trace_crit[start:stop].any():
+                        store(p, [(start, stop, False)])
+                    continue
+                # Paths are only stored once a point is done, so the first cell already in a stored path ends this one
+                cells = trace_cells[start:stop]
+                hits = index.owner[cells] >= 0
+                end = int(hits.argmax()) if hits.any() else len(cells) - 1
+                path = [(start, start + end + 1, False)]
+                critical = trace_crit[start:start+end+1].any()
+                if first_point or not hits[end]:
                     if critical:
-                        paths[p] = [path, self.crit_points[p], crit_points]
-                        # crit_keys_reversed.insert(0, p)
-                    break
-                point, target = self.__flow_dir(path[-1], self.f_arr)
-                path.append(point)
-
-        self.crit_num = len(paths)
-        paths = {x: [[self.f.xy(y[0], y[1]) for y in paths[x][0]], paths[x][1]] for x in paths}
-        paths_points = {x: [[arcpy.Point(y[0], y[1]) for y in paths[x][0]], paths[x][1]] for x in paths}
-        paths_array = {x: [arcpy.Array(paths_points[x][0]), paths_points[x][1]] for x in paths_points}
+                        store(p, path)
+                    continue
+                idx, current_idx = index.find(cells[end])
+                if paths[idx][1] > self.crit_points[p]:
+                    crit_pos = piece_critical(trace_crit, paths[idx][0])
+                    first_crit_idx = crit_pos[0]
+                    last_crit_idx = crit_pos[-1]
+                    if current_idx < last_crit_idx:
+                        # the other path goes on from the cell this one ends on, which is only critical once
+                        tail = cut_pieces(paths[idx][0], current_idx)
+                        tail[0] = (tail[0][0], tail[0][1], True)
+                        store(p, path + tail)
+                        merged += 1
+                    elif critical:
+                        store(p, path)
+                        continue
+                    else:
+                        continue
+                    if first_crit_idx <= current_idx:
+                        index.remove(idx, piece_cells(trace_cells, cut_pieces(paths[idx][0], current_idx+1)), current_idx+1)
+                        paths[idx][0] = cut_pieces(paths[idx][0], 0, current_idx+1)
+                        truncated += 1
+                    else:
+                        index.remove(idx, piece_cells(trace_cells, paths[idx][0]), 0)
+                        del paths[idx]
+                        removed += 1
+                elif critical:
+                    store(p, path)
+
+            self.recorder.count('paths_merged', merged)
+            self.recorder.count('paths_truncated', truncated)
+            self.recorder.count('paths_removed', removed)
+            self.recorder.count('paths_resolved', len(paths))
+            self.crit_num = len(paths)
+            self.scenario_points[q] = crit_points
+            self.scenario_num[q] = len(paths)
+            resolved = self.resolved_paths(paths, trace_cells, trace_crit)
+            self.resolved[q] = resolved
+            with self.recorder.stage('raster_accuracy'):
+                self.scenario_accuracy[q] = self.path_accuracy(resolved)
+            with self.recorder.stage('path_coordinates'):
+                resolved['coords'] = self.path_coordinates(resolved['cells'])
+            # the paths are views of the coordinates of the scenario
+            lines = np.split(resolved['coords'], resolved['offsets'][1:-1])
+            if not as_arcpy:
+                results[q] = {x: [xy, paths[x][1]] for x, xy in zip(paths, lines)}
+                continue
+            results[q] = {x: [arcpy.Array([arcpy.Point(*y) for y in xy.tolist()]), paths[x][1]] for x, xy in zip(paths, lines)}
+
+        self.resolve_time = time.perf_counter() - resolve_st
+        if tiled:
+            print("Tile cache: {tile_hits} hits, {tile_misses} misses, {tiles_cached} tiles in memory".format(**self.f_arr.cache_stats()))
         
         # for point in paths_array:
         #     with arcpy.da.SearchCursor(self.point_fc, ['orig_id', 'RASTERVALU'], f'OBJECTID = {point}') as cursor:
         #         for row in cursor:
         #             paths_array[point] = (paths_array[point], (row[0], row[1]))
-        return paths_array
+        return results
+
+    def resolved_paths(self, paths: dict[int: list], trace_cells: np.ndarray, trace_crit: np.ndarray) -> dict[str: np.ndarray]:
+        """Copies the pieces of the resolved paths of a scenario out of the trace buffer, once, to one array of cells with offsets.
+
+        Args:
+            paths (dict[int: list]): Point ID as key, and pieces of the trace buffer and critical percentage as value
+            trace_cells (np.ndarray): Flat cell index of the trace buffer
+            trace_crit (np.ndarray): True for road and building cells in the trace buffer
+
+        Returns:
+            dict[str: np.ndarray]: 'keys' point IDs, 'values' critical percentages, 'cells' flat cell index of all paths,
+            'offsets' so path i is cells[offsets[i]:offsets[i+1]], and 'critical' True for road and building cells
+        """
+        pieces = [x for key in paths for x in paths[key][0]]
+        starts = np.array([x[0] for x in pieces], dtype=np.int64)
+        lengths = np.array([x[1] - x[0] for x in pieces], dtype=np.int64)
+        take = gather_ranges(starts, lengths)
+        critical = trace_crit[take]
+        piece_offsets = np.cumsum(lengths) - lengths
+        critical[piece_offsets[np.array([x[2] for x in pieces], dtype=bool)]] = False
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([sum(x[1] - x[0] for x in paths[key][0]) for key in paths], out=offsets[1:])
+        return {'keys': np.array(list(paths), dtype=np.int64), 'values': np.array([paths[x][1] for x in paths]),
+                'cells': trace_cells[take], 'offsets': offsets, 'critical': critical}
+
+    def path_coordinates(self, cells: np.ndarray) -> np.ndarray:
+        """Converts cells to the coordinates of the cell centers with one transform.
+
+        Args:
+            cells (np.ndarray): Flat cell index
+
+        Returns:
+            np.ndarray: x and y with shape (cells, 2)
+        """
+        if len(cells) == 0:
+            return np.zeros((0, 2))
+        rows, cols = np.divmod(cells, self.f_arr.shape[2])
+        return np.column_stack([np.asarray(x, dtype=np.float64) for x in self.f.xy(rows, cols)])
+
+    def building_component(self, cell: int) -> np.ndarray:
+        """Finds the building cells (class 2) connected to a building cell in any of the eight directions.
+
+        Args:
+            cell (int): Flat index of a building cell
+
+        Returns:
+            np.ndarray: Sorted flat index of the cells of the building
+        """
+        n_rows, n_cols = self.f_arr.shape[1:]
+        offsets = D8_OFFSETS[list(D8_CODES)]
+        region = np.array([cell], dtype=np.int64)
+        frontier = region
+        while len(frontier) > 0:
+            rows, cols = np.divmod(frontier, n_cols)
+            rows = (rows[:, None] + offsets[:, 0]).ravel()
+            cols = (cols[:, None] + offsets[:, 1]).ravel()
+            inside = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+            frontier = np.unique(rows[inside] * n_cols + cols[inside])
+            frontier = frontier[~np.isin(frontier, region)]
+            frontier = frontier[np.asarray(self.f_arr[1, frontier // n_cols, frontier % n_cols]) == 2]
+            region = np.union1d(region, frontier)
+        return region
+
+    def path_accuracy(self, resolved: dict[str: np.ndarray]) -> dict[str: float]:
+        """Statistics of the flow paths of a scenario from the class band of the raster, like Stats.calc_accuracy() and
+        Stats.calc_mean_crit() do with the exported feature class, but without geoprocessing.
+        A building is a group of connected building cells, which is the polygon expanded by a cell in raster_merge.py,
+        so buildings closer than two cells count as one. The road length is the length of the path steps inside road cells,
+        half a step for each end, and a step that is in several paths is only counted once, like Dissolve().
+
+        Args:
+            resolved (dict[str: np.ndarray]): Paths of a scenario from self.resolved_paths()
+
+        Returns:
+            dict[str: float]: 'build_inter' buildings the paths cross, 'road_inter' length of road in meters,
+            and 'mean_crit' the mean critical percentage of the paths, None without paths
+        """
+        if len(resolved['keys']) == 0:
+            return {'build_inter': 0, 'road_inter': 0.0, 'mean_crit': None}
+        n_cols = self.f_arr.shape[2]
+        cells = resolved['cells']
+        unique = np.unique(cells)
+        classes = np.asarray(self.f_arr[1, unique // n_cols, unique % n_cols])
+
+        buildings = set()
+        for cell in unique[classes == 2].tolist():
+            if cell not in self.building_labels:
+                # a building is labelled by its first cell
+                region = self.building_component(cell)
+                self.building_labels.update(dict.fromkeys(region.tolist(), int(region[0])))
+            buildings.add(self.building_labels[cell])
+
+        # steps from the last cell of a path to the first of the next aren't steps
+        step = np.ones(len(cells) - 1, dtype=bool)
+        step[resolved['offsets'][1:-1] - 1] = False
+        firsts, seconds = cells[:-1][step], cells[1:][step]
+        order = np.lexsort((seconds, firsts))
+        firsts, seconds = firsts[order], seconds[order]
+        # the same step in several paths, and the repeated last cell of a path, have no length of their own
+        keep = (firsts != seconds) & np.concatenate(([True], (np.diff(firsts) != 0) | (np.diff(seconds) != 0)))
+        firsts, seconds = firsts[keep], seconds[keep]
+        d_rows = seconds // n_cols - firsts // n_cols
+        d_cols = seconds % n_cols - firsts % n_cols
+        length = np.hypot(d_rows * self.transform.e, d_cols * self.transform.a)
+        on_road = (classes[np.searchsorted(unique, firsts)] == 1).astype(np.float64) + (classes[np.searchsorted(unique, seconds)] == 1)
+        return {'build_inter': len(buildings), 'road_inter': float((length * on_road).sum() / 2),
+                'mean_crit': float(np.mean(resolved['values']))}
+
+    def save_traces(self, path: str) -> None:
+        """Saves self.traces with an index from raster cell to the paths through it, for self.update() after the flow raster changes.
+
+        Args:
+            path (str): Path to .npz file
+        """
+        traces = self.traces
+        owners = np.repeat(np.arange(len(traces['keys']), dtype=np.int64), np.diff(traces['offsets']))
+        order = np.argsort(traces['cells'], kind='stable')
+        arrays = {x: traces[x] for x in ('keys', 'starts', 'wanted', 'traced', 'cells', 'targets', 'offsets')}
+        arrays['index_cells'] = traces['cells'][order]
+        arrays['index_points'] = owners[order]
+        arrays['shape'] = np.array(self.f_arr.shape, dtype=np.int64)
+        arrays['modes'] = np.array([traces['duplicate_paths'], traces['first_point']])
+        # scenarios are stored by position, since a scenario can be None
+        arrays['scenario_q'] = np.array([-1 if q == None else q for q in traces['scenarios']], dtype=np.int64)
+        arrays['scenario_none'] = np.array([q == None for q in traces['scenarios']], dtype=bool)
+        arrays['scenario_all'] = np.array([crit == None for crit in traces['scenarios'].values()], dtype=bool)
+        for i, crit in enumerate(traces['scenarios'].values()):
+            if crit != None:
+                arrays[f'crit_keys_{i}'] = np.array(list(crit), dtype=np.int64)
+                arrays[f'crit_values_{i}'] = np.array(list(crit.values()))
+        np.savez_compressed(path, **arrays)
+
+    def load_traces(self, path: str) -> dict:
+        """Loads traces saved by self.save_traces() to self.traces.
+
+        Args:
+            path (str): Path to .npz file
+
+        Returns:
+            dict: self.traces, with the cell index in 'index_cells' and 'index_points'
+        """
+        with np.load(path) as arrays:
+            traces = {x: arrays[x] for x in arrays.files if not x.startswith(('crit_', 'scenario_', 'modes'))}
+            traces['duplicate_paths'], traces['first_point'] = (bool(x) for x in arrays['modes'])
+            scenarios = {}
+            for i, (q, none, every) in enumerate(zip(arrays['scenario_q'].tolist(), arrays['scenario_none'], arrays['scenario_all'])):
+                crit = None if every else dict(zip(arrays[f'crit_keys_{i}'].tolist(), arrays[f'crit_values_{i}'].tolist()))
+                scenarios[None if none else q] = crit
+            traces['scenarios'] = scenarios
+        self.traces = traces
+        return traces
+
+    def update(self, trace_file: str, old_raster: any, workers: int = 1, as_arcpy: bool = True, output: str = None) -> dict[int: dict[int: arcpy.Array, int]]:
+        """Updates the result of an earlier run after the flow raster has changed, like when new buildings or roads are added.
+        The previous traces are loaded from trace_file, and only the paths that cross a changed cell are traced again.
+        A path that doesn't cross a changed cell is the same on the new raster, as it only depends on its own cells.
+        Points that were not traced because they were not critical are traced if they can be critical now, which uses
+        self.downstream if it is built for the new raster, or else traces all of them. The paths are then merged again
+        with self.resolve(), since merging depends on the order of all paths, and the updated traces are saved.
+
+        Args:
+            trace_file (str): Traces of the earlier run, saved by self.save_traces()
+            old_raster (any): The flow raster of the earlier run, path or array, see changed_cells(). self.f_arr is the new raster.
+            workers (int, optional): Worker processes for tracing. Defaults to 1.
+            as_arcpy (bool, optional): Return paths as arcpy arrays, see self.analyze_scenarios(). Defaults to True.
+            output (str, optional): Where the updated traces are saved. Defaults to None = trace_file.
+
+        Returns:
+            dict[int: dict[int: (arcpy.Array, int)]]: Scenario as key and output like self.analyze() as value
+        """
+        traces = self.load_traces(trace_file)
+        if tuple(traces['shape']) != tuple(self.f_arr.shape):
+            raise ValueError(f"The traces are from a raster with shape {tuple(traces['shape'])}, not {tuple(self.f_arr.shape)}")
+        with self.recorder.stage('diff_rasters'):
+            changed = changed_cells(old_raster, self.f_arr)
+        self.recorder.count('cells_changed', len(changed))
+        lo = np.searchsorted(traces['index_cells'], changed, 'left')
+        hi = np.searchsorted(traces['index_cells'], changed, 'right')
+        affected = np.zeros(len(traces['keys']), dtype=bool)
+        affected[traces['index_points'][gather_ranges(lo, hi - lo)]] = True
+
+        old_traced, offsets = traces['traced'], traces['offsets']
+        modes = traces['duplicate_paths'] or traces['first_point']
+        retrace = traces['wanted'] & (affected | ~old_traced) & self.may_be_critical(traces['starts'], modes)
+        traced = old_traced & ~affected | retrace
+        print(f"{len(changed)} cells changed, retracing {retrace.sum()} of {traced.sum()} flow paths")
+        self.workers = workers
+        with self.recorder.stage('trace_paths'):
+            rows, cols, targets, trace_offsets = self.trace(traces['starts'][retrace], workers)
+        self.retraced = int(retrace.sum())
+
+        # New paths are put after the old buffer, and every path is copied from where it is now
+        lengths = np.where(traced & ~retrace, np.diff(offsets), 0)
+        sources = offsets[:-1].copy()
+        lengths[retrace] = np.diff(trace_offsets)
+        sources[retrace] = trace_offsets[:-1] + len(traces['cells'])
+        new_offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+        take = gather_ranges(sources, lengths)
+        traces['cells'] = np.concatenate((traces['cells'], rows * self.f_arr.shape[2] + cols))[take]
+        traces['targets'] = np.concatenate((traces['targets'], targets.astype(traces['targets'].dtype)))[take]
+        traces['offsets'] = new_offsets
+        traces['traced'] = traced
+        with self.recorder.stage('resolve_paths'):
+            results = self.resolve(as_arcpy)
+        self.save_traces(trace_file if output == None else output)
+        return results
+
+    def export_scenario(self, q: int, output: str, simplify: bool = True) -> None:
+        """Exports the paths of a scenario of the last analysis to a GeoPackage, FlatGeobuf or GeoParquet file,
+        straight from the coordinates in self.resolved without copying them to a dict of paths first.
+
+        Args:
+            q (int): Scenario, None after self.analyze()
+            output (str): Path to a file ending in .gpkg, .fgb or .parquet
+            simplify (bool, optional): Only write the cells where a path changes direction. Defaults to True.
+        """
+        resolved = self.resolved[q]
+        with self.recorder.stage('export'):
+            vertices = path_export.write_lines(output, resolved['keys'], resolved['values'].astype(np.int64), resolved['coords'],
+                                               resolved['offsets'], self.crs, simplify)
+            self.recorder.count('rows_written', len(resolved['keys']))
+            self.recorder.count('vertices_written', vertices)
 
-    def export(self, input: dict[int: (arcpy.Array, int)], output: str) -> None:
-        """Exports critical points to feature class in gdb.
+    def export(self, input: dict[int: (arcpy.Array, int)], output: str, simplify: bool = True) -> None:
+        """Exports critical points to feature class in gdb, or to a GeoPackage, FlatGeobuf or GeoParquet file
+        when output ends in .gpkg, .fgb or .parquet, see path_export.py.
         The field 'point_id' referes to point where flow starts.
 
         Args:
-            input (dict[int: (arcpy.Array, int)]): Output from self.analyze()
-            output (str): Name of fc to be exported
+            input (dict[int: (arcpy.Array, int)]): Output from self.analyze(), with as_arcpy=False for the file formats
+            output (str): Name of fc to be exported, or path to a file
+            simplify (bool, optional): Only write the cells where a path changes direction to the files. Defaults to True.
         """
-        arcpy.management.CreateFeatureclass(arcpy.env.workspace, output, 'POLYLINE', '', '', '', self.spatial_ref)
-        arcpy.management.AddFields(output, [['point_id', 'LONG'], ['crit_percent', 'SHORT']])
-        with arcpy.da.InsertCursor(output, ['SHAPE@', 'point_id', 'crit_percent']) as in_cursor:
-            for line in input:
-                    in_cursor.insertRow([arcpy.Polyline(input[line][0]), line, input[line][1]])
+        with self.recorder.stage('export'):
+            if os.path.splitext(output)[1].lower() in path_export.WRITERS:
+                vertices = path_export.write_paths(input, output, self.crs, simplify)
+                self.recorder.count('rows_written', len(input))
+                self.recorder.count('vertices_written', vertices)
+                return
+            arcpy.management.CreateFeatureclass(arcpy.env.workspace, output, 'POLYLINE', '', '', '', self.spatial_ref)
+            arcpy.management.AddFields(output, [['point_id', 'LONG'], ['crit_percent', 'SHORT']])
+            with arcpy.da.InsertCursor(output, ['SHAPE@', 'point_id', 'crit_percent']) as in_cursor:
+                for line in input:
+                        points = input[line][0]
+                        if isinstance(points, np.ndarray):
+                            points = arcpy.Array([arcpy.Point(*x) for x in points.tolist()])
+                        in_cursor.insertRow([arcpy.Polyline(points), line, input[line][1]])
+            self.recorder.count('rows_written', len(input))
 
 
 if __name__ == '__main__':
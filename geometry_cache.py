@@ -0,0 +1,217 @@
+"""
+On-disk cache of a finished River analysis and the flow raster, for service.py and for reruns with the same inputs.
+A cache is a directory with:
+    meta.json       content hash of the inputs, settings and field names
+    river.npz       the arrays of River.data
+    flow.npy        the flow raster, memory mapped on load so only the cells that are read are loaded
+    downstream.npz  Flood_path.downstream, if it was built
+The cache is current when the hash of the inputs matches, see is_current(). The hash is made from the input datasets
+before a run writes anything, with inputs_hash(), so outputs written to the same gdb don't change it.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+try:
+    import arcpy
+except ImportError: # the service loads caches without ArcGIS
+    arcpy = None
+from river_geometry import River
+from river_table import River_table
+from critical_paths import Flood_path
+import parameter_sweep
+
+VERSION = 1
+
+
+def update_file(digest: any, path: str) -> None:
+    """Adds the content of a file, or of every file in a directory in sorted order, to a hash."""
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, x) for root, _, names in os.walk(path) for x in names)
+    else:
+        files = [path]
+    for name in files:
+        digest.update(os.path.relpath(name, path).encode() if name != path else os.path.basename(name).encode())
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+
+
+def update_dataset(digest: any, name: str, block_rows: int = 1024) -> None:
+    """Adds the content of a feature class or raster in a gdb to a hash, read with arcpy, since the files of a gdb
+    also change when other datasets in it are written. A feature class is hashed row by row in OBJECTID order, with its
+    geometry as WKB, and a raster block by block with its extent and cell size.
+
+    Args:
+        digest (any): hashlib hash
+        name (str): Name of the dataset in arcpy.env.workspace
+        block_rows (int, optional): Raster rows read at once. Defaults to 1024.
+    """
+    describe = arcpy.Describe(name)
+    digest.update(f'{name}:{describe.dataType}'.encode())
+    if describe.dataType in ('RasterDataset', 'RasterBand'):
+        raster = arcpy.Raster(name)
+        extent = raster.extent
+        digest.update(json.dumps([extent.XMin, extent.YMin, extent.XMax, extent.YMax, raster.meanCellWidth, raster.meanCellHeight]).encode())
+        for row in range(0, raster.height, block_rows):
+            rows = min(block_rows, raster.height - row)
+            lower_left = arcpy.Point(extent.XMin, extent.YMax - (row + rows) * raster.meanCellHeight)
+            digest.update(np.ascontiguousarray(arcpy.RasterToNumPyArray(raster, lower_left, raster.width, rows)).tobytes())
+        return
+    fields = [x.name for x in arcpy.ListFields(name) if x.type not in ('OID', 'Geometry', 'Blob', 'Raster')]
+    with arcpy.da.SearchCursor(name, ['SHAPE@WKB'] + fields, sql_clause=(None, f'ORDER BY {describe.OIDFieldName}')) as cursor:
+        for row in cursor:
+            digest.update(bytes(row[0]) if row[0] != None else b'')
+            digest.update(json.dumps(row[1:], default=str).encode())
+
+
+def inputs_hash(workspace: str, datasets: list[str], settings: dict) -> str:
+    """Hashes the input datasets and the settings of the analysis, before the analysis writes anything, so the hash
+    is the same for every run with the same inputs. A dataset that is a file or directory is hashed with update_file(),
+    and a dataset in the gdb with update_dataset().
+
+    Args:
+        workspace (str): Path to gdb
+        datasets (list[str]): Paths to files, or names of feature classes and rasters in the gdb
+        settings (dict): Settings that change the result, must be JSON serializable
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    for name in datasets:
+        if os.path.exists(name) and not os.path.samefile(name, workspace):
+            update_file(digest, name)
+        else:
+            arcpy.env.workspace = workspace
+            update_dataset(digest, name)
+    return digest.hexdigest()
+
+
+def river_settings(river: River) -> dict:
+    """Settings of a River that change the result of River.full_analysis().
+
+    Args:
+        river (River): River object
+
+    Returns:
+        dict: Settings as JSON serializable values
+    """
+    return {'river': river.river, 'river_feature': river.river_feature, 'dem': river.dem, 'distances': list(river.distance_tupl),
+            'point_distance': river.point_distance, 'transect_length': river.transect_length,
+            'scenarios': {str(q): raster for q, raster in river.scenarios.items()}}
+
+
+def is_current(cache_dir: str, key: str) -> bool:
+    """Checks that a cache exists and was made from inputs with the same hash.
+
+    Args:
+        cache_dir (str): Cache directory
+        key (str): Output from inputs_hash()
+
+    Returns:
+        bool: True if the cache can be used
+    """
+    path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        meta = json.load(f)
+    return meta.get('version') == VERSION and meta.get('key') == key
+
+
+def save(cache_dir: str, key: str, river: River, flood_path: Flood_path = None) -> None:
+    """Writes a River and optionally the flow raster of a Flood_path to a cache.
+
+    Args:
+        cache_dir (str): Cache directory, created if it doesn't exist
+        key (str): Output from inputs_hash()
+        river (River): River after River.full_analysis()
+        flood_path (Flood_path, optional): Flood_path with the flow raster. Defaults to None.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    table = river.data
+    arrays = {'ids': table.ids, 'river_side': table.river_side, 'slope': table.slope}
+    if table.bank_oid is not None:
+        arrays['bank_oid'] = table.bank_oid
+    if table.bank_xy is not None:
+        arrays['bank_xy'] = table.bank_xy
+    columns = list(table.columns)
+    for i, name in enumerate(columns):
+        arrays[f'column_{i}'] = table.columns[name]
+    # only objects that are coordinates can be stored as arrays
+    objects = [x for x in table.objects if all(isinstance(y, tuple) and len(y) == 2 for y in table.objects[x])]
+    for i, name in enumerate(objects):
+        arrays[f'object_{i}'] = np.array(table.objects[name], dtype=np.float64).reshape(-1, 2)
+    np.savez_compressed(os.path.join(cache_dir, 'river.npz'), **arrays)
+
+    crs = parameter_sweep.river_crs(river)
+    meta = {'version': VERSION, 'key': key, 'workspace': river.workspace, 'settings': river_settings(river),
+            'columns': columns, 'objects': objects, 'fields': list(table.fields), 'integer': sorted(table.integer),
+            'river_crs': None if crs == None else crs.to_wkt()}
+    if flood_path != None:
+        f_arr = flood_path.f_arr
+        if not isinstance(f_arr, np.ndarray):
+            # a tiled raster is read in full once, so the service can memory map it
+            f_arr = np.stack([f_arr[band] for band in range(f_arr.shape[0])])
+        np.save(os.path.join(cache_dir, 'flow.npy'), f_arr)
+        meta['transform'] = list(flood_path.transform)[:6]
+        meta['crs'] = None if flood_path.crs == None else flood_path.crs.to_wkt()
+        meta['point_fc'] = flood_path.point_fc
+        if flood_path.downstream != None:
+            np.savez_compressed(os.path.join(cache_dir, 'downstream.npz'), **flood_path.downstream)
+    # meta.json is written last, so a cache that was cut short is never current
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def load(cache_dir: str) -> tuple[River, Flood_path]:
+    """Reads a River and the Flood_path of its flow raster from a cache.
+
+    Args:
+        cache_dir (str): Cache directory written by save()
+
+    Returns:
+        tuple[River, Flood_path]: River with self.data from the cache, and a Flood_path from Flood_path.from_array(), or None if no flow raster was saved
+    """
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    settings = meta['settings']
+    river = River(meta['workspace'], settings['river'], settings['river_feature'], settings['dem'])
+    river.distance_tupl = tuple(settings['distances'])
+    river.point_distance = settings['point_distance']
+    river.transect_length = settings['transect_length']
+    river.scenarios = {int(q): raster for q, raster in settings['scenarios'].items()}
+    # the crs of the bank coordinates, see parameter_sweep.river_crs()
+    river.crs = CRS.from_wkt(meta['river_crs']) if meta.get('river_crs') != None else None
+
+    with np.load(os.path.join(cache_dir, 'river.npz')) as arrays:
+        table = River_table(arrays['ids'], river.distance_tupl)
+        table.river_side = arrays['river_side']
+        table.slope = arrays['slope']
+        if 'bank_oid' in arrays:
+            table.bank_oid = arrays['bank_oid']
+        if 'bank_xy' in arrays:
+            table.bank_xy = arrays['bank_xy']
+        for i, name in enumerate(meta['columns']):
+            table.columns[name] = arrays[f'column_{i}']
+        for i, name in enumerate(meta['objects']):
+            table.objects[name] = [tuple(x) for x in arrays[f'object_{i}'].tolist()]
+    for name in meta['fields']:
+        table.add_field(name, integer=name in meta['integer'])
+    river.data = table
+
+    flood_path = None
+    if 'transform' in meta:
+        f_arr = np.load(os.path.join(cache_dir, 'flow.npy'), mmap_mode='r')
+        flood_path = Flood_path.from_array(f_arr, Affine(*meta['transform']), meta['point_fc'])
+        # from_array() doesn't know the crs of the raster
+        flood_path.crs = CRS.from_wkt(meta['crs']) if meta.get('crs') != None else None
+        path = os.path.join(cache_dir, 'downstream.npz')
+        if os.path.exists(path):
+            with np.load(path) as arrays:
+                flood_path.downstream = {x: arrays[x] for x in arrays.files}
+    return river, flood_path
@@ -0,0 +1,486 @@
+"""
+Depression filling and D8 flow direction without arcpy, like Fill() and FlowDirection() in raster_merge.py.
+The flow direction has the codes 1 to 128 that Flood_path decodes, see D8_CODES and D8_OFFSETS in critical_paths.py.
+
+The filled surface is the lowest surface without depressions: every cell is raised to the lowest level
+water can leave the raster from it, over its neighbours. This is what a priority-flood from the edge of the
+raster and from NoData gives, but it is found by sweeps over rows and columns instead, which numpy runs
+a whole row at a time:
+    W = Z on the edge and next to NoData, W = infinity elsewhere
+    W = max(Z, min(W, W of a neighbour)), repeated until nothing changes
+Every sweep only lowers W, and W never goes below the filled surface, so the sweeps can run tile by tile in any
+order and still end at the same surface. A tile reads a one cell halo of its neighbour tiles, and is run again
+when the edge of a neighbour changed, so depressions that reach across tiles are filled like on the whole raster.
+
+Flow direction follows the steepest drop. Cells on the edge or next to NoData without a lower neighbour flow out
+of the raster, like the NORMAL edge setting of FlowDirection. Flat areas of the filled surface flow to the
+nearest cell of the flat that has a direction, found with distance sweeps that run tile by tile the same way.
+
+Work arrays are memory mapped files in a temporary directory, so only a few tiles per process are in memory,
+and tiles can run in worker processes.
+
+Run with:
+    python hydrology.py dem.tif flow_dir.tif --filled dem_fill.tif --tile-size 1024 --workers 4
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from critical_paths import D8_CODES, D8_OFFSETS
+
+D8_DISTANCE = {code: float(np.hypot(*D8_OFFSETS[code])) for code in D8_CODES}
+# distance of flat cells that are not reached yet
+FAR = 2**30
+
+
+def sweep_fill(z: np.ndarray, w: np.ndarray) -> None:
+    """One sweep of the fill down the rows, and one up. Every row is lowered to the lowest of the three
+    neighbours in the row before it, but not below its elevation.
+
+    Args:
+        z (np.ndarray): Elevation with shape (rows, cols), -inf for NoData
+        w (np.ndarray): Water level with a one cell halo, shape (rows + 2, cols + 2), changed in place
+    """
+    n_rows = z.shape[0]
+    for rows in (range(1, n_rows + 1), range(n_rows, 0, -1)):
+        step = 1 if rows.step > 0 else -1
+        for row in rows:
+            before = w[row - step]
+            lowest = np.minimum(np.minimum(before[:-2], before[1:-1]), before[2:])
+            level = w[row, 1:-1]
+            np.maximum(z[row - 1], np.minimum(level, lowest), out=level)
+
+
+def fill_window(z: np.ndarray, w: np.ndarray) -> int:
+    """Sweeps along rows and columns until the water level of a window doesn't change.
+
+    Args:
+        z (np.ndarray): Elevation with shape (rows, cols), -inf for NoData
+        w (np.ndarray): Water level with a one cell halo, which is not changed, changed in place
+
+    Returns:
+        int: Number of rounds of sweeps
+    """
+    rounds = 0
+    while True:
+        before = w.copy()
+        sweep_fill(z, w)
+        sweep_fill(z.T, w.T)
+        rounds += 1
+        if np.array_equal(before, w):
+            return rounds
+
+
+def sweep_flats(level: np.ndarray, distance: np.ndarray, flat: np.ndarray) -> None:
+    """One sweep of the flat distances down the rows, and one up. A flat cell gets one more than the
+    smallest distance of the neighbours at the same level in the row before it.
+
+    Args:
+        level (np.ndarray): Filled surface with a one cell halo, -inf for NoData and outside the raster
+        distance (np.ndarray): Distance with a one cell halo, 0 for cells with a direction, changed in place
+        flat (np.ndarray): True for flat cells, shape (rows, cols)
+    """
+    n_rows = flat.shape[0]
+    for rows in (range(1, n_rows + 1), range(n_rows, 0, -1)):
+        step = 1 if rows.step > 0 else -1
+        for row in rows:
+            if not flat[row - 1].any():
+                continue
+            centre = level[row, 1:-1]
+            nearest = distance[row, 1:-1].copy()
+            for shift in (0, 1, 2):
+                same = level[row - step, shift:shift+len(centre)] == centre
+                np.minimum(nearest, np.where(same, distance[row - step, shift:shift+len(centre)] + 1, FAR), out=nearest)
+            distance[row, 1:-1] = np.where(flat[row - 1], nearest, distance[row, 1:-1])
+
+
+def flats_window(level: np.ndarray, distance: np.ndarray, flat: np.ndarray) -> int:
+    """Sweeps along rows and columns until the flat distances of a window don't change.
+
+    Args:
+        level (np.ndarray): Filled surface with a one cell halo
+        distance (np.ndarray): Distance with a one cell halo, which is not changed, changed in place
+        flat (np.ndarray): True for flat cells
+
+    Returns:
+        int: Number of rounds of sweeps
+    """
+    rounds = 0
+    while flat.any():
+        before = distance.copy()
+        sweep_flats(level, distance, flat)
+        sweep_flats(level.T, distance.T, flat.T)
+        rounds += 1
+        if np.array_equal(before, distance):
+            break
+    return rounds
+
+
+def steepest_direction(level: np.ndarray, outside: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """D8 direction of the steepest drop. Of equal drops the first in D8_CODES is taken.
+    Cells without a lower neighbour flow to the first neighbour outside the raster or with NoData, if they have one.
+
+    Args:
+        level (np.ndarray): Filled surface with a one cell halo
+        outside (np.ndarray): True for NoData and cells outside the raster, with a one cell halo
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: D8 codes as uint8 with 0 for NoData and flat cells, and True for flat cells
+    """
+    n_rows, n_cols = level.shape[0] - 2, level.shape[1] - 2
+    centre = level[1:-1, 1:-1]
+    steepest = np.zeros((n_rows, n_cols))
+    direction = np.zeros((n_rows, n_cols), dtype=np.uint8)
+    out_direction = np.zeros((n_rows, n_cols), dtype=np.uint8)
+    for code in D8_CODES:
+        d_row, d_col = D8_OFFSETS[code]
+        neighbour = level[1+d_row:1+d_row+n_rows, 1+d_col:1+d_col+n_cols]
+        neighbour_outside = outside[1+d_row:1+d_row+n_rows, 1+d_col:1+d_col+n_cols]
+        with np.errstate(invalid='ignore'):
+            drop = np.where(neighbour_outside, 0, (centre - neighbour) / D8_DISTANCE[code])
+        steeper = drop > steepest
+        steepest[steeper] = drop[steeper]
+        direction[steeper] = code
+        out_direction[neighbour_outside & (out_direction == 0)] = code
+    nodata = outside[1:-1, 1:-1]
+    direction = np.where(direction == 0, out_direction, direction)
+    direction[nodata] = 0
+    return direction, (direction == 0) & ~nodata
+
+
+def flat_direction(level: np.ndarray, distance: np.ndarray, outside: np.ndarray, flat: np.ndarray) -> np.ndarray:
+    """D8 direction of flat cells, to the first neighbour at the same level that is one step closer to the edge of the flat.
+
+    Args:
+        level (np.ndarray): Filled surface with a one cell halo
+        distance (np.ndarray): Distance from flats_window() with a one cell halo
+        outside (np.ndarray): True for NoData and cells outside the raster, with a one cell halo
+        flat (np.ndarray): True for flat cells
+
+    Returns:
+        np.ndarray: D8 codes as uint8, 0 for cells that are not flat
+    """
+    n_rows, n_cols = flat.shape
+    centre = level[1:-1, 1:-1]
+    closer = distance[1:-1, 1:-1] - 1
+    direction = np.zeros((n_rows, n_cols), dtype=np.uint8)
+    for code in D8_CODES:
+        d_row, d_col = D8_OFFSETS[code]
+        window = (slice(1+d_row, 1+d_row+n_rows), slice(1+d_col, 1+d_col+n_cols))
+        found = flat & (direction == 0) & ~outside[window] & (level[window] == centre) & (distance[window] == closer)
+        direction[found] = code
+    return direction
+
+
+def fill(dem: np.ndarray, nodata: float = None) -> np.ndarray:
+    """Fills the depressions of a DEM in memory, see the module docstring.
+
+    Args:
+        dem (np.ndarray): Elevation raster
+        nodata (float, optional): NoData value of dem, NaN is always NoData. Defaults to None.
+
+    Returns:
+        np.ndarray: Filled surface as float64, NaN for NoData
+    """
+    z = np.asarray(dem, dtype=np.float64)
+    nodata_mask = np.isnan(z) if nodata == None else np.isnan(z) | (z == nodata)
+    z = np.where(nodata_mask, -np.inf, z)
+    w = np.full((z.shape[0] + 2, z.shape[1] + 2), -np.inf)
+    w[1:-1, 1:-1] = np.where(nodata_mask, -np.inf, np.inf)
+    fill_window(z, w)
+    return np.where(nodata_mask, np.nan, w[1:-1, 1:-1])
+
+
+def flow_direction(filled: np.ndarray) -> np.ndarray:
+    """D8 flow direction of a filled surface in memory, see the module docstring.
+
+    Args:
+        filled (np.ndarray): Output from fill(), NaN for NoData
+
+    Returns:
+        np.ndarray: D8 codes as uint8, 0 for NoData
+    """
+    level = np.pad(np.where(np.isnan(filled), -np.inf, filled), 1, constant_values=-np.inf)
+    outside = np.pad(np.isnan(filled), 1, constant_values=True)
+    direction, flat = steepest_direction(level, outside)
+    distance = np.pad(np.where(flat, FAR, 0), 1, constant_values=FAR)
+    flats_window(level, distance, flat)
+    return direction | flat_direction(level, distance, outside, flat)
+
+
+def tiles(shape: tuple[int, int], tile_size: int) -> tuple[list[Window], list[list[int]]]:
+    """Splits a raster into square tiles, row by row.
+
+    Args:
+        shape (tuple[int, int]): Rows and columns of the raster
+        tile_size (int): Width and height of tiles in cells
+
+    Returns:
+        tuple[list[Window], list[list[int]]]: Window of every tile, and the indices of the up to eight tiles around every tile
+    """
+    n_rows, n_cols = -(-shape[0] // tile_size), -(-shape[1] // tile_size)
+    windows = [Window(col * tile_size, row * tile_size, min(tile_size, shape[1] - col * tile_size), min(tile_size, shape[0] - row * tile_size))
+               for row in range(n_rows) for col in range(n_cols)]
+    around = [[(row + d_row) * n_cols + col + d_col for d_row in (-1, 0, 1) for d_col in (-1, 0, 1)
+               if (d_row, d_col) != (0, 0) and 0 <= row + d_row < n_rows and 0 <= col + d_col < n_cols]
+              for row in range(n_rows) for col in range(n_cols)]
+    return windows, around
+
+
+def read_halo(array: np.ndarray, window: Window, outside: any) -> np.ndarray:
+    """Reads a window with a one cell halo from a raster sized array.
+
+    Args:
+        array (np.ndarray): Raster sized array, like a memory mapped work array
+        window (Window): Window in the raster
+        outside (any): Value of the halo outside the raster
+
+    Returns:
+        np.ndarray: Copy of the window with shape (rows + 2, cols + 2)
+    """
+    row, col, height, width = int(window.row_off), int(window.col_off), int(window.height), int(window.width)
+    halo = np.full((height + 2, width + 2), outside, dtype=array.dtype)
+    top, left = max(row - 1, 0), max(col - 1, 0)
+    bottom, right = min(row + height + 1, array.shape[0]), min(col + width + 1, array.shape[1])
+    halo[top-row+1:bottom-row+1, left-col+1:right-col+1] = array[top:bottom, left:right]
+    return halo
+
+
+def edge_changed(before: np.ndarray, after: np.ndarray) -> bool:
+    """True if the outer cells of a window differ, which are the halo of the tiles around it."""
+    return not (np.array_equal(before[0], after[0]) and np.array_equal(before[-1], after[-1])
+                and np.array_equal(before[:, 0], after[:, 0]) and np.array_equal(before[:, -1], after[:, -1]))
+
+
+# memory mapped work arrays of a worker process, set once by init_hydrology_worker()
+worker_arrays = {}
+
+
+def init_hydrology_worker(work_dir: str) -> None:
+    """Opens the work arrays in a worker process.
+
+    Args:
+        work_dir (str): Directory with the .npy work arrays
+    """
+    global worker_arrays
+    worker_arrays = {x[:-4]: np.load(os.path.join(work_dir, x), mmap_mode='r+') for x in os.listdir(work_dir) if x.endswith('.npy')}
+
+
+def fill_tile(window: Window) -> tuple[bool, int]:
+    """Fills one tile with the current water level of the tiles around it as halo.
+
+    Args:
+        window (Window): Tile in the raster
+
+    Returns:
+        tuple[bool, int]: True if the edge of the tile changed, and the number of rounds of sweeps
+    """
+    z, w = worker_arrays['z'], worker_arrays['w']
+    rows, cols = slice(int(window.row_off), int(window.row_off + window.height)), slice(int(window.col_off), int(window.col_off + window.width))
+    level = read_halo(w, window, -np.inf)
+    before = level[1:-1, 1:-1].copy()
+    rounds = fill_window(z[rows, cols], level)
+    w[rows, cols] = level[1:-1, 1:-1]
+    return edge_changed(before, level[1:-1, 1:-1]), rounds
+
+
+def direction_tile(window: Window) -> int:
+    """Finds the steepest drop direction of one tile, and marks its flat cells for the distance sweeps.
+
+    Args:
+        window (Window): Tile in the raster
+
+    Returns:
+        int: Number of flat cells
+    """
+    w = worker_arrays['w']
+    rows, cols = slice(int(window.row_off), int(window.row_off + window.height)), slice(int(window.col_off), int(window.col_off + window.width))
+    level = read_halo(w, window, -np.inf)
+    direction, flat = steepest_direction(level, level == -np.inf)
+    worker_arrays['direction'][rows, cols] = direction
+    worker_arrays['distance'][rows, cols] = np.where(flat, FAR, 0)
+    return int(flat.sum())
+
+
+def flats_tile(window: Window) -> tuple[bool, int]:
+    """Runs the flat distance sweeps on one tile with the current distances of the tiles around it as halo.
+
+    Args:
+        window (Window): Tile in the raster
+
+    Returns:
+        tuple[bool, int]: True if the edge of the tile changed, and the number of rounds of sweeps
+    """
+    rows, cols = slice(int(window.row_off), int(window.row_off + window.height)), slice(int(window.col_off), int(window.col_off + window.width))
+    flat = worker_arrays['direction'][rows, cols] == 0
+    level = read_halo(worker_arrays['w'], window, -np.inf)
+    flat &= level[1:-1, 1:-1] != -np.inf
+    if not flat.any():
+        return False, 0
+    distance = read_halo(worker_arrays['distance'], window, FAR)
+    before = distance[1:-1, 1:-1].copy()
+    rounds = flats_window(level, distance, flat)
+    worker_arrays['distance'][rows, cols] = distance[1:-1, 1:-1]
+    return edge_changed(before, distance[1:-1, 1:-1]), rounds
+
+
+def output_tile(window: Window) -> tuple[Window, np.ndarray, np.ndarray]:
+    """Final flow direction of one tile, with the flat cells pointed along the distances.
+
+    Args:
+        window (Window): Tile in the raster
+
+    Returns:
+        tuple[Window, np.ndarray, np.ndarray]: The window, the D8 codes and the filled surface with -inf for NoData
+    """
+    rows, cols = slice(int(window.row_off), int(window.row_off + window.height)), slice(int(window.col_off), int(window.col_off + window.width))
+    level = read_halo(worker_arrays['w'], window, -np.inf)
+    direction = np.array(worker_arrays['direction'][rows, cols])
+    outside = level == -np.inf
+    flat = (direction == 0) & ~outside[1:-1, 1:-1]
+    if flat.any():
+        distance = read_halo(worker_arrays['distance'], window, FAR)
+        direction |= flat_direction(level, distance, outside, flat)
+    return window, direction, level[1:-1, 1:-1]
+
+
+def relax(run: callable, function: callable, windows: list[Window], around: list[list[int]], label: str) -> int:
+    """Runs a tile function until no tile changes its edge. Tiles run again only if a tile around them changed.
+
+    Args:
+        run (callable): map() of this process or of a pool
+        function (callable): fill_tile() or flats_tile()
+        windows (list[Window]): Tiles from tiles()
+        around (list[list[int]]): Tiles around every tile from tiles()
+        label (str): Name of the step in the progress lines
+
+    Returns:
+        int: Number of passes over the tiles
+    """
+    active = list(range(len(windows)))
+    passes = 0
+    while len(active) > 0:
+        passes += 1
+        print(f"{label}: pass {passes}, {len(active)} tiles")
+        changed = set()
+        for i, (edge, _) in zip(active, run(function, [windows[i] for i in active])):
+            if edge:
+                changed.update(around[i])
+        active = sorted(changed)
+    return passes
+
+
+def output_tiles(pool: ProcessPoolExecutor, windows: list[Window], workers: int):
+    """Yields output_tile() of every tile in order, with a few tiles per worker in flight, so memory stays bounded on large rasters.
+
+    Args:
+        pool (ProcessPoolExecutor): Pool of workers, or None to run the tiles here
+        windows (list[Window]): Tiles from tiles()
+        workers (int): Number of workers
+    """
+    if pool == None:
+        yield from map(output_tile, windows)
+        return
+    pending = []
+    for window in windows:
+        pending.append(pool.submit(output_tile, window))
+        if len(pending) >= 2 * workers:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+def fill_and_direction(dem: str, flow_dir: str, filled: str = None, tile_size: int = 1024, workers: int = 1,
+                       work_dir: str = None, output_tile_size: int = 256) -> dict:
+    """Fills the depressions of a DEM and writes the D8 flow direction, tile by tile. The result is the same for every
+    tile size and number of workers. The work arrays take 17 bytes per cell on disk.
+
+    Args:
+        dem (str): Path to the DEM raster
+        flow_dir (str): Path to the D8 flow direction GeoTIFF, uint8 with 0 for NoData, the grid of the DEM
+        filled (str, optional): Path to a GeoTIFF of the filled surface, like Fill(). Defaults to None = not written.
+        tile_size (int, optional): Width and height of the tiles that are processed at once. Defaults to 1024.
+        workers (int, optional): Worker processes running tiles. Defaults to 1 = run them here.
+        work_dir (str, optional): Where the work arrays are made. Defaults to None = the temporary directory.
+        output_tile_size (int, optional): Width and height of the GeoTIFF tiles. Defaults to 256.
+
+    Returns:
+        dict: 'tiles', 'fill_passes', 'flat_cells' and 'flat_passes'
+    """
+    work = tempfile.mkdtemp(prefix='hydrology_', dir=work_dir)
+    try:
+        with rasterio.open(dem) as dataset:
+            shape, profile = dataset.shape, dataset.profile
+            windows, around = tiles(shape, tile_size)
+            z = np.lib.format.open_memmap(os.path.join(work, 'z.npy'), mode='w+', dtype=np.float64, shape=shape)
+            w = np.lib.format.open_memmap(os.path.join(work, 'w.npy'), mode='w+', dtype=np.float64, shape=shape)
+            print(f"Reading {len(windows)} tiles")
+            for window in windows:
+                rows, cols = slice(int(window.row_off), int(window.row_off + window.height)), slice(int(window.col_off), int(window.col_off + window.width))
+                values = dataset.read(1, window=window, masked=True)
+                data = values.data.astype(np.float64)
+                nodata = np.ma.getmaskarray(values) | np.isnan(data)
+                z[rows, cols] = np.where(nodata, -np.inf, data)
+                w[rows, cols] = np.where(nodata, -np.inf, np.inf)
+        np.lib.format.open_memmap(os.path.join(work, 'direction.npy'), mode='w+', dtype=np.uint8, shape=shape).flush()
+        np.lib.format.open_memmap(os.path.join(work, 'distance.npy'), mode='w+', dtype=np.int32, shape=shape).flush()
+        z.flush()
+        w.flush()
+        del z, w
+
+        pool = None
+        if workers <= 1:
+            init_hydrology_worker(work)
+            run = map
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=init_hydrology_worker, initargs=(work,))
+            run = pool.map
+        try:
+            stats = {'tiles': len(windows)}
+            stats['fill_passes'] = relax(run, fill_tile, windows, around, "Filling")
+            print("Finding flow directions")
+            stats['flat_cells'] = sum(run(direction_tile, windows))
+            stats['flat_passes'] = relax(run, flats_tile, windows, around, "Flat areas") if stats['flat_cells'] > 0 else 0
+
+            print(f"Writing {flow_dir}")
+            out_profile = {'driver': 'GTiff', 'height': shape[0], 'width': shape[1], 'count': 1, 'crs': profile.get('crs'),
+                           'transform': profile['transform'], 'tiled': True, 'blockxsize': output_tile_size, 'blockysize': output_tile_size,
+                           'compress': 'deflate', 'BIGTIFF': 'IF_SAFER'}
+            with rasterio.open(flow_dir, 'w', dtype='uint8', nodata=0, predictor=2, **out_profile) as out:
+                filled_out = None
+                if filled != None:
+                    nodata = profile.get('nodata')
+                    nodata = np.finfo(np.float32).min if nodata == None or np.isnan(nodata) else nodata
+                    filled_out = rasterio.open(filled, 'w', dtype='float32', nodata=nodata, predictor=3, **out_profile)
+                try:
+                    for window, direction, level in output_tiles(pool, windows, workers):
+                        out.write(direction, 1, window=window)
+                        if filled_out != None:
+                            filled_out.write(np.where(level == -np.inf, filled_out.nodata, level).astype(np.float32), 1, window=window)
+                finally:
+                    if filled_out != None:
+                        filled_out.close()
+        finally:
+            worker_arrays.clear()
+            if pool != None:
+                pool.shutdown()
+        return stats
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+# worker processes import this module, so the conditioning only runs in the main process
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Depression filling and D8 flow direction of a DEM, tile by tile")
+    parser.add_argument('dem', help="DEM raster, cells outside the watershed as NoData")
+    parser.add_argument('flow_dir', help="D8 flow direction GeoTIFF")
+    parser.add_argument('--filled', help="GeoTIFF of the filled DEM")
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--work-dir', help="directory for the work arrays, 17 bytes per cell")
+    args = parser.parse_args()
+    print(fill_and_direction(args.dem, args.flow_dir, args.filled, args.tile_size, args.workers, args.work_dir))
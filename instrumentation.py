@@ -0,0 +1,178 @@
+"""
+Timing, memory and counter instrumentation of the analysis stages.
+River and Flood_path record to self.recorder, which is the shared module recorder unless it is replaced,
+so one Recorder collects a whole run and Stats adds its results to the stats table.
+
+    recorder = instrumentation.Recorder(sinks=[instrumentation.Jsonl_sink('stages.jsonl')])
+    river.recorder = flood_path.recorder = recorder
+    with recorder.stage('my_step'):
+        ...
+    recorder.count('cursor_rows', 100)
+
+Progress of long loops goes through Recorder.progress(), which calls the progress hook at most once per interval.
+"""
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process in bytes, or None if it can't be read."""
+    if resource != None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes and macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil != None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    return None
+
+
+def print_progress(label: str, done: int, total: int) -> None:
+    """Default progress hook, which writes over the same line until the last item."""
+    if done < total:
+        print(f"{label} {done} of {total}", end="\r")
+    else:
+        print(f"{label} {done} of {total}")
+
+
+class Jsonl_sink:
+    """Sink that appends every record to a JSON lines file."""
+
+    def __init__(self, path: str) -> None:
+        """Create a sink.
+
+        Args:
+            path (str): File the records are appended to
+        """
+        self.path = path
+
+    def __call__(self, record: dict) -> None:
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+class Recorder:
+    """Records wall time and peak memory of named stages, and counters like cells traversed or cursor rows read.
+    Stages can be nested, and a stage that runs more than once adds up its time.
+    """
+
+    def __init__(self, sinks: list[callable] = None, memory: str = 'rss', progress: callable = print_progress, interval: float = 0.5) -> None:
+        """Create a recorder.
+
+        Args:
+            sinks (list[callable], optional): Functions that get a dict for every finished stage and from self.flush(). Defaults to None.
+            memory (str, optional): 'rss' for the peak memory of the process, 'tracemalloc' for the peak of Python and numpy allocations
+                within each stage, which is slower, or None. Defaults to 'rss'.
+            progress (callable, optional): Hook called with label, done and total, or None for no progress. Defaults to print_progress().
+            interval (float, optional): Seconds between calls to the progress hook. Defaults to 0.5.
+        """
+        self.sinks = list(sinks) if sinks != None else []
+        self.memory = memory
+        self.progress_hook = progress
+        self.interval = interval
+        self.stages = {}
+        self.counters = {}
+        self.peaks = []
+        self.last_progress = 0
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times the code in a with block as a stage.
+
+        Args:
+            name (str): Name of the stage
+        """
+        if self.memory == 'tracemalloc':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            # the peak so far belongs to the stage around this one
+            if len(self.peaks) > 0:
+                self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = None
+            if self.memory == 'tracemalloc':
+                peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if len(self.peaks) > 0:
+                    self.peaks[-1] = max(self.peaks[-1], peak)
+            elif self.memory == 'rss':
+                peak = peak_rss()
+            record = self.stages.setdefault(name, {'time': 0.0, 'calls': 0, 'peak_memory': None})
+            record['time'] += elapsed
+            record['calls'] += 1
+            if peak != None:
+                record['peak_memory'] = peak if record['peak_memory'] == None else max(record['peak_memory'], peak)
+            self.emit({'event': 'stage', 'name': name, 'time': elapsed, 'peak_memory': peak})
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Adds to a counter.
+
+        Args:
+            name (str): Name of the counter
+            value (int, optional): Amount to add. Defaults to 1.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def progress(self, label: str, done: int, total: int) -> None:
+        """Reports progress through the hook, at most once per interval and always for the last item.
+
+        Args:
+            label (str): What is counted, like 'Analyzing point'
+            done (int): Position of the current item, counting from 1
+            total (int): Number of items
+        """
+        if self.progress_hook == None:
+            return
+        now = time.perf_counter()
+        if now - self.last_progress >= self.interval or done >= total:
+            self.last_progress = now
+            self.progress_hook(label, done, total)
+
+    def emit(self, record: dict) -> None:
+        """Sends a record to all sinks."""
+        for sink in self.sinks:
+            sink(record)
+
+    def results(self) -> dict:
+        """Flat results for Stats.results, with {stage}_time and {stage}_peak_mb for every stage and all counters.
+        With memory='rss', {stage}_peak_mb is the peak of the process so far when the stage last ended.
+        """
+        results = {}
+        for name, record in self.stages.items():
+            results[f'{name}_time'] = record['time']
+            if record['peak_memory'] != None:
+                results[f'{name}_peak_mb'] = record['peak_memory'] / 2**20
+        results.update(self.counters)
+        return results
+
+    def flush(self) -> None:
+        """Sends the results to all sinks."""
+        self.emit({'event': 'summary', 'time': datetime.now(), **self.results()})
+
+    def reset(self) -> None:
+        """Clears stages and counters, like between iterations of a benchmark."""
+        self.stages = {}
+        self.counters = {}
+        self.peaks = []
+
+
+# recorder used by River and Flood_path unless they are given another one
+recorder = Recorder()
@@ -1,6 +1,11 @@
 from river_geometry import River as River_dic
 from critical_paths import Flood_path
 from parameter_statistics import Stats
+import geometry_cache
+import instrumentation
+import parameter_sweep
+import pipeline
+import os
 import time
 
 """
@@ -22,30 +27,88 @@ side_points = 'path'
 dem = 'dem'
 dem_res = '1'
 comp_flow = '1'
-q = 100
+scenarios = {5: 'wse5', 100: 'wse100'} # return period and water surface raster
 transect_space = 4
 transect_width = 80
 transect_point_space = 4
 distances = tuple(x for x in range(0, transect_width+1, transect_point_space))
+workers = 14 # processes for the geometry analysis and flow tracing, 1 runs them in this process
+cache_dir = None # directory to save the geometry and flow raster to, for service.py, and to reuse while the inputs are the same
+input_layers = ['fkb_bygning_omrade', 'fkb_veg_omrade'] # building and road layers of the flow raster, part of the cache key
+trace_file = None # .npz with the flow paths of the last run, so a changed flow raster only retraces the paths it changes
+old_comp_flow = None # flow raster of the run in trace_file, None runs from scratch
+stage_log = None # .jsonl file that gets the time and memory of every stage
+export_format = None # '.gpkg', '.fgb' or '.parquet' writes the paths to files next to the gdb instead of to feature classes
+exact_accuracy = False # intersect the exported paths with the building and road layers, instead of counting them in the flow raster
+pipelined = False # overlap the DEM sampling, critical point selection and flow tracing of batches of points, with the native bank sampling
+sweep_grid = None # values of transect_space, transect_width, transect_point_space, slope and dynamic to sweep, like {'transect_width': [40, 80]}, instead of the runs below
 
 
-for q in (5, 100):
-    for i in range(5):
+# worker processes import this module on Windows, so the analysis only runs in the main process
+if __name__ == "__main__":
+    if stage_log != None:
+        instrumentation.recorder.sinks.append(instrumentation.Jsonl_sink(stage_log))
+    if sweep_grid != None:
+        grid = {'transect_space': [transect_space], 'transect_width': [transect_width], 'transect_point_space': [transect_point_space], **sweep_grid}
+        parameter_sweep.run(workspace, river_name, 'river_polygon', dem, 'flow_raster', scenarios, grid, workers=workers, output='sweep.csv')
+    key = None
+    if cache_dir != None and sweep_grid == None:
+        # only the inputs, hashed before the first run writes its outputs to the same gdb
         river = River_dic(workspace, river_name, 'river_polygon', dem)
         river.distance_tupl = distances
         river.point_distance = transect_space
+        river.scenarios = dict(scenarios)
+        key = geometry_cache.inputs_hash(workspace, ['river_polygon', dem, 'flow_raster'] + input_layers + list(scenarios.values()),
+                                         geometry_cache.river_settings(river))
+    for i in range(5 if sweep_grid == None else 0):
+        instrumentation.recorder.reset()
+        cached = key != None and geometry_cache.is_current(cache_dir, key)
         geom_st = time.perf_counter()
-        river.full_analysis()
-        geom_et = time.perf_counter()
-        cp = river.find_critical_points(q)
-        flood_test = Flood_path(workspace, 'flow_raster', side_points)
-        cp_st = time.perf_counter()
-        all = flood_test.import_data(cp)
-        all_analyzed = flood_test.analyze(all, duplicate_paths=True)
+        if cached:
+            # the geometry and flow raster of an earlier run with the same inputs
+            river, flood_test = geometry_cache.load(cache_dir)
+        else:
+            river = River_dic(workspace, river_name, 'river_polygon', dem)
+            river.distance_tupl = distances
+            river.point_distance = transect_space
+        if pipelined and not cached:
+            river.prepare_analysis(scenarios)
+            flood_test = Flood_path(workspace, 'flow_raster', side_points)
+            all_analyzed = pipeline.run(river, flood_test, duplicate_paths=True, workers=workers, as_arcpy=export_format == None)
+            # the stages overlap, so the geometry time is the run up to resolving the paths
+            geom_et = cp_st = time.perf_counter() - flood_test.resolve_time
+            if trace_file != None:
+                flood_test.save_traces(trace_file)
+        else:
+            if not cached:
+                river.full_analysis(workers=workers, scenarios=scenarios)
+            geom_et = time.perf_counter()
+            if not cached:
+                flood_test = Flood_path(workspace, 'flow_raster', side_points)
+            cp_st = time.perf_counter()
+            if trace_file != None and old_comp_flow != None and os.path.exists(trace_file):
+                # the points and critical points of the earlier run are in trace_file, so they aren't selected and imported again
+                all_analyzed = flood_test.update(trace_file, old_comp_flow, workers, as_arcpy=export_format == None)
+            else:
+                cp = river.find_critical_points(scenarios)
+                all = flood_test.import_data({x: y for q in cp for x, y in cp[q].items()})
+                all_analyzed = flood_test.analyze_scenarios(all, cp, duplicate_paths=True, workers=workers, as_arcpy=export_format == None)
+                if trace_file != None:
+                    flood_test.save_traces(trace_file)
         cp_et = time.perf_counter()
         geom_tt = geom_et - geom_st
         cp_tt = cp_et - cp_st
-        out_name = f"final_cp_paths_{q}"
-        flood_test.export(all_analyzed, out_name)
-        stats = Stats(river, flood_test, out_name, geom_tt, cp_tt)
-        stats.calculate()
\ No newline at end of file
+        if key != None and not cached:
+            geometry_cache.save(cache_dir, key, river, flood_test)
+        for q in scenarios:
+            out_name = f"final_cp_paths_{q}"
+            if export_format != None:
+                out_name = os.path.join(os.path.dirname(workspace), out_name + export_format)
+                flood_test.export_scenario(q, out_name)
+            else:
+                flood_test.export(all_analyzed[q], out_name)
+            stats = Stats(river, flood_test, out_name, geom_tt, cp_tt, q, exact_accuracy)
+            stats.calculate()
+        # the flow raster in shared memory for the workers
+        flood_test.close()
+        instrumentation.recorder.flush()
\ No newline at end of file
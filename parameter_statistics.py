@@ -1,29 +1,74 @@
 import os
-import arcpy
+try:
+    import arcpy
+except ImportError: # the statistics from the flow raster don't need ArcGIS
+    arcpy = None
 from river_geometry import River
 from critical_paths import Flood_path
 import csv
 from datetime import datetime
 
+# stages and counters recorded by River, Flood_path and parameter_sweep, in the order they run
+STAGES = ('dissolve', 'centerline', 'split_centerline', 'river_points', 'transects', 'extract_elevation', 'import_points', 'extract_wse',
+          'import_elevation', 'import_wse', 'river_bank', 'parallel_analysis', 'gradient_xsection', 'longest_water', 'pipeline',
+          'find_critical_points', 'import_data', 'diff_rasters', 'analyze', 'trace_paths', 'resolve_paths', 'raster_accuracy',
+          'path_coordinates', 'export', 'sweep_select', 'sweep_trace', 'sweep_resolve')
+COUNTERS = ('cursor_rows', 'cells_changed', 'paths_traced', 'cells_traversed', 'paths_merged', 'paths_truncated', 'paths_removed',
+            'paths_resolved', 'pipeline_batches', 'pipeline_sample_busy_time', 'pipeline_select_busy_time', 'pipeline_trace_busy_time',
+            'tile_loads', 'tile_sweeps', 'tile_load_bound', 'rows_written', 'vertices_written')
+# columns of stats.csv, the same for every kind of run so rows can be appended, with blanks for stages that didn't run.
+# {stage}_peak_mb is the peak memory of the process so far when the stage ended, not of the stage alone,
+# unless the recorder measures with memory='tracemalloc'
+FIELDS = (('name', 'time', 'geo_time', 'cp_time', 'cp_workers', 'trace_time', 'resolve_time')
+          + tuple(f'{x}_{y}' for x in STAGES for y in ('time', 'peak_mb')) + COUNTERS
+          + ('candidates', 'critical', 'percent', 'accuracy_source', 'build_inter', 'road_inter', 'mean_crit'))
+
 
 class Stats:
-    def __init__(self, river: River, flood_path: Flood_path, filename: str, geom_time: float, cp_time: float) -> None:
-        arcpy.env.workspace = river.workspace
+    def __init__(self, river: River, flood_path: Flood_path, filename: str, geom_time: float, cp_time: float, q: int = None, exact: bool = False) -> None:
+        """Collects the statistics of a run.
+
+        Args:
+            river (River): River after River.full_analysis()
+            flood_path (Flood_path): Flood_path after the analysis
+            filename (str): Name of the exported fc with the flow paths
+            geom_time (float): Seconds of the geometry analysis
+            cp_time (float): Seconds of the flow path analysis
+            q (int, optional): Scenario from Flood_path.analyze_scenarios(). Defaults to None.
+            exact (bool, optional): Intersect the exported paths with the building and road polygons, instead of
+                using Flood_path.scenario_accuracy from the flow raster. Needs arcpy. Defaults to False.
+        """
+        if arcpy != None:
+            arcpy.env.workspace = river.workspace
         self.river = river
         self.flood_path = flood_path
         self.filename = filename
         self.geom_time = geom_time
         self.cp_time = cp_time
+        # scenario from Flood_path.analyze_scenarios(), None after Flood_path.analyze()
+        self.q = q
+        self.exact = exact
         self.results = {}
         self.results['name'] = filename
         self.results['time'] = datetime.now()
         self.results['geo_time'] = geom_time
         self.results['cp_time'] = cp_time
+        # tracing is the part of cp_time that scales with workers, the paths are merged in one process
+        self.results['cp_workers'] = flood_path.workers
+        self.results['trace_time'] = flood_path.trace_time
+        self.results['resolve_time'] = flood_path.resolve_time
+        # stage timings and counters, once per recorder when River and Flood_path share one
+        for recorder in {id(x): x for x in (river.recorder, flood_path.recorder)}.values():
+            self.results.update(recorder.results())
         
         
     def calc_percentage(self):
-        total_candidate = len(self.flood_path.crit_points)
-        total_critical = self.flood_path.crit_num
+        if self.q == None:
+            total_candidate = len(self.flood_path.crit_points)
+            total_critical = self.flood_path.crit_num
+        else:
+            total_candidate = len(self.flood_path.scenario_points[self.q])
+            total_critical = self.flood_path.scenario_num[self.q]
         percent = total_critical/total_candidate*100
         self.results['candidates'] = total_candidate
         self.results['critical'] = total_critical
@@ -31,7 +76,16 @@ class Stats:
         print(f"Candidate points: {total_candidate}, Critical points: {total_critical}, {percent}%")
         return percent
     
+    def raster_accuracy(self) -> dict:
+        """Statistics of the paths from the flow raster, or None if Flood_path doesn't have them for self.q."""
+        return None if self.exact else self.flood_path.scenario_accuracy.get(self.q)
+
     def calc_mean_crit(self):
+        accuracy = self.raster_accuracy()
+        if accuracy != None:
+            self.results['mean_crit'] = accuracy['mean_crit']
+            print(f"Mean crit percentage: {accuracy['mean_crit']}")
+            return
         num = 0
         tot = 0
         with arcpy.da.SearchCursor(self.filename, ['crit_percent']) as cursor:
@@ -42,6 +96,15 @@ class Stats:
         print(f'Mean crit percentage: {tot/num}')
     
     def calc_accuracy(self):
+        accuracy = self.raster_accuracy()
+        if accuracy != None:
+            self.results['accuracy_source'] = 'raster'
+            self.results['build_inter'] = accuracy['build_inter']
+            self.results['road_inter'] = accuracy['road_inter']
+            print(f"number of intersections is: {accuracy['build_inter']}")
+            print(f"Length of road affected is {accuracy['road_inter']} meters")
+            return
+        self.results['accuracy_source'] = 'geometry'
         sel_build = arcpy.management.SelectLayerByLocation('fkb_bygning_omrade', 'INTERSECT', self.filename, '1 Meters')
         self.results['build_inter'] = sel_build[2]
         print(f'number of intersections is: {sel_build[2]}')
@@ -56,17 +119,45 @@ class Stats:
         arcpy.management.Delete('temp_roads')
         arcpy.management.Delete('temp_roads_diss')
 
-    def write_stats(self):
-        file_path = "stats.csv"
-        file_exists = os.path.exists(file_path)
-        file_empty = os.path.getsize(file_path) == 0 if file_exists else True
+    def write_stats(self, file_path: str = "stats.csv") -> str:
+        """Appends the results to a CSV file with the columns in FIELDS. A file with other columns is rewritten with FIELDS
+        when all its columns are in FIELDS, and otherwise left as it is, and the results go to a new file next to it.
 
-        
-        with open("stats.csv", "a", newline="") as f:
-            w = csv.DictWriter(f, self.results.keys())
-            if not file_exists or file_empty:
+        Args:
+            file_path (str, optional): CSV file. Defaults to "stats.csv".
+
+        Returns:
+            str: The file the results were written to
+        """
+        unknown = [x for x in self.results if x not in FIELDS]
+        if len(unknown) > 0:
+            print(f"Results {unknown} are not in the stats columns and are not written")
+        header = None
+        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+            with open(file_path, newline="") as f:
+                header = next(csv.reader(f), None)
+        if header != None and header != list(FIELDS):
+            with open(file_path, newline="") as f:
+                rows = list(csv.DictReader(f))
+            # a row with more values than the header has them under the key None
+            if set(header) <= set(FIELDS) and all(None not in row for row in rows):
+                print(f"Adding the new stats columns to {file_path}")
+                with open(file_path, "w", newline="") as f:
+                    w = csv.DictWriter(f, FIELDS, restval='')
+                    w.writeheader()
+                    w.writerows(rows)
+            else:
+                base, extension = os.path.splitext(file_path)
+                file_path = f"{base}_{datetime.now():%Y%m%d_%H%M%S}{extension}"
+                print(f"The columns of the existing stats file don't match, writing to {file_path}")
+                header = None
+
+        with open(file_path, "a", newline="") as f:
+            w = csv.DictWriter(f, FIELDS, restval='', extrasaction='ignore')
+            if header == None:
                 w.writeheader()
-            w.writerow(self.results)                
+            w.writerow(self.results)
+        return file_path
     
     def calculate(self):
         print(f'Geometry took: {self.geom_time} sec, Crit_path took: {self.cp_time} sec.')
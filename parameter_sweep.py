@@ -0,0 +1,292 @@
+"""
+Parameter sweeps of the analysis over a grid of settings, reusing the work that grid points share.
+    transect_space          distance between points along the river, which needs its own geoprocessing
+    transect_width          distance from the river bank to the last point across the river
+    transect_point_space    distance between points across the river
+    slope, dynamic          selection of River.find_critical_points()
+For every transect_space, the river is analyzed once with the union of the distances of its grid points, since a bank point
+only depends on its distance along the transect, so a narrower or coarser profile is a subset of the finest one, see River.with_distances().
+The candidate points of all grid points and scenarios are then traced once, and only the merging of the paths, Flood_path.resolve(),
+runs for each grid point, in parallel worker processes. A bank point keeps the OBJECTID from the finest profile in all grid points.
+
+    grid = {'transect_width': [40, 80], 'transect_point_space': [2, 4], 'slope': [None, 10], 'dynamic': [False, True]}
+    table = parameter_sweep.run(workspace, river_name, 'river_polygon', dem, 'flow_raster', scenarios, grid, workers=14, output='sweep.csv')
+
+The results go in one columnar table, a dict of arrays with a row for every grid point and scenario.
+Bank points are found in the flow raster from river.data.bank_xy, which is in the crs of the river, so they are projected to the
+crs of the flow raster first, like the side_points_elev_crs feature class that main.py traces from, see raster_coordinates().
+"""
+import contextlib
+import csv
+import itertools
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.crs import CRS
+from rasterio.warp import transform as warp_transform
+from multiprocessing import shared_memory
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError: # only needed for Parquet output
+    pyarrow = None
+import critical_paths
+import instrumentation
+from river_geometry import River
+from critical_paths import Flood_path
+
+# arrays of Flood_path.traces that the workers read from shared memory
+TRACE_ARRAYS = ('keys', 'starts', 'wanted', 'traced', 'cells', 'targets', 'offsets')
+PARAMETERS = ('transect_space', 'transect_width', 'transect_point_space', 'slope', 'dynamic')
+DEFAULTS = {'transect_space': 4, 'transect_width': 80, 'transect_point_space': 4, 'slope': None, 'dynamic': False}
+
+
+def grid_points(grid: dict[str: list]) -> list[dict]:
+    """All combinations of the values in a grid, with DEFAULTS for parameters that are not in it.
+
+    Args:
+        grid (dict[str: list]): Parameter as key and the values to try as value
+
+    Returns:
+        list[dict]: Value of every parameter for each grid point
+    """
+    unknown = [x for x in grid if x not in PARAMETERS]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown parameters {unknown}, use {PARAMETERS}")
+    values = [list(grid.get(x, [DEFAULTS[x]])) for x in PARAMETERS]
+    return [dict(zip(PARAMETERS, x)) for x in itertools.product(*values)]
+
+
+def point_distances(width: int, point_space: int) -> tuple[int]:
+    """Distances across the river for a transect width and point spacing, like main.py."""
+    return tuple(range(0, width+1, point_space))
+
+
+def river_crs(river: River) -> CRS:
+    """Crs of the feature classes of a river, from its arcpy spatial reference, or river.crs of a River loaded by geometry_cache.
+
+    Args:
+        river (River): River object
+
+    Returns:
+        CRS: The crs, or None if it isn't known
+    """
+    spatial_ref = getattr(river, 'spatial_ref', None)
+    if spatial_ref == None:
+        return getattr(river, 'crs', None)
+    # an EPSG code when the spatial reference has one, since ESRI WKT doesn't always match its EPSG definition
+    return CRS.from_epsg(spatial_ref.factoryCode) if spatial_ref.factoryCode else CRS.from_wkt(spatial_ref.exportToString())
+
+
+def raster_coordinates(river: River, flood_path: Flood_path, xy: np.ndarray) -> np.ndarray:
+    """Projects bank coordinates from the crs of the river to the crs of the flow raster.
+    A river or raster without a known crs, like one from Flood_path.from_array(), is taken to have the crs of the other.
+
+    Args:
+        river (River): River with the crs of its feature classes, see river_crs()
+        flood_path (Flood_path): Flood path object of the flow raster
+        xy (np.ndarray): Coordinates with shape (points, 2), NaN for points that were not found
+
+    Returns:
+        np.ndarray: Coordinates in the crs of the flow raster
+    """
+    crs = river_crs(river)
+    if crs == None or flood_path.crs == None or crs == flood_path.crs:
+        return xy
+    out = np.array(xy, dtype=np.float64)
+    known = np.isfinite(out).all(axis=1)
+    if known.any():
+        x, y = warp_transform(crs, flood_path.crs, out[known, 0], out[known, 1])
+        out[known] = np.column_stack((x, y))
+    return out
+
+
+# flood path with the shared traces, set once in each worker process by init_sweep_worker()
+worker_flood_path = None
+worker_traces_memory = None
+
+
+def init_sweep_worker(raster_args: tuple, transform: any, traces_name: str, layout: list[tuple], modes: dict) -> None:
+    """Gives a worker process a flood path with the raster and the traces of the sweep, both read from shared memory.
+
+    Args:
+        raster_args (tuple): Arguments of critical_paths.init_trace_worker(), from Flood_path.worker_args()
+        transform (any): Affine transform of the raster
+        traces_name (str): Name of the shared memory block with the TRACE_ARRAYS of Flood_path.traces
+        layout (list[tuple]): Layout of the block from critical_paths.share_arrays()
+        modes (dict): 'duplicate_paths' and 'first_point' of Flood_path.traces
+    """
+    global worker_flood_path, worker_traces_memory
+    critical_paths.init_trace_worker(*raster_args)
+    worker_flood_path = Flood_path.from_array(critical_paths.worker_raster, transform)
+    # sinks can't be sent to worker processes, and the workers don't report
+    worker_flood_path.recorder = instrumentation.Recorder(memory=None, progress=None)
+    worker_traces_memory = shared_memory.SharedMemory(name=traces_name)
+    worker_flood_path.traces = critical_paths.attach_arrays(worker_traces_memory, layout)
+    worker_flood_path.traces.update(modes)
+
+
+def resolve_point(task: dict) -> list[dict]:
+    """Merges the traced paths of one grid point with Flood_path.resolve(), and collects its statistics like Stats.
+
+    Args:
+        task (dict): 'params' of the grid point, 'crit' with the scenario as key and critical percentage of its candidates as value,
+            and 'select_time' of the selection
+
+    Returns:
+        list[dict]: Row of the results table for every scenario
+    """
+    flood_path = worker_flood_path
+    flood_path.traces['scenarios'] = task['crit']
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        flood_path.resolve(as_arcpy=False)
+    resolve_time = time.perf_counter() - start
+    rows = []
+    for q, crit in task['crit'].items():
+        accuracy = flood_path.scenario_accuracy[q]
+        critical = flood_path.scenario_num[q]
+        row = dict(task['params'])
+        row['slope'] = np.nan if row['slope'] == None else float(row['slope'])
+        row.update({'q': q, 'candidates': len(crit), 'critical': critical, 'percent': critical / len(crit) * 100 if len(crit) > 0 else np.nan,
+                    'build_inter': accuracy['build_inter'], 'road_inter': accuracy['road_inter'],
+                    'mean_crit': np.nan if accuracy['mean_crit'] == None else accuracy['mean_crit'],
+                    'select_time': task['select_time'], 'resolve_time': resolve_time})
+        rows.append(row)
+    return rows
+
+
+def sweep_river(river: River, flood_path: Flood_path, points: list[dict], duplicate_paths: bool = True, first_point: bool = False, workers: int = 1) -> list[dict]:
+    """Runs the grid points that share an analyzed river. The river needs the union of the distances of the grid points,
+    and the flow paths of all their candidate points are traced once.
+
+    Args:
+        river (River): River after River.full_analysis(), with the bank coordinates in river.data.bank_xy, projected with raster_coordinates()
+        flood_path (Flood_path): Flood path object of the flow raster
+        points (list[dict]): Grid points from grid_points()
+        duplicate_paths (bool, optional): Mode of Flood_path.analyze(). Defaults to True, like main.py.
+        first_point (bool, optional): Mode of Flood_path.analyze(). Defaults to False.
+        workers (int, optional): Worker processes for the tracing and for the grid points. Defaults to 1 = run here.
+
+    Returns:
+        list[dict]: Rows of the results table
+    """
+    recorder = river.recorder
+    scenarios = list(river.scenarios)
+    tasks = []
+    profiles = {}
+    with recorder.stage('sweep_select'):
+        for params in points:
+            start = time.perf_counter()
+            distances = point_distances(params['transect_width'], params['transect_point_space'])
+            if distances not in profiles:
+                profiles[distances] = river if distances == tuple(river.distance_tupl) else river.with_distances(distances)
+            crit = profiles[distances].find_critical_points(scenarios, params['slope'], params['dynamic'])
+            tasks.append({'params': params, 'crit': crit, 'select_time': time.perf_counter() - start})
+
+    # the candidates of all grid points, found in the flow raster from their coordinates like service.py
+    with recorder.stage('sweep_trace'):
+        candidates = np.fromiter(set(x for task in tasks for crit in task['crit'].values() for x in crit), dtype=np.int64)
+        oid = river.data.bank_oid.reshape(-1)
+        xy = river.data.bank_xy.reshape(-1, 2)
+        keep = np.isin(oid, candidates)
+        order = np.argsort(oid[keep], kind='stable')
+        keys, starts = flood_path.cell_index(oid[keep][order], raster_coordinates(river, flood_path, xy[keep][order]))
+        print(f"Sweeping {len(tasks)} grid points with {len(keys)} candidate points")
+        flood_path.trace_points((keys, starts), {None: None}, duplicate_paths, first_point, workers)
+
+    with recorder.stage('sweep_resolve'):
+        if workers <= 1 or len(tasks) < 2:
+            global worker_flood_path
+            worker_flood_path = flood_path
+            results = [resolve_point(x) for x in tasks]
+        else:
+            # the traces go to the workers by the name of their shared memory, not pickled for each
+            memory, layout = critical_paths.share_arrays({x: flood_path.traces[x] for x in TRACE_ARRAYS})
+            modes = {x: flood_path.traces[x] for x in ('duplicate_paths', 'first_point')}
+            try:
+                initargs = (flood_path.worker_args(workers), flood_path.transform, memory.name, layout, modes)
+                with ProcessPoolExecutor(max_workers=workers, initializer=init_sweep_worker, initargs=initargs) as pool:
+                    results = list(pool.map(resolve_point, tasks))
+            finally:
+                critical_paths.release_memory(memory)
+    rows = [row for result in results for row in result]
+    for row in rows:
+        row['trace_time'] = flood_path.trace_time
+    return rows
+
+
+def table(rows: list[dict]) -> dict[str: np.ndarray]:
+    """Turns rows of results into a columnar table, with a column for every key."""
+    if len(rows) == 0:
+        return {}
+    return {name: np.array([row[name] for row in rows]) for name in rows[0]}
+
+
+def write_table(results: dict[str: np.ndarray], path: str) -> None:
+    """Writes a results table as CSV, or as Parquet, which needs pyarrow.
+
+    Args:
+        results (dict[str: np.ndarray]): Output from table()
+        path (str): Output file ending in .csv or .parquet
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.parquet':
+        if pyarrow == None:
+            raise ValueError("Writing Parquet needs pyarrow")
+        pyarrow.parquet.write_table(pyarrow.table({x: y for x, y in results.items()}), path)
+    elif extension == '.csv':
+        with open(path, 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(list(results))
+            w.writerows(zip(*(x.tolist() for x in results.values())))
+    else:
+        raise ValueError(f"Unknown format '{extension}', use .csv or .parquet")
+
+
+def run(workspace: str, river_name: str, river_feature: str, dem: str, raster: str, scenarios: dict[int: str], grid: dict[str: list],
+        duplicate_paths: bool = True, first_point: bool = False, workers: int = 1, bank_backend: str = 'arcpy', memory_budget: int = None,
+        output: str = None) -> dict[str: np.ndarray]:
+    """Runs the analysis for every point of a parameter grid. The geometry is analyzed once for every transect_space,
+    and the flow raster is read once for the whole sweep.
+
+    Args:
+        workspace (str): Path to gdb
+        river_name (str): Name for output
+        river_feature (str): Name of river polygon in gdb
+        dem (str): Name of DEM in gdb
+        raster (str): Name or path to raster with D8 and vector layers
+        scenarios (dict[int: str]): Return period as key and name or path of the water surface raster as value
+        grid (dict[str: list]): Parameter as key and the values to try as value, see grid_points()
+        duplicate_paths (bool, optional): Mode of Flood_path.analyze(). Defaults to True, like main.py.
+        first_point (bool, optional): Mode of Flood_path.analyze(). Defaults to False.
+        workers (int, optional): Worker processes for the geometry, tracing and grid points. Defaults to 1.
+        bank_backend (str, optional): Bank sampling of River.full_analysis(). Defaults to 'arcpy'.
+        memory_budget (int, optional): Bytes for raster tiles, see Flood_path. Defaults to None = read all.
+        output (str, optional): .csv or .parquet file for the results. Defaults to None.
+
+    Returns:
+        dict[str: np.ndarray]: Results table with the parameters, scenario, 'candidates', 'critical', 'percent', 'build_inter',
+        'road_inter', 'mean_crit', and 'geom_time', 'trace_time', 'select_time' and 'resolve_time' in seconds
+    """
+    points = grid_points(grid)
+    rows = []
+    with Flood_path(workspace, raster, None, memory_budget) as flood_path:
+        for space in sorted(set(x['transect_space'] for x in points)):
+            group = [x for x in points if x['transect_space'] == space]
+            distances = sorted(set(y for x in group for y in point_distances(x['transect_width'], x['transect_point_space'])))
+            print(f"Analyzing transect space {space} with {len(distances)} distances for {len(group)} grid points")
+            river = River(workspace, river_name, river_feature, dem)
+            river.distance_tupl = tuple(distances)
+            river.point_distance = space
+            geom_st = time.perf_counter()
+            river.full_analysis(bank_backend, workers=workers, scenarios=scenarios)
+            geom_time = time.perf_counter() - geom_st
+            for row in sweep_river(river, flood_path, group, duplicate_paths, first_point, workers):
+                row['geom_time'] = geom_time
+                rows.append(row)
+    results = table(rows)
+    if output != None:
+        write_table(results, output)
+    return results
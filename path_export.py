@@ -0,0 +1,252 @@
+"""
+Bulk export of flow paths to open formats, without arcpy. Flood_path.export() uses this for outputs ending in
+.gpkg, .fgb or .parquet, and the gdb writer with arcpy for everything else.
+
+Paths are handled as one array of coordinates with offsets, so path i is coords[offsets[i]:offsets[i+1]],
+and D8 paths are simplified to the vertices where the direction changes before they are written.
+    .gpkg       GeoPackage, written with sqlite3 from the standard library
+    .fgb        FlatGeobuf, needs pyogrio
+    .parquet    GeoParquet, needs pyarrow
+"""
+import json
+import os
+import sqlite3
+import struct
+import numpy as np
+from rasterio.crs import CRS
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError: # only needed for GeoParquet
+    pyarrow = None
+try:
+    import pyogrio.raw
+except ImportError: # only needed for FlatGeobuf
+    pyogrio = None
+
+
+def path_arrays(paths: dict[int: list]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Joins flow paths to one array of coordinates.
+
+    Args:
+        paths (dict[int: list]): Output from Flood_path.analyze() with as_arcpy=False, point ID as key and coordinates and critical percentage as value
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Point IDs, critical percentages, coordinates with shape (vertices, 2), and offsets
+    """
+    ids = np.array(list(paths), dtype=np.int64)
+    crit = np.array([paths[x][1] for x in paths], dtype=np.int64)
+    lines = [np.asarray(paths[x][0], dtype=np.float64).reshape(-1, 2) for x in paths]
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in lines], out=offsets[1:])
+    coords = np.concatenate(lines) if len(lines) > 0 else np.zeros((0, 2))
+    return ids, crit, coords, offsets
+
+
+def simplify_lines(coords: np.ndarray, offsets: np.ndarray, tolerance: float = 1e-9) -> tuple[np.ndarray, np.ndarray]:
+    """Removes repeated vertices and vertices in the middle of straight runs, like the cells of a D8 path between two
+    changes of direction. The first and last vertex of every line are kept.
+
+    Args:
+        coords (np.ndarray): Coordinates with shape (vertices, 2)
+        offsets (np.ndarray): Line i is coords[offsets[i]:offsets[i+1]]
+        tolerance (float, optional): Sine of the angle between two steps below which they are straight. Defaults to 1e-9.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Coordinates and offsets of the simplified lines
+    """
+    lengths = np.diff(offsets)
+    line = np.repeat(np.arange(len(lengths)), lengths)
+    first = np.zeros(len(coords), dtype=bool)
+    first[offsets[:-1][lengths > 0]] = True
+    repeated = np.zeros(len(coords), dtype=bool)
+    repeated[1:] = (coords[1:] == coords[:-1]).all(axis=1)
+    keep = ~repeated | first
+    coords, line = coords[keep], line[keep]
+    first = first[keep]
+    last = np.zeros(len(coords), dtype=bool)
+    last[:-1] = first[1:]
+    last[-1:] = True
+
+    step = np.diff(coords, axis=0)
+    before, after = step[:-1], step[1:]
+    cross = before[:, 0] * after[:, 1] - before[:, 1] * after[:, 0]
+    dot = (before * after).sum(axis=1)
+    size = np.hypot(*before.T) * np.hypot(*after.T)
+    straight = np.zeros(len(coords), dtype=bool)
+    straight[1:-1] = (np.abs(cross) <= tolerance * size) & (dot > 0)
+    keep = ~straight | first | last
+    new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(line[keep], minlength=len(lengths)), out=new_offsets[1:])
+    return coords[keep], new_offsets
+
+
+def linestring_wkb(coords: np.ndarray, offsets: np.ndarray) -> list[bytes]:
+    """Little endian WKB of every line. A line of one vertex, like the path of a critical start cell or from first_point,
+    is written as a degenerate line with the vertex twice, since a LineString needs at least two points.
+
+    Args:
+        coords (np.ndarray): Coordinates with shape (vertices, 2)
+        offsets (np.ndarray): Line i is coords[offsets[i]:offsets[i+1]]
+
+    Returns:
+        list[bytes]: WKB LineString of every line
+    """
+    data = np.ascontiguousarray(coords, dtype='<f8').tobytes()
+    blobs = []
+    for start, stop in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        if stop - start == 1:
+            blobs.append(struct.pack('<BII', 1, 2, 2) + data[start*16:stop*16] * 2)
+        else:
+            blobs.append(struct.pack('<BII', 1, 2, stop - start) + data[start*16:stop*16])
+    return blobs
+
+
+def line_bounds(coords: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Min x, max x, min y and max y of every line, with shape (lines, 4). Lines need at least one vertex."""
+    if len(offsets) < 2:
+        return np.zeros((0, 4))
+    starts = offsets[:-1]
+    x_min, y_min = np.minimum.reduceat(coords, starts).T
+    x_max, y_max = np.maximum.reduceat(coords, starts).T
+    return np.column_stack((x_min, x_max, y_min, y_max))
+
+
+def crs_parts(crs: any) -> tuple[int, str]:
+    """EPSG code and WKT of a rasterio CRS, EPSG code or WKT string, (None, None) if crs is None."""
+    if crs == None:
+        return None, None
+    crs = CRS.from_epsg(crs) if isinstance(crs, int) else CRS.from_user_input(crs)
+    return crs.to_epsg(), crs.to_wkt()
+
+
+def write_gpkg(path: str, ids: np.ndarray, crit: np.ndarray, coords: np.ndarray, offsets: np.ndarray, crs: any = None, layer: str = 'flow_paths') -> None:
+    """Writes lines to a new GeoPackage layer in one transaction.
+
+    Args:
+        path (str): GeoPackage file, replaced if it exists
+        ids (np.ndarray): Point ID of every line, written as point_id
+        crit (np.ndarray): Critical percentage of every line, written as crit_percent
+        coords (np.ndarray): Coordinates with shape (vertices, 2)
+        offsets (np.ndarray): Line i is coords[offsets[i]:offsets[i+1]]
+        crs (any, optional): rasterio CRS, EPSG code or WKT. Defaults to None = undefined.
+        layer (str, optional): Name of the table. Defaults to 'flow_paths'.
+    """
+    epsg, wkt = crs_parts(crs)
+    srs_id = -1 if wkt == None else (epsg if epsg != None else 100000)
+    if os.path.exists(path):
+        os.remove(path)
+    bounds = line_bounds(coords, offsets)
+    header = struct.pack('<2sBBi', b'GP', 0, 0b011, srs_id)
+    blobs = [header + struct.pack('<4d', *box) + wkb for box, wkb in zip(bounds.tolist(), linestring_wkb(coords, offsets))]
+    extent = (coords[:, 0].min(), coords[:, 1].min(), coords[:, 0].max(), coords[:, 1].max()) if len(coords) > 0 else (None,) * 4
+    with sqlite3.connect(path) as connection:
+        connection.execute("PRAGMA application_id = 1196444487")
+        connection.execute("PRAGMA user_version = 10200")
+        connection.executescript("""
+            CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,
+                organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+            CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '',
+                last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                srs_id INTEGER, CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+            CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+                srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name));
+        """)
+        srs = [('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined'), ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined'),
+               ('WGS 84 geodetic', 4326, 'EPSG', 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]')]
+        if srs_id not in (-1, 0, 4326):
+            srs.append(('flow raster', srs_id, 'EPSG' if epsg != None else 'NONE', epsg if epsg != None else srs_id, wkt))
+        connection.executemany("INSERT INTO gpkg_spatial_ref_sys (srs_name, srs_id, organization, organization_coordsys_id, definition) VALUES (?, ?, ?, ?, ?)", srs)
+        connection.execute(f'CREATE TABLE "{layer}" (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom LINESTRING, point_id INTEGER, crit_percent INTEGER)')
+        connection.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, max_y, srs_id) VALUES (?, 'features', ?, ?, ?, ?, ?, ?)",
+                           (layer, layer, *extent, srs_id))
+        connection.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'LINESTRING', ?, 0, 0)", (layer, srs_id))
+        connection.executemany(f'INSERT INTO "{layer}" (geom, point_id, crit_percent) VALUES (?, ?, ?)', zip(blobs, ids.tolist(), crit.tolist()))
+    connection.close()
+
+
+def write_geoparquet(path: str, ids: np.ndarray, crit: np.ndarray, coords: np.ndarray, offsets: np.ndarray, crs: any = None) -> None:
+    """Writes lines to a GeoParquet file with WKB geometry. Needs pyarrow.
+
+    Args:
+        path (str): Parquet file
+        ids (np.ndarray): Point ID of every line
+        crit (np.ndarray): Critical percentage of every line
+        coords (np.ndarray): Coordinates with shape (vertices, 2)
+        offsets (np.ndarray): Line i is coords[offsets[i]:offsets[i+1]]
+        crs (any, optional): rasterio CRS, EPSG code or WKT. Defaults to None = undefined.
+    """
+    if pyarrow == None:
+        raise ValueError("Writing GeoParquet needs pyarrow")
+    column = {'encoding': 'WKB', 'geometry_types': ['LineString']}
+    if len(coords) > 0:
+        column['bbox'] = [float(coords[:, 0].min()), float(coords[:, 1].min()), float(coords[:, 0].max()), float(coords[:, 1].max())]
+    # GeoParquet reads a missing crs as longitude and latitude, so an unknown crs is written as null
+    column['crs'] = None
+    if crs != None:
+        column['crs'] = (CRS.from_epsg(crs) if isinstance(crs, int) else CRS.from_user_input(crs)).to_dict(projjson=True)
+    table = pyarrow.table({'point_id': pyarrow.array(ids, pyarrow.int64()), 'crit_percent': pyarrow.array(crit, pyarrow.int64()),
+                           'geometry': pyarrow.array(linestring_wkb(coords, offsets), pyarrow.binary())})
+    metadata = {'version': '1.0.0', 'primary_column': 'geometry', 'columns': {'geometry': column}}
+    table = table.replace_schema_metadata({b'geo': json.dumps(metadata).encode()})
+    pyarrow.parquet.write_table(table, path)
+
+
+def write_flatgeobuf(path: str, ids: np.ndarray, crit: np.ndarray, coords: np.ndarray, offsets: np.ndarray, crs: any = None) -> None:
+    """Writes lines to a FlatGeobuf file with a spatial index. Needs pyogrio.
+
+    Args:
+        path (str): FlatGeobuf file
+        ids (np.ndarray): Point ID of every line
+        crit (np.ndarray): Critical percentage of every line
+        coords (np.ndarray): Coordinates with shape (vertices, 2)
+        offsets (np.ndarray): Line i is coords[offsets[i]:offsets[i+1]]
+        crs (any, optional): rasterio CRS, EPSG code or WKT. Defaults to None = undefined.
+    """
+    if pyogrio == None:
+        raise ValueError("Writing FlatGeobuf needs pyogrio")
+    geometry = np.array(linestring_wkb(coords, offsets), dtype=object)
+    pyogrio.raw.write(path, geometry, [ids, crit], ['point_id', 'crit_percent'], driver='FlatGeobuf',
+                      geometry_type='LineString', crs=crs_parts(crs)[1])
+
+
+WRITERS = {'.gpkg': write_gpkg, '.fgb': write_flatgeobuf, '.parquet': write_geoparquet}
+
+
+def write_paths(paths: dict[int: list], path: str, crs: any = None, simplify: bool = True) -> int:
+    """Writes flow paths to the format of the file extension, see WRITERS.
+
+    Args:
+        paths (dict[int: list]): Output from Flood_path.analyze() with as_arcpy=False
+        path (str): Output file ending in .gpkg, .fgb or .parquet
+        crs (any, optional): rasterio CRS, EPSG code or WKT. Defaults to None = undefined.
+        simplify (bool, optional): Keep only the vertices where a path changes direction, see simplify_lines(). Defaults to True.
+
+    Returns:
+        int: Number of vertices written
+    """
+    return write_lines(path, *path_arrays(paths), crs, simplify)
+
+
+def write_lines(path: str, ids: np.ndarray, crit: np.ndarray, coords: np.ndarray, offsets: np.ndarray, crs: any = None, simplify: bool = True) -> int:
+    """Writes lines that are already one array of coordinates with offsets, like Flood_path.resolved, see write_paths().
+
+    Args:
+        path (str): Output file ending in .gpkg, .fgb or .parquet
+        ids (np.ndarray): Point ID of every line
+        crit (np.ndarray): Critical percentage of every line
+        coords (np.ndarray): Coordinates with shape (vertices, 2)
+        offsets (np.ndarray): Line i is coords[offsets[i]:offsets[i+1]]
+        crs (any, optional): rasterio CRS, EPSG code or WKT. Defaults to None = undefined.
+        simplify (bool, optional): Keep only the vertices where a path changes direction. Defaults to True.
+
+    Returns:
+        int: Number of vertices written
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError(f"Unknown format '{extension}', use one of {tuple(WRITERS)}")
+    if simplify:
+        coords, offsets = simplify_lines(coords, offsets)
+    WRITERS[extension](path, ids, crit, coords, offsets, crs)
+    return len(coords)
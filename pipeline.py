@@ -0,0 +1,241 @@
+"""
+Pipelined run of the geometry analysis and flow tracing, where the stages of different batches of points overlap.
+The points are split in batches with River.partition(), and every batch goes through three stages that run in
+their own threads, connected by bounded queues:
+    sample      bank points along the transects of the batch and DEM sampling, bank_sampling.py
+    select      gradient, cross-section and longest water, and River.find_critical_points() of the batch
+    trace       Flood_path.trace() of the candidate points of the batch
+So the DEM is read for the next batches while the critical points of one batch are selected and the candidates of
+the batch before are traced. rasterio and most of numpy release the GIL, so the stages run at the same time.
+A full queue blocks the stage before it, which bounds the batches in memory to about the queue sizes.
+
+Paths are merged with Flood_path.resolve() once all batches are traced, in the order of the point IDs like
+Flood_path.import_data(), so the result is the same as River.full_analysis() and Flood_path.analyze_scenarios().
+
+    river.prepare_analysis(scenarios)
+    paths = pipeline.run(river, flood_path, duplicate_paths=True)
+
+The bank points are found in the flow raster from self.data.bank_xy, like service.py, so the river and the flow raster need the same crs.
+"""
+import queue
+import threading
+import time
+import numpy as np
+from river_geometry import River
+from critical_paths import Flood_path, gather_ranges
+
+# ends the items of a queue
+DONE = None
+
+
+def stage(function: callable, inbox: queue.Queue, outbox: queue.Queue, busy: dict, name: str, threads: int = 1) -> list[threading.Thread]:
+    """Starts threads that put function(item) in outbox for every item in inbox, until DONE, which is passed on by the last thread.
+    An exception is passed on in place of the item, and the rest of inbox is read and dropped, so the stages before don't block.
+
+    Args:
+        function (callable): Function of one item
+        inbox (queue.Queue): Items in
+        outbox (queue.Queue): Results out
+        busy (dict): Seconds spent in function, added to busy[name]
+        name (str): Name of the stage
+        threads (int, optional): Number of threads. Defaults to 1.
+
+    Returns:
+        list[threading.Thread]: The started threads
+    """
+    remaining = [threads]
+    lock = threading.Lock()
+
+    def work():
+        failed = False
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                break
+            if failed:
+                continue
+            if isinstance(item, BaseException):
+                failed = True
+                outbox.put(item)
+                continue
+            start = time.perf_counter()
+            try:
+                result = function(item)
+            except BaseException as error:
+                failed = True
+                result = error
+            with lock:
+                busy[name] = busy.get(name, 0.0) + time.perf_counter() - start
+            outbox.put(result)
+        # the other threads of the stage also need to see the end
+        inbox.put(DONE)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            outbox.put(DONE)
+
+    workers = [threading.Thread(target=work, name=f'pipeline_{name}', daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def merge_traces(batches: list[dict]) -> tuple[np.ndarray]:
+    """Puts the traces of all batches together, sorted by point ID.
+
+    Args:
+        batches (list[dict]): 'keys', 'starts', 'traced' and 'trace' from Flood_path.trace() of every batch
+
+    Returns:
+        tuple[np.ndarray]: Keys, starts and traced of all points, and the trace like Flood_path.trace() with the traced points in key order
+    """
+    keys = np.concatenate([np.zeros(0, dtype=np.int64)] + [x['keys'] for x in batches])
+    starts = np.concatenate([np.zeros((0, 2), dtype=np.int64)] + [x['starts'] for x in batches])
+    traced = np.concatenate([np.zeros(0, dtype=bool)] + [x['traced'] for x in batches])
+    parts = [x['trace'] for x in batches if len(x['trace'][3]) > 1]
+    if len(parts) == 0:
+        trace = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int16), np.zeros(1, dtype=np.int64))
+        parts = [trace]
+    rows, cols, targets = (np.concatenate([x[i] for x in parts]) for i in range(3))
+    lengths = np.concatenate([np.diff(x[3]) for x in parts])
+    first = np.zeros(len(lengths), dtype=np.int64)
+    first[1:] = np.cumsum(lengths)[:-1]
+    # traced points in the order of their batch, and then in key order
+    traced_keys = keys[traced]
+    order = np.argsort(traced_keys, kind='stable')
+    cells = gather_ranges(first[order], lengths[order])
+    offsets = np.zeros(len(order)+1, dtype=np.int64)
+    np.cumsum(lengths[order], out=offsets[1:])
+    point_order = np.argsort(keys, kind='stable')
+    return keys[point_order], starts[point_order], traced[point_order], (rows[cells], cols[cells], targets[cells], offsets)
+
+
+def run(river: River, flood_path: Flood_path, duplicate_paths: bool = False, first_point: bool = False, workers: int = 1,
+        batch_points: int = None, readers: int = 2, queue_size: int = 2, sample_method: str = 'nearest', dem_path: str = None,
+        write_points: bool = True, as_arcpy: bool = True) -> dict[int: dict[int: any]]:
+    """Runs the bank sampling, geometry, critical point selection and flow tracing of a river with overlapping stages.
+    Needs River.prepare_analysis() first, and samples the DEM like River.add_river_bank_native().
+    self.data of the river gets the same values as from River.full_analysis(), and the flood path the same traces as from
+    Flood_path.analyze_scenarios(), with the critical points of each scenario in flood_path.scenario_points.
+
+    Args:
+        river (River): River after River.prepare_analysis()
+        flood_path (Flood_path): Flood path object of the flow raster
+        duplicate_paths (bool, optional): Mode of Flood_path.analyze(). Defaults to False.
+        first_point (bool, optional): Mode of Flood_path.analyze(). Defaults to False.
+        workers (int, optional): Worker processes for tracing, started once and used by every batch. Defaults to 1 = trace in the trace thread.
+        batch_points (int, optional): Max number of points in a batch, see River.partition(). Defaults to None, which gives about 16 batches.
+        readers (int, optional): Threads that sample the DEM. Defaults to 2.
+        queue_size (int, optional): Batches that can wait between two stages. Defaults to 2.
+        sample_method (str, optional): 'nearest' or 'bilinear' sampling of the DEM. Defaults to 'nearest'.
+        dem_path (str, optional): Path to the DEM if GDAL can't read river.dem in the gdb. Defaults to None.
+        write_points (bool, optional): Write river.side_points_elev when all batches are done. Defaults to True.
+        as_arcpy (bool, optional): Return paths as arcpy arrays, see Flood_path.analyze_scenarios(). Defaults to True.
+
+    Returns:
+        dict[int: dict[int: any]]: Output like Flood_path.analyze_scenarios()
+    """
+    recorder = river.recorder
+    scenarios = list(river.scenarios)
+    names = tuple(f'Q{q}' for q in scenarios)
+    with recorder.stage('pipeline'):
+        orig_id, ends, edges = river.read_transects()
+        # built before the threads start, since subsets copy them from river.data.cache
+        river.segment_index()
+        river.chainage()
+        chunks = river.partition(4, batch_points)
+        transects = river.chunk_transects(chunks, orig_id, ends)
+        print(f"Running {len(chunks)} batches in a pipeline")
+
+        def sample(i):
+            rows, _, segments = chunks[i]
+            batch = river.subset(rows, segments)
+            points, values = batch.sample_banks(transects[i]['ends'], edges, sample_method, dem_path)
+            batch.set_bank_points(transects[i]['orig_id'], points, values, transects[i]['ordinal'])
+            return {'index': i, 'river': batch, 'points': points, 'values': values}
+
+        def select(item):
+            batch = item['river']
+            for segment in batch.segment_index():
+                batch.calculate_gradient(segment)
+                batch.add_xsection_data(segment)
+            batch.add_longest_water(names)
+            crit = batch.find_critical_points(scenarios)
+            # only the bank points of the points the batch owns, the others belong to the batches next to it
+            own = chunks[item['index']][1]
+            oid = batch.data.bank_oid[own].reshape(-1)
+            xy = batch.data.bank_xy[own].reshape(-1, 2)
+            keep = oid >= 0
+            oid, xy = oid[keep], xy[keep]
+            owned = set(oid.tolist())
+            item['crit'] = {q: {x: y for x, y in crit[q].items() if x in owned} for q in scenarios}
+            candidate = np.isin(oid, np.fromiter(set(x for q in scenarios for x in item['crit'][q]), dtype=np.int64))
+            item['keys'], item['xy'] = oid[candidate], xy[candidate]
+            batch.data.cache = {}
+            return item
+
+        def trace(item):
+            keys, starts = flood_path.cell_index(item['keys'], item['xy'])
+            order = np.argsort(keys, kind='stable')
+            keys, starts = keys[order], starts[order]
+            traced = flood_path.may_be_critical(starts, duplicate_paths or first_point)
+            item['keys'], item['starts'], item['traced'] = keys, starts, traced
+            item['trace'] = flood_path.trace(starts[traced], workers, pool=pool)
+            return item
+
+        # one pool for all batches, so the workers and their raster are set up once
+        pool = flood_path.trace_pool(workers) if workers > 1 else None
+        busy = {}
+        tasks, sampled, selected, done = (queue.Queue(maxsize=queue_size) for _ in range(4))
+        stage(sample, tasks, sampled, busy, 'sample', readers)
+        stage(select, sampled, selected, busy, 'select')
+        stage(trace, selected, done, busy, 'trace')
+
+        def feed():
+            for i in range(len(chunks)):
+                tasks.put(i)
+            tasks.put(DONE)
+
+        threading.Thread(target=feed, name='pipeline_feed', daemon=True).start()
+        batches = [None] * len(chunks)
+        error = None
+        count = 0
+        while True:
+            item = done.get()
+            if item is DONE:
+                break
+            if isinstance(item, BaseException):
+                error = item
+                continue
+            batches[item['index']] = item
+            count += 1
+            recorder.progress("Pipeline batch", count, len(chunks))
+        if pool != None:
+            pool.shutdown()
+        if error != None:
+            raise error
+
+        # every point is written only by the batch that owns it, in batch order, like River.parallel_analysis()
+        for (rows, own, _), batch in zip(chunks, batches):
+            river.data.put(rows, batch['river'].data, own)
+        if write_points:
+            points = np.full((len(orig_id), len(river.distance_tupl), 2, 2), np.nan)
+            values = np.full((len(orig_id), len(river.distance_tupl), 2), np.nan)
+            for transect, batch in zip(transects, batches):
+                points[transect['ordinal']] = batch['points']
+                values[transect['ordinal']] = batch['values']
+            river.write_bank_points(orig_id, points, values)
+
+        crit = {q: {x: y for batch in batches for x, y in batch['crit'][q].items()} for q in scenarios}
+        flood_path.crit_points = {x: y for q in crit for x, y in crit[q].items()}
+        keys, starts, traced, traces = merge_traces(batches)
+        wanted = np.ones(len(keys), dtype=bool)
+        flood_path.store_traces(keys, starts, wanted, traced, traces, crit, duplicate_paths, first_point)
+        flood_path.workers = workers
+        flood_path.trace_time = busy.get('trace', 0.0)
+        for name, seconds in busy.items():
+            recorder.count(f'pipeline_{name}_busy_time', seconds)
+        recorder.count('pipeline_batches', len(chunks))
+    with recorder.stage('resolve_paths'):
+        return flood_path.resolve(as_arcpy)
@@ -0,0 +1,127 @@
+"""
+Bulk import of the bank points that Flood_path traces from, as arrays of IDs and coordinates.
+Flood_path.import_data() reads points with this, from:
+    .gpkg       GeoPackage point layer, read with sqlite3 from the standard library
+    .parquet    GeoParquet with WKB points, or x and y columns, needs pyarrow
+    other       feature class in the arcpy workspace, read at once with FeatureClassToNumPyArray
+"""
+import json
+import os
+import sqlite3
+import struct
+import numpy as np
+try:
+    import arcpy
+except ImportError: # files are read without ArcGIS
+    arcpy = None
+try:
+    import pyarrow.parquet
+except ImportError: # only needed for GeoParquet
+    pyarrow = None
+
+
+def wkb_points(blobs: list[bytes]) -> np.ndarray:
+    """x and y of WKB points, 2D or with z or m, in either byte order.
+
+    Args:
+        blobs (list[bytes]): WKB of every point
+
+    Returns:
+        np.ndarray: Coordinates with shape (points, 2), NaN for empty points
+    """
+    xy = np.full((len(blobs), 2), np.nan)
+    for i, blob in enumerate(blobs):
+        if blob == None or len(blob) < 21:
+            continue
+        xy[i] = struct.unpack('<2d' if blob[0] == 1 else '>2d', blob[5:21])
+    return xy
+
+
+def gpkg_geometry_wkb(blob: bytes) -> bytes:
+    """WKB of a GeoPackage geometry blob, without the header and envelope."""
+    flags = blob[3]
+    envelope = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}.get((flags >> 1) & 0b111, 0)
+    return blob[8+envelope:]
+
+
+def read_gpkg(path: str, layer: str = None, id_field: str = None) -> tuple[np.ndarray, np.ndarray]:
+    """Reads the points of a GeoPackage layer.
+
+    Args:
+        path (str): GeoPackage file
+        layer (str, optional): Table of the points. Defaults to None = the first features table.
+        id_field (str, optional): Field with the point IDs. Defaults to None = the primary key.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: IDs and coordinates with shape (points, 2)
+    """
+    with sqlite3.connect(path) as connection:
+        if layer == None:
+            layer = connection.execute("SELECT table_name FROM gpkg_contents WHERE data_type = 'features' LIMIT 1").fetchone()[0]
+        geometry = connection.execute("SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?", (layer,)).fetchone()[0]
+        if id_field == None:
+            id_field = next(x[1] for x in connection.execute(f'PRAGMA table_info("{layer}")') if x[5] > 0)
+        rows = connection.execute(f'SELECT "{id_field}", "{geometry}" FROM "{layer}"').fetchall()
+    connection.close()
+    ids = np.array([x[0] for x in rows], dtype=np.int64)
+    return ids, wkb_points([gpkg_geometry_wkb(x[1]) if x[1] != None else None for x in rows])
+
+
+def read_parquet(path: str, id_field: str = 'OBJECTID') -> tuple[np.ndarray, np.ndarray]:
+    """Reads the points of a GeoParquet file, or of a Parquet file with x and y columns. Needs pyarrow.
+
+    Args:
+        path (str): Parquet file
+        id_field (str, optional): Column with the point IDs. Defaults to 'OBJECTID'.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: IDs and coordinates with shape (points, 2)
+    """
+    if pyarrow == None:
+        raise ValueError("Reading Parquet needs pyarrow")
+    table = pyarrow.parquet.read_table(path)
+    ids = table.column(id_field).to_numpy().astype(np.int64)
+    if 'x' in table.column_names and 'y' in table.column_names:
+        return ids, np.column_stack((table.column('x').to_numpy(), table.column('y').to_numpy())).astype(np.float64)
+    metadata = table.schema.metadata or {}
+    geometry = 'geometry'
+    if b'geo' in metadata:
+        geometry = json.loads(metadata[b'geo'])['primary_column']
+    return ids, wkb_points(table.column(geometry).to_pylist())
+
+
+def read_feature_class(name: str, id_field: str = 'OID@') -> tuple[np.ndarray, np.ndarray]:
+    """Reads the points of a feature class in the arcpy workspace with one FeatureClassToNumPyArray call.
+
+    Args:
+        name (str): Feature class
+        id_field (str, optional): Field with the point IDs. Defaults to 'OID@' = OBJECTID.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: IDs and coordinates with shape (points, 2)
+    """
+    if arcpy == None:
+        raise ValueError(f"Reading the feature class '{name}' needs arcpy, use a GeoPackage or Parquet file")
+    table = arcpy.da.FeatureClassToNumPyArray(name, [id_field, 'SHAPE@X', 'SHAPE@Y'], null_value={'SHAPE@X': np.nan, 'SHAPE@Y': np.nan})
+    return table[id_field].astype(np.int64), np.column_stack((table['SHAPE@X'], table['SHAPE@Y'])).astype(np.float64)
+
+
+def read_points(source: str, id_field: str = None) -> tuple[np.ndarray, np.ndarray]:
+    """Reads all points of a source, sorted by ID.
+
+    Args:
+        source (str): GeoPackage, Parquet file or feature class, see the module docstring
+        id_field (str, optional): Field with the point IDs. Defaults to None = OBJECTID, or the primary key of a GeoPackage.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: IDs and coordinates with shape (points, 2)
+    """
+    extension = os.path.splitext(source)[1].lower()
+    if extension == '.gpkg':
+        ids, xy = read_gpkg(source, id_field=id_field)
+    elif extension == '.parquet':
+        ids, xy = read_parquet(source, 'OBJECTID' if id_field == None else id_field)
+    else:
+        ids, xy = read_feature_class(source, 'OID@' if id_field == None else id_field)
+    order = np.argsort(ids, kind='stable')
+    return ids[order], xy[order]
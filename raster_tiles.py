@@ -0,0 +1,134 @@
+from collections import OrderedDict
+import numpy as np
+from rasterio.windows import Window
+
+
+class Tiled_raster:
+    """Read-only view of a raster that reads square tiles on demand through rasterio windows.
+    Tiles are kept in a least recently used cache that is bounded by a memory budget.
+    Indexing with [band, rows, cols] works like on the array from dataset.read().
+    """
+
+    def __init__(self, dataset: any, tile_size: int = 512, memory_budget: int = 256 * 2**20) -> None:
+        """Create a tiled view of an open raster.
+
+        Args:
+            dataset (any): Open rasterio dataset
+            tile_size (int, optional): Width and height of tiles in cells. Defaults to 512.
+            memory_budget (int, optional): Bytes the tile cache can use. At least one tile is always kept. Defaults to 256 MB.
+        """
+        self.dataset = dataset
+        self.tile_size = tile_size
+        self.shape = (dataset.count, dataset.height, dataset.width)
+        self.dtype = np.dtype(dataset.dtypes[0])
+        self.tiles_x = -(-dataset.width // tile_size)
+        self.tiles_y = -(-dataset.height // tile_size)
+        self.tile_bytes = dataset.count * tile_size * tile_size * self.dtype.itemsize
+        self.max_tiles = max(1, memory_budget // self.tile_bytes)
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def tile(self, tile_id: int) -> np.ndarray:
+        """Returns all bands of a tile, reading it if it's not in the cache.
+
+        Args:
+            tile_id (int): Tile number, counted row by row from the upper left corner
+
+        Returns:
+            np.ndarray: Array with shape (bands, rows, cols)
+        """
+        if tile_id in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(tile_id)
+            return self.cache[tile_id]
+        self.misses += 1
+        row_off = (tile_id // self.tiles_x) * self.tile_size
+        col_off = (tile_id % self.tiles_x) * self.tile_size
+        window = Window(col_off, row_off, min(self.tile_size, self.shape[2] - col_off), min(self.tile_size, self.shape[1] - row_off))
+        data = self.dataset.read(window=window)
+        self.cache[tile_id] = data
+        while len(self.cache) > self.max_tiles:
+            self.cache.popitem(last=False)
+        return data
+
+    def __getitem__(self, key: any) -> any:
+        if not isinstance(key, tuple):
+            # a whole band, for code that needs the full raster anyway
+            return self.dataset.read(key+1)
+        band, rows, cols = key
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        out = np.empty(rows.shape, dtype=self.dtype)
+        flat_rows, flat_cols, flat_out = rows.reshape(-1), cols.reshape(-1), out.reshape(-1)
+        tile_ids = (flat_rows // self.tile_size) * self.tiles_x + flat_cols // self.tile_size
+        order = np.argsort(tile_ids, kind='stable')
+        tile_ids, starts = np.unique(tile_ids[order], return_index=True)
+        for tile_id, cells in zip(tile_ids.tolist(), np.split(order, starts[1:])):
+            data = self.tile(tile_id)
+            row_off = (tile_id // self.tiles_x) * self.tile_size
+            col_off = (tile_id % self.tiles_x) * self.tile_size
+            flat_out[cells] = data[band, flat_rows[cells] - row_off, flat_cols[cells] - col_off]
+        return out if out.ndim > 0 else out[()]
+
+    def cache_stats(self) -> dict[str: int]:
+        """Returns tile cache hits and misses, and the number of tiles in the cache."""
+        return {'tile_hits': self.hits, 'tile_misses': self.misses, 'tiles_cached': len(self.cache)}
+
+
+class Block_array:
+    """Flat array where blocks are only allocated when written to.
+    Used for raster sized indexes where only a corridor of cells is ever set.
+    """
+
+    def __init__(self, size: int, fill: any, dtype: any, block_size: int = 2**16) -> None:
+        """Create an array where every element has the fill value.
+
+        Args:
+            size (int): Number of elements
+            fill (any): Value of elements that have not been set
+            dtype (any): Numpy data type
+            block_size (int, optional): Elements per block. Defaults to 2**16.
+        """
+        self.size = size
+        self.fill = fill
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.blocks = {}
+
+    def groups(self, idx: np.ndarray) -> list[tuple[int, np.ndarray]]:
+        """Positions in idx of the elements in each block, from one sort of the block ids, like Tiled_raster.__getitem__().
+
+        Args:
+            idx (np.ndarray): Flat element indexes
+
+        Returns:
+            list[tuple[int, np.ndarray]]: Block id and the positions of its elements, in the order they are in idx
+        """
+        block_ids = idx // self.block_size
+        order = np.argsort(block_ids, kind='stable')
+        block_ids, starts = np.unique(block_ids[order], return_index=True)
+        return list(zip(block_ids.tolist(), np.split(order, starts[1:])))
+
+    def __getitem__(self, idx: any) -> any:
+        idx = np.asarray(idx, dtype=np.int64)
+        out = np.full(idx.shape, self.fill, dtype=self.dtype)
+        flat_idx, flat_out = idx.reshape(-1), out.reshape(-1)
+        for block_id, positions in self.groups(flat_idx):
+            if block_id in self.blocks:
+                flat_out[positions] = self.blocks[block_id][flat_idx[positions] - block_id * self.block_size]
+        return out if out.ndim > 0 else out[()]
+
+    def __setitem__(self, idx: any, values: any) -> None:
+        idx = np.asarray(idx, dtype=np.int64)
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), idx.shape).reshape(-1)
+        idx = idx.reshape(-1)
+        for block_id, positions in self.groups(idx):
+            if block_id not in self.blocks:
+                self.blocks[block_id] = np.full(self.block_size, self.fill, dtype=self.dtype)
+            # positions are in the order of idx, so the last value of a repeated index is kept, like numpy
+            self.blocks[block_id][idx[positions] - block_id * self.block_size] = values[positions]
+
+    def nbytes(self) -> int:
+        """Returns the bytes used by allocated blocks."""
+        return len(self.blocks) * self.block_size * self.dtype.itemsize
@@ -1,11 +1,21 @@
 #TODO: Fix longest water being set to NULL when long transects exit the watershed.
 
 # import libraries 
-import arcpy
+import os
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import arcpy
+except ImportError: # Linux workers without ArcGIS can still use the numpy parts
+    arcpy = None
+import numpy as np
+from river_table import River_table
+import bank_sampling
+import instrumentation
 
 class River:
-    arcpy.CheckOutExtension("Spatial")
-    arcpy.env.overwriteOutput = True
+    if arcpy != None:
+        arcpy.CheckOutExtension("Spatial")
+        arcpy.env.overwriteOutput = True
 
     def __init__(self, workspace, river_name, river_feature, dem) -> None:
         """Create a River object
@@ -17,7 +27,8 @@ class River:
             dem (str): Name of DEM in gdb
         """
         self.workspace = workspace
-        arcpy.env.workspace = workspace
+        if arcpy != None:
+            arcpy.env.workspace = workspace
         self.river_feature = river_feature
         self.dem = dem 
         self.river = river_name
@@ -42,7 +53,19 @@ class River:
         self.transect_distance = self.point_distance/2+0.01
         self.transect_length = 300
         self.distance_tupl = (0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20)
+        # return period and water surface elevation raster of every discharge scenario
+        self.scenarios = {100: 'wse100', 5: 'wse5'}
+        # stage timings and counters, shared with Flood_path by default
+        self.recorder = instrumentation.recorder
         
+    def __getstate__(self) -> dict:
+        """State for pickling, like a River sent to worker processes. The arcpy spatial reference can't be pickled,
+        so it is left out, and a River from a worker only has the settings and self.data.
+        """
+        state = dict(self.__dict__)
+        state['spatial_ref'] = None
+        return state
+
     def data_import(self, feature_class, field_names='*', new_names=None) -> dict[int: any]: 
         """Reads data from a feature class
 
@@ -66,6 +89,26 @@ class River:
                 data[row[0]] = row_dict
         return data
     
+    def table_import(self, feature_class, field_names, new_names) -> River_table:
+        """Reads points from a feature class into a columnar River_table
+
+        Args:
+            feature_class (str): Name of fc in gdb or path
+            field_names (tuple[str]): Field names to import. First item needs to be a uniqe ID like OBJECTID
+            new_names (tuple[str]): Field name aliases to use after import
+
+        Returns:
+            River_table: Table with one row per point, in cursor order
+        """
+        self.spatial_ref = arcpy.Describe(feature_class).spatialReference
+        with arcpy.da.SearchCursor(feature_class, field_names) as cursor:
+            rows = list(cursor)
+        self.recorder.count('cursor_rows', len(rows))
+        table = River_table([row[0] for row in rows], self.distance_tupl)
+        for i, name in enumerate(new_names):
+            table.add_field(name, [row[i] for row in rows])
+        return table
+
     def data_export(self, feature_class, fields) -> None: 
         """Export data back to feature class in gdb.
         Exports data from self.data.
@@ -103,25 +146,55 @@ class River:
         del insert_cursor
         
     def calculate_length(self, point_a, point_b): # finds length of river between two points
-        length = 0 # counting variable
-        switch = 1 # switch to reverse for loop
-        if self.data[point_a]['River_Sequence'] > self.data[point_b]['River_Sequence']:
-            switch = -1
-        river = self.data[point_a]['River_Segment']
-        for pos in self.data:
-            if self.data[pos]['River_Segment'] == river and self.data[pos]['River_Sequence'] in \
-            range(self.data[point_a]['River_Sequence'], self.data[point_b]['River_Sequence']+switch, switch):
-                if (self.data[pos]['River_Sequence'] == self.data[point_a]['River_Sequence']) or \
-                (self.data[pos]['River_Sequence'] == self.data[point_b]['River_Sequence']):
-                    length += self.data[pos]['Length']/2
-                else: 
-                    length += self.data[pos]['Length']
-        return(length)
+        return float(self.river_length(self.data.rows([point_a]), self.data.rows([point_b]))[0])
+
+    def chainage(self) -> dict[str: np.ndarray]:
+        """Cumulative river length over all points sorted by segment and sequence.
+        Built once from Length and River_Sequence and kept in self.data.cache.
+
+        Returns:
+            dict[str: np.ndarray]: 'key' orders points by segment and then sequence, 'sorted' is the sorted keys,
+            and 'cum' is the length of all points before each position in 'sorted', with the total last.
+        """
+        if 'chainage' not in self.data.cache:
+            sequence = self.data.columns['River_Sequence']
+            _, segment = np.unique(self.data.columns['River_Segment'], return_inverse=True)
+            key = segment * (sequence.max() - sequence.min() + 1) + (sequence - sequence.min())
+            order = np.argsort(key, kind='stable')
+            cum = np.concatenate(([0], np.cumsum(self.data.columns['Length'][order])))
+            self.data.cache['chainage'] = {'key': key, 'sorted': key[order], 'cum': cum}
+        return self.data.cache['chainage']
+
+    def river_length(self, rows_a, rows_b) -> np.ndarray:
+        """Finds the length of the river between pairs of points in the same segment.
+        All points between get their full length and the two end points half their length.
+
+        Args:
+            rows_a (np.ndarray): Rows in self.data of the first points
+            rows_b (np.ndarray): Rows in self.data of the second points
+
+        Returns:
+            np.ndarray: Length between each pair of points
+        """
+        chainage = self.chainage()
+        cum, sorted_key = chainage['cum'], chainage['sorted']
+        low = np.minimum(chainage['key'][rows_a], chainage['key'][rows_b])
+        high = np.maximum(chainage['key'][rows_a], chainage['key'][rows_b])
+        first = np.searchsorted(sorted_key, low, 'left')
+        last = np.searchsorted(sorted_key, high, 'right')
+        low_end = cum[np.searchsorted(sorted_key, low, 'right')] - cum[first]
+        high_end = np.where(low != high, cum[last] - cum[np.searchsorted(sorted_key, high, 'left')], 0)
+        return cum[last] - cum[first] - (low_end + high_end) / 2
         
     def calculate_gradient(self, river): # finds gradient from downstream point
-        sequences = self.sort_sequence(river)
-        for i in range(len(sequences)-1):
-            self.data[sequences[i][1]]['Gradient'] = ((self.data[sequences[i][1]]['Elevation'] - self.data[sequences[i+1][1]]['Elevation']) / self.calculate_length(sequences[i][1], sequences[i+1][1])) * 100
+        rows = self.segment_index(rows=True)[river]
+        if len(rows) < 2:
+            return
+        elevation = self.data.columns['Elevation'][rows]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gradient = ((elevation[:-1] - elevation[1:]) / self.river_length(rows[:-1], rows[1:])) * 100
+        self.data.add_field('Gradient')
+        self.data.columns['Gradient'][rows[:-1]] = np.where(np.isfinite(gradient), gradient, np.nan)
         
     def add_xsection_data(self, river) -> None:
         """Method that calls self.calc_xsection_area() and self.calc_xsection_slope()
@@ -130,13 +203,12 @@ class River:
         Args:
             river (int): Number representing the river segment
         """
-        sequences = self.sort_sequence(river)
-        for i in range(1, len(sequences)):
-            try:
-                self.calc_xsection_area(sequences[i][1])
-                self.calc_xsection_slope(sequences[i][1])
-            except:
-                pass
+        points = self.segment_index()[river][1:]
+        rows = self.segment_index(rows=True)[river][1:]
+        # A side with NoData has no area, and the left area and slopes are only calculated when the right side is complete
+        complete = np.isfinite(self.data.river_side[rows]).all(axis=1) & np.isfinite(self.data.columns['Elevation'][rows])[:, None]
+        self.calc_xsection_area(points[complete[:, 0]])
+        self.calc_xsection_slope(points[complete[:, 0] & complete[:, 1]])
     
     
     def sort_sequence(self, river) -> list[dict]:
@@ -148,12 +220,37 @@ class River:
         Returns:
             list[int, int]: Returns a nested list[sequence, id]
         """
-        sequences = [(self.data[x]['River_Sequence'], x) for x in self.data if self.data[x]['River_Segment'] == river]
-        if self.data[sequences[0][1]]['Elevation'] < self.data[sequences[len(sequences)-1][1]]['Elevation']:
-            sequences.sort(reverse=True, key=lambda x:x[0])    
-        else:
-            sequences.sort(key=lambda x:x[0])
-        return sequences
+        rows = self.segment_index(rows=True)[river]
+        return list(zip(self.data.columns['River_Sequence'][rows].astype(np.int64).tolist(), self.data.ids[rows].tolist()))
+
+    def segment_index(self, rows=False) -> dict[int: np.ndarray]:
+        """Groups the points by River_Segment, sorted from upstream to downstream.
+        Built once after the elevation is imported and kept in self.data.cache, so all stages and
+        repeated calls share it. A segment is sorted by descending River_Sequence when its first
+        point in the feature class is lower than its last point.
+
+        Args:
+            rows (bool, optional): Return rows in self.data instead of point IDs. Defaults to False.
+
+        Returns:
+            dict[int: np.ndarray]: Segment number as key and sorted point IDs or rows as value
+        """
+        if 'segments' not in self.data.cache:
+            segment = self.data.columns['River_Segment']
+            sequence = self.data.columns['River_Sequence']
+            elevation = self.data.columns['Elevation']
+            order = np.argsort(segment, kind='stable')
+            values, starts = np.unique(segment[order], return_index=True)
+            segment_rows = {}
+            for value, group in zip(values.tolist(), np.split(order, starts[1:])):
+                if elevation[group[0]] < elevation[group[-1]]:
+                    group = group[np.argsort(-sequence[group], kind='stable')]
+                else:
+                    group = group[np.argsort(sequence[group], kind='stable')]
+                segment_rows[int(value)] = group
+            self.data.cache['segment_rows'] = segment_rows
+            self.data.cache['segments'] = {x: self.data.ids[segment_rows[x]] for x in segment_rows}
+        return self.data.cache['segment_rows'] if rows else self.data.cache['segments']
     
     def add_no_data(self, fields) -> None:
         """Adds type None to all points in self.data that doesn't have a value for the specific field
@@ -162,98 +259,72 @@ class River:
             fields (tupel[str]): Takes an iterable of strings with fieldnames to assign NoData for
         """
         for field in fields:
-            for row in self.data:
-                if field not in self.data[row]:
-                    self.data[row][field] = None
+            self.data.add_field(field)
                     
     
     def find_critical_points(self, q, slope=None, dynamic=False) -> dict[int: int]: #Kan jeg kode slope dynamisk ut i fra slope i lengderetningen?
         """A method that selects candidate critical points based on water can reach.
-        Uses a dict[list] called self.crit as input, as well as q
+        The selection is done with masks over all points, distances and sides at once,
+        and the points on the river bank are found in self.data.bank_oid.
+        Several scenarios can be selected at once, sharing the masks that don't depend on the water surface.
 
         Args:
-            q (int): Number representing the discharge scenario
+            q (int): Number representing the discharge scenario, or an iterable of them
             slope (int): slope in cross-section that selects points as critical
+            dynamic (bool): Use the gradient along the river at each point as slope. Defaults to False.
 
         Returns:
-            dict[int: int]: A dict with IDs for the points on the river bank that can be critical as key, and critical percentage as value
+            dict[int: int]: A dict with IDs for the points on the river bank that can be critical as key, and critical percentage as value.
+            With several scenarios, a dict with the scenario as key and such a dict as value.
         """
-        def get_crit_value(point, distance, side):
-            max_elevation = max([self.data[point][f'river_side_{x}_{side}'] for x in self.distance_tupl[:self.distance_tupl.index(distance)+1]])
-            crit_value = ((max_elevation - self.data[point]['Elevation']) / self.data[point][f'Q{q}_wse_diff']) * 100
-            return crit_value
-            
-        self.crit = {}
-        all_points = [f'{dist}_{side}' for side in ('r', 'l') for dist in self.distance_tupl]
-        
-        if slope != None or dynamic:
-            for point in self.data:
+        with self.recorder.stage('find_critical_points'):
+            if self.data.bank_oid is None:
+                self.load_bank_index()
+            scenarios = [q] if isinstance(q, (int, np.integer)) else list(q)
+            elevation = self.data.columns['Elevation'][:, None, None]
+            bank = self.data.river_side
+            distances = np.array(self.distance_tupl)[None, :, None]
+
+            candidate = self.data.bank_oid >= 0
+            if slope != None or dynamic:
                 if dynamic:
-                    if self.data[point]['Gradient'] == None:
-                        slope = float('inf')
-                    else:
-                        slope = self.data[point]['Gradient']
-                crit = []
-                for i, dist in enumerate(self.distance_tupl):
-                    if dist < self.distance_tupl[-1]:
-                        next_dist = self.distance_tupl[i+1]
-                        for side in ('r', 'l'):
-                            if self.data[point][f'slope_{dist}_{next_dist}_{side}'] != None and self.data[point][f'slope_{dist}_{next_dist}_{side}'] < slope:
-                                crit.append(f'{dist}_{side}')
-                self.crit[point] = crit
-            actual_crit = {}
-            for x in self.crit:
-                temp_lst = []
-                for y in self.crit[x]:
-                    if self.data[x][f'Q{q}_wse_diff'] != None and self.data[x][f'longest_water_Q{q}_{y[-1]}'] != None and self.data[x][f'longest_water_Q{q}_{y[-1]}'] >= int(y[:-2]):
-                        if self.data[x][f'river_side_{y}'] - self.data[x]['Elevation'] < self.data[x][f'Q{q}_wse_diff']:
-                            temp_lst.append(y)
-                if len(temp_lst) > 0:
-                    actual_crit[x] = temp_lst
-        else:
-            actual_crit = {}
-            for x in self.data:
-                temp_lst = []
-                for y in all_points:
-                    if self.data[x][f'Q{q}_wse_diff'] != None and self.data[x][f'longest_water_Q{q}_{y[-1]}'] != None and self.data[x][f'longest_water_Q{q}_{y[-1]}'] >= int(y[:-2]):
-                        if self.data[x][f'river_side_{y}'] - self.data[x]['Elevation'] < self.data[x][f'Q{q}_wse_diff']:
-                            temp_lst.append(y)
-                if len(temp_lst) > 0:
-                    actual_crit[x] = temp_lst
-                    
-        
-        actual_crit_short = {}
-        for x in actual_crit:
-            for side in ('r', 'l'):
-                tmp_lst = []
-                for y in actual_crit[x]:
-                    if y[-1] == side:
-                        tmp_lst.append(int(y[:-2]))
-                if len(tmp_lst) > 0:
-                    if x not in actual_crit_short:
-                        actual_crit_short[x] = [f'{max(tmp_lst)}_{side}']
-                    else:
-                        actual_crit_short[x] += [f'{max(tmp_lst)}_{side}']
-                        
-        crit_points = {}
-        for point in actual_crit:
-            sides = set([x[-1] for x in actual_crit[point]])
-            for side in sides:
-                if side == 'r':
-                    distances = [int(x[:-2]) for x in actual_crit[point] if x[-1] == 'r']
-                    with arcpy.da.SearchCursor(self.side_points_elev, ['OBJECTID', 'side', 'distance'], f'orig_id = {point}') as cursor:
-                        for row in cursor:
-                            if row[1][0] == side and row[2] in distances:
-                                crit_value_r = get_crit_value(point, row[2], row[1][0])
-                                crit_points[row[0]] = crit_value_r
-                elif side == 'l':
-                    distances = [int(x[:-2]) for x in actual_crit[point] if x[-1] == 'l']
-                    with arcpy.da.SearchCursor(self.side_points_elev, ['OBJECTID', 'side', 'distance'], f'orig_id = {point}') as cursor2:
-                        for row2 in cursor2:
-                            if row2[1][0] == side and row2[2] in distances:
-                                crit_value_l = get_crit_value(point, row2[2], row2[1][0])
-                                crit_points[row2[0]] = crit_value_l
-        return crit_points     
+                    slope = np.where(np.isnan(self.data.columns['Gradient']), np.inf, self.data.columns['Gradient'])[:, None, None]
+                # the last distance has no slope to the next, so it is never selected by slope
+                gentle = np.zeros(bank.shape, dtype=bool)
+                gentle[:, :-1] = ~np.isnan(self.data.slope) & (self.data.slope < slope)
+                candidate &= gentle
+            # critical percentage uses the highest bank point between the river and the candidate
+            height = np.fmax.accumulate(bank, axis=1) - elevation
+            order = (0, 2, 1) # point, side, distance
+            bank_oid = self.data.bank_oid.transpose(order)
+
+            results = {}
+            for x in scenarios:
+                wse_diff = self.data.columns[f'Q{x}_wse_diff'][:, None, None]
+                longest = np.stack([self.data.columns[f'longest_water_Q{x}_{side}'] for side in ('r', 'l')], axis=-1)[:, None, :]
+                # bank points that are within the longest water and below the water surface
+                crit = candidate & ~np.isnan(wse_diff) & ~np.isnan(longest) & (longest >= distances) & (bank - elevation < wse_diff)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    crit_value = (height / wse_diff) * 100
+                crit = crit.transpose(order)
+                results[x] = dict(zip(bank_oid[crit].tolist(), crit_value.transpose(order)[crit].tolist()))
+            return results[q] if isinstance(q, (int, np.integer)) else results
+
+    def load_bank_index(self) -> None:
+        """Reads the OBJECTID of every point on the river bank from self.side_points_elev into self.data.bank_oid,
+        so the points for a (point, distance, side) can be found without a cursor.
+        """
+        with arcpy.da.SearchCursor(self.side_points_elev, ['orig_id', 'side', 'distance', 'OBJECTID', 'SHAPE@XY']) as cursor:
+            rows = list(cursor)
+        self.recorder.count('cursor_rows', len(rows))
+        rows = [row for row in rows if row[0] in self.data and row[2] in self.data.distance_index]
+        self.data.bank_oid = np.full(self.data.river_side.shape, -1, dtype=np.int64)
+        self.data.bank_xy = np.full(self.data.river_side.shape + (2,), np.nan)
+        if len(rows) > 0:
+            orig_id, side, distance, oid, xy = zip(*rows)
+            bank_idx = (self.data.rows(orig_id), [self.data.distance_index[x] for x in distance], [('r', 'l').index(x[0]) for x in side])
+            self.data.bank_oid[bank_idx] = oid
+            self.data.bank_xy[bank_idx] = np.array(xy, dtype=np.float64)
                                     
     def add_river_bank(self, raster=None) -> None:
         """A method for generating points in the cross-section of the river.
@@ -313,8 +384,16 @@ class River:
             arcpy.management.Project(self.side_points_elev, self.side_points_elev_crs, arcpy.Describe(raster).spatialReference)
         
         with arcpy.da.SearchCursor(self.side_points_elev, ['orig_id', 'side', 'distance', 'RASTERVALU']) as cursor:
-            for row in cursor:
-                self.data[row[0]][f'river_side_{row[2]}_{row[1][0]}'] = row[3]
+            rows = list(cursor)
+        if len(rows) > 0:
+            orig_id, side, distance, value = zip(*rows)
+            # the values are set in a copy of the points and put back at once, instead of field by field
+            point_rows = self.data.rows(orig_id)
+            points = np.unique(point_rows)
+            table = self.data.take(points)
+            bank_idx = (np.searchsorted(points, point_rows), [self.data.distance_index[x] for x in distance], [('r', 'l').index(x[0]) for x in side])
+            table.river_side[bank_idx] = np.array(value, dtype=np.float64)
+            self.data.put(points, table)
                 
     def add_river_bank2(self, raster=None) -> None: #Latest version
         """A method for generating points in the cross-section of the river.
@@ -373,151 +452,494 @@ class River:
         if raster:
             arcpy.management.Project(self.side_points_elev, self.side_points_elev_crs, arcpy.Describe(raster).spatialReference)
         
-        with arcpy.da.SearchCursor(self.side_points_elev, ['orig_id', 'side', 'distance', 'RASTERVALU']) as cursor:
-            for row in cursor:
-                self.data[row[0]][f'river_side_{row[2]}_{row[1][0]}'] = row[3]      
+        with arcpy.da.SearchCursor(self.side_points_elev, ['orig_id', 'side', 'distance', 'RASTERVALU', 'OBJECTID', 'SHAPE@XY']) as cursor:
+            rows = list(cursor)
+        self.data.bank_oid = np.full(self.data.river_side.shape, -1, dtype=np.int64)
+        self.data.bank_xy = np.full(self.data.river_side.shape + (2,), np.nan)
+        if len(rows) > 0:
+            orig_id, side, distance, value, oid, xy = zip(*rows)
+            bank_idx = (self.data.rows(orig_id), [self.data.distance_index[x] for x in distance], [('r', 'l').index(x[0]) for x in side])
+            self.data.river_side[bank_idx] = np.array(value, dtype=np.float64)
+            self.data.bank_oid[bank_idx] = oid
+            self.data.bank_xy[bank_idx] = np.array(xy, dtype=np.float64)
     
-    def calc_xsection_slope(self, point) -> None:
+    def add_river_bank_native(self, raster=None, method='nearest', dem_path=None, write_points=True) -> None:
+        """Generates points in the cross-section of the river like self.add_river_bank2(), but computes the
+        points for all transects as arrays and samples the DEM directly with rasterio.
+        The points get the OBJECTID they would get in self.side_points_elev, in self.data.bank_oid,
+        and their coordinates are kept in self.data.bank_xy.
+
+        Args:
+            raster (str, optional): Name or path to raster for reprojection of the written points. Defaults to None.
+            method (str, optional): 'nearest' or 'bilinear' sampling of the DEM. Defaults to 'nearest'.
+            dem_path (str, optional): Path to the DEM if GDAL can't read self.dem in the gdb. Defaults to None.
+            write_points (bool, optional): Write self.side_points_elev for Flood_path. Defaults to True.
+        """
+        orig_id, ends, edges = self.read_transects()
+        points, values = self.sample_banks(ends, edges, method, dem_path)
+        self.set_bank_points(orig_id, points, values)
+        if write_points:
+            self.write_bank_points(orig_id, points, values, raster)
+
+    def read_transects(self) -> tuple[np.ndarray]:
+        """Reads the end points of the transects and the edges of the dissolved river polygon.
+
+        Returns:
+            tuple[np.ndarray]: ID of the point in the river for every transect, transect ends with shape (transects, 2, 2)
+            where the first point is the left side, and the polygon edges from bank_sampling.polygon_edges()
+        """
+        self.distances = {distance: (f'river_side_{distance}_r', f'river_side_{distance}_l') for distance in sorted(self.distance_tupl)}
+        with arcpy.da.SearchCursor(self.transects, ['ORIG_FID', 'Shape@']) as cursor:
+            trans = {row[0]: ((row[1].firstPoint.X, row[1].firstPoint.Y), (row[1].lastPoint.X, row[1].lastPoint.Y)) for row in cursor}
+        self.recorder.count('cursor_rows', len(trans))
+        rings = []
+        with arcpy.da.SearchCursor(self.polygon_dissolve, ['Shape@']) as cursor:
+            for row in cursor:
+                for part in row[0]:
+                    ring = []
+                    for point in part:
+                        # None separates the outer ring from holes
+                        if point == None:
+                            rings.append(ring)
+                            ring = []
+                        else:
+                            ring.append((point.X, point.Y))
+                    rings.append(ring)
+        orig_id = np.array(list(trans), dtype=np.int64)
+        ends = np.array(list(trans.values()), dtype=np.float64).reshape(-1, 2, 2)
+        return orig_id, ends, bank_sampling.polygon_edges(rings)
+
+    def sample_banks(self, ends, edges, method='nearest', dem_path=None) -> tuple[np.ndarray]:
+        """Places points along transects and samples the DEM at them.
+
+        Args:
+            ends (np.ndarray): Transect ends with shape (transects, 2, 2), from self.read_transects()
+            edges (np.ndarray): Edges of the dissolved river polygon
+            method (str, optional): 'nearest' or 'bilinear' sampling of the DEM. Defaults to 'nearest'.
+            dem_path (str, optional): Path to the DEM if GDAL can't read self.dem in the gdb. Defaults to None.
+
+        Returns:
+            tuple[np.ndarray]: Coordinates with shape (transects, distances, 2, 2) and elevation with shape (transects, distances, 2)
+        """
+        points = bank_sampling.bank_points(ends[:, 0], ends[:, 1], edges, self.distance_tupl)
+        dem = dem_path if dem_path != None else os.path.join(self.workspace, self.dem)
+        return points, bank_sampling.sample_raster(dem, points[..., 0], points[..., 1], method)
+
+    def write_bank_points(self, orig_id, points, values, raster=None) -> None:
+        """Writes bank points to self.side_points_elev in the same order as self.add_river_bank2().
+
+        Args:
+            orig_id (np.ndarray): ID of the point in the river for every transect
+            points (np.ndarray): Coordinates with shape (transects, distances, 2, 2)
+            values (np.ndarray): Elevation with shape (transects, distances, 2)
+            raster (str, optional): Name or path to raster for reprojection. Defaults to None.
+        """
+        arcpy.management.CreateFeatureclass(arcpy.env.workspace, self.side_points_elev, 'POINT', '', '', '', self.spatial_ref)
+        arcpy.management.AddFields(self.side_points_elev, [['orig_id', 'SHORT'], ['distance', 'SHORT'], ['side', 'TEXT'], ['RASTERVALU', 'FLOAT']])
+        with arcpy.da.InsertCursor(self.side_points_elev, ('orig_id', 'side', 'distance', 'RASTERVALU', 'SHAPE@XY')) as in_cursor:
+            for i, id_point in enumerate(orig_id.tolist()):
+                for side, name in ((1, 'left'), (0, 'right')):
+                    for j, distance in enumerate(self.distance_tupl):
+                        value = None if np.isnan(values[i, j, side]) else float(values[i, j, side])
+                        in_cursor.insertRow((id_point, name, distance, value, tuple(points[i, j, side].tolist())))
+        if raster:
+            arcpy.management.Project(self.side_points_elev, self.side_points_elev_crs, arcpy.Describe(raster).spatialReference)
+
+    def set_bank_points(self, orig_id, points, values, ordinal=None) -> None:
+        """Stores bank points from bank_sampling in self.data. OBJECTIDs are numbered in the order
+        add_river_bank2() inserts points: by transect, then left before right, then by distance.
+
+        Args:
+            orig_id (np.ndarray): ID of the point in the river for every transect
+            points (np.ndarray): Coordinates with shape (transects, distances, 2, 2)
+            values (np.ndarray): Elevation with shape (transects, distances, 2)
+            ordinal (np.ndarray, optional): Position of each transect among all transects, when only some are given. Defaults to None.
+        """
+        num_dist = len(self.distance_tupl)
+        ordinal = np.arange(len(orig_id)) if ordinal is None else np.asarray(ordinal, dtype=np.int64)
+        first_oid = 1 + ordinal[:, None] * 2 * num_dist + np.arange(num_dist)[None, :]
+        oid = np.stack((first_oid + num_dist, first_oid), axis=-1)
+        known = np.isin(orig_id, self.data.ids)
+        rows = self.data.rows(orig_id[known])
+        self.data.river_side[rows] = values[known]
+        if self.data.bank_oid is None:
+            self.data.bank_oid = np.full(self.data.river_side.shape, -1, dtype=np.int64)
+        self.data.bank_oid[rows] = oid[known]
+        if self.data.bank_xy is None:
+            self.data.bank_xy = np.full(self.data.river_side.shape + (2,), np.nan)
+        self.data.bank_xy[rows] = points[known]
+
+    def calc_xsection_slope(self, points) -> None:
         """Calculates the slope between points on both sides of the river in percentage.
         The formula is (rise / run) * 100.
-        Adds a field in self.data called slope_{distance from river}_{next distance}_{side}
+        Sets self.data.slope, which is the field slope_{distance from river}_{next distance}_{side}
 
         Args:
-            point (int): ID of point in the river to have slope calculated
+            points (list[int]): IDs of points in the river to have slope calculated
         """
-        
-        for i, dist in enumerate(self.distance_tupl):
-            if dist < self.distance_tupl[-1]:
-                next_dist = self.distance_tupl[i+1]
-                for side in range(2): 
-                    slope = (self.data[point][self.distances[next_dist][side]] - self.data[point][self.distances[dist][side]]) / (next_dist - dist) * 100
-                    if side == 0:
-                        self.data[point][f'slope_{dist}_{next_dist}_r'] = slope
-                    else:
-                        self.data[point][f'slope_{dist}_{next_dist}_l'] = slope                              
-                        
+        rows = self.data.rows(points)
+        run = np.diff(np.array(self.distance_tupl, dtype=np.float64))
+        profile = self.data.river_side[rows]
+        self.data.slope[rows] = (profile[:, 1:] - profile[:, :-1]) / run[None, :, None] * 100
 
-    def calc_xsection_area(self, point) -> None:
+    def calc_xsection_area(self, points) -> None:
         """Calculates area of cross-section for both sides of the river.
         Adds fields for both sides of the river to self.data
     
         Args:
-            point (int): ID of point in the river to have area calculated
+            points (list[int]): IDs of points in the river to have area calculated
         """
-        base = self.data[point]['Elevation']
-        for side in range(2):
-            area = 0
-            for i, dist in enumerate(self.distance_tupl):
-                if dist < self.distance_tupl[-1]:
-                    next_dist = self.distance_tupl[i+1]
-                    height1 = (self.data[point][self.distances[next_dist][side]] - base)
-                    height2 = (self.data[point][self.distances[dist][side]] - base)
-                    area += ((height1 + height2) / 2) * (next_dist - dist)
-            if side == 0:
-                self.data[point][f'slope_area_r'] = area
-            else:
-                self.data[point][f'slope_area_l'] = area
-                    
-    
-    def full_analysis(self) -> None:
+        rows = self.data.rows(points)
+        height = self.data.river_side[rows] - self.data.columns['Elevation'][rows][:, None, None]
+        area = np.zeros((len(rows), 2))
+        for i in range(len(self.distance_tupl)-1):
+            area += ((height[:, i+1] + height[:, i]) / 2) * (self.distance_tupl[i+1] - self.distance_tupl[i])
+        for side, name in enumerate(('slope_area_r', 'slope_area_l')):
+            self.data.add_field(name)
+            self.data.columns[name][rows] = area[:, side]
+
+    def add_longest_water(self, scenarios) -> None:
+        """Finds the furthest distance from the center where the river bank is below the water surface.
+        Adds fields longest_water_{scenario}_{side} to self.data
+
+        Args:
+            scenarios (tuple[str]): Names of the scenarios, like 'Q100', with a field '{scenario}_wse_diff'
+        """
+        scenarios = tuple(scenarios)
+        distances = self.distance_tupl
+        # the distance before the first bank above water, with the same wrap-around as distances[i-1]
+        before = np.array([d if d == 0 else distances[i-1] for i, d in enumerate(distances)], dtype=np.float64)
+        bank = self.data.river_side[None]
+        has_bank = np.isfinite(bank) & (bank != 0)
+        # all scenarios at once, with the scenario as the first axis
+        wse_diff = np.stack([self.data.columns[f'{q}_wse_diff'] for q in scenarios])
+        w_level = self.data.columns['Elevation'][None] + wse_diff
+        above = has_bank & (bank > w_level[:, :, None, None])
+        first_above = above.argmax(axis=2)
+        longest = np.where(above.any(axis=2), before[first_above], np.where(has_bank[:, :, -1], distances[-1], np.nan))
+        longest[np.isnan(wse_diff)] = np.nan
+        for i, q in enumerate(scenarios):
+            for side, name in enumerate(('r', 'l')):
+                self.data.add_field(f'longest_water_{q}_{name}')
+                self.data.columns[f'longest_water_{q}_{name}'][:] = longest[i, :, side]
+
+    def partition(self, workers, max_points=None) -> list[tuple]:
+        """Splits the points into chunks for self.parallel_analysis(). Whole segments are packed together,
+        and segments longer than max_points are split into runs along the river, which keeps each chunk
+        in one part of the DEM. A run also gets the point before and after it, so its gradients and
+        cross-sections are the same as for the whole segment, but only its own points are kept.
+
+        Args:
+            workers (int): Number of worker processes
+            max_points (int, optional): Max number of own points in a chunk. Defaults to None, which gives about four chunks per worker.
+
+        Returns:
+            list[tuple]: (rows, own, segments) for every chunk, where rows are rows in self.data, own is True for the points the chunk
+            owns, and segments has the positions in rows of each run from upstream to downstream
+        """
+        if max_points == None:
+            max_points = max(1, -(-len(self.data) // (workers * 4)))
+        chunks = []
+        rows, own, segments, size = [], [], {}, 0
+        segment_rows = self.segment_index(rows=True)
+        for segment in sorted(segment_rows):
+            group = segment_rows[segment]
+            for start in range(0, len(group), max_points):
+                stop = min(start + max_points, len(group))
+                if size > 0 and size + stop - start > max_points:
+                    chunks.append((np.concatenate(rows), np.concatenate(own), segments))
+                    rows, own, segments, size = [], [], {}, 0
+                first, last = max(start - 1, 0), min(stop + 1, len(group))
+                piece_own = np.zeros(last - first, dtype=bool)
+                piece_own[start - first:stop - first] = True
+                position = sum(len(x) for x in rows)
+                segments[len(segments)] = np.arange(position, position + last - first)
+                rows.append(group[first:last])
+                own.append(piece_own)
+                size += stop - start
+        if size > 0:
+            chunks.append((np.concatenate(rows), np.concatenate(own), segments))
+        return chunks
+
+    def chunk_transects(self, chunks, orig_id, ends) -> list[dict]:
+        """Splits the transects over the chunks from self.partition(), so each transect is sampled with the chunk that owns its point.
+
+        Args:
+            chunks (list[tuple]): Output from self.partition()
+            orig_id (np.ndarray): ID of the point in the river for every transect, from self.read_transects()
+            ends (np.ndarray): Transect ends with shape (transects, 2, 2), from self.read_transects()
+
+        Returns:
+            list[dict]: 'orig_id', 'ends' and 'ordinal', the position among all transects, of the transects of every chunk
+        """
+        owner = np.zeros(len(self.data), dtype=np.int64)
+        for i, (rows, own, _) in enumerate(chunks):
+            owner[rows[own]] = i
+        # transects without a point in self.data are only needed for self.side_points_elev, and go with the first chunk
+        known = np.isin(orig_id, self.data.ids)
+        transect_chunk = np.zeros(len(orig_id), dtype=np.int64)
+        transect_chunk[known] = owner[self.data.rows(orig_id[known])]
+        transects = []
+        for i in range(len(chunks)):
+            ordinal = np.flatnonzero(transect_chunk == i)
+            transects.append({'orig_id': orig_id[ordinal], 'ends': ends[ordinal], 'ordinal': ordinal})
+        return transects
+
+    def subset(self, rows, segments) -> 'River':
+        """Copies the River with only some of the points in self.data, for running stages on part of the river.
+
+        Args:
+            rows (np.ndarray): Rows in self.data to copy
+            segments (dict[int: np.ndarray]): Positions in rows of each segment from upstream to downstream, used as segment_index() of the copy
+
+        Returns:
+            River: River with the same settings and a smaller self.data
+        """
+        river = River.__new__(River)
+        river.__dict__.update(self.__dict__)
+        river.data = self.data.take(rows)
+        # sinks can't be sent to worker processes, and the workers don't report
+        river.recorder = instrumentation.Recorder(memory=None, progress=None)
+        river.data.cache['segment_rows'] = segments
+        river.data.cache['segments'] = {x: river.data.ids[segments[x]] for x in segments}
+        # the part of the chainage the points cover, so lengths are summed the same way as in the whole river
+        chainage = self.chainage()
+        key = chainage['key'][rows]
+        first = np.searchsorted(chainage['sorted'], key.min(), 'left')
+        last = np.searchsorted(chainage['sorted'], key.max(), 'right')
+        river.data.cache['chainage'] = {'key': key, 'sorted': chainage['sorted'][first:last], 'cum': chainage['cum'][first:last+1]}
+        return river
+
+    def with_distances(self, distances) -> 'River':
+        """Copies the River with only some of its distances across the river, and calculates the cross-sections and longest water
+        for them, like self.full_analysis() with those distances in self.distance_tupl. A bank point only depends on its distance
+        along the transect, so the points are the same, and they keep their OBJECTID in self.data.bank_oid.
+
+        Args:
+            distances (tuple[int]): Distances to keep, ascending, all in self.distance_tupl
+
+        Returns:
+            River: River with the same points and only the distances
+        """
+        river = River.__new__(River)
+        river.__dict__.update(self.__dict__)
+        river.distance_tupl = tuple(distances)
+        river.data = self.data.take_distances(river.distance_tupl)
+        river.recorder = instrumentation.Recorder(memory=None, progress=None)
+        river.distance_fields = tuple(x for x in river.data.fields if river.data.key(x)[0] != 'column')
+        # areas are only calculated for complete cross-sections, so the ones of the wider profile are cleared first
+        for name in ('slope_area_r', 'slope_area_l'):
+            if name in river.data.columns:
+                river.data.columns[name][:] = np.nan
+        for segment in river.segment_index():
+            river.add_xsection_data(segment)
+        river.add_longest_water(tuple(f'Q{q}' for q in river.scenarios))
+        return river
+
+    def parallel_analysis(self, workers, bank_backend='arcpy', sample_method='nearest', scenarios=None, max_points=None, dem_path=None) -> None:
+        """Runs the bank sampling, gradient, cross-section and longest water stages of self.full_analysis() in a process pool.
+        Reading transects and writing points is done here, since it needs arcpy, and with bank_backend='arcpy'
+        self.add_river_bank2() runs before the pool. Results are merged back into self.data in chunk order,
+        and every point is written only by the chunk that owns it, so the result is the same for any number of workers.
+
+        Args:
+            workers (int): Number of worker processes
+            bank_backend (str, optional): 'arcpy' or 'native'. Defaults to 'arcpy'.
+            sample_method (str, optional): DEM sampling of the native backend, 'nearest' or 'bilinear'. Defaults to 'nearest'.
+            scenarios (tuple[str], optional): Scenarios for self.add_longest_water(). Defaults to None = all in self.scenarios.
+            max_points (int, optional): Max number of own points in a chunk, see self.partition(). Defaults to None.
+            dem_path (str, optional): Path to the DEM if GDAL can't read self.dem in the gdb, for the native backend. Defaults to None.
+        """
+        if scenarios == None:
+            scenarios = tuple(f'Q{q}' for q in self.scenarios)
+        chunks = self.partition(workers, max_points)
+        edges = None
+        transects = [None] * len(chunks)
+        if bank_backend == 'native':
+            orig_id, ends, edges = self.read_transects()
+            transects = self.chunk_transects(chunks, orig_id, ends)
+        else:
+            self.add_river_bank2()
+
+        tasks = [{'river': self.subset(rows, segments), 'transects': transects[i], 'scenarios': scenarios, 'method': sample_method,
+                  'dem_path': dem_path}
+                 for i, (rows, own, segments) in enumerate(chunks)]
+        print(f"Running {len(tasks)} chunks on {workers} workers")
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(edges,)) as pool:
+            results = list(pool.map(analyze_chunk, tasks))
+
+        for (rows, own, _), result in zip(chunks, results):
+            self.data.put(rows, result['data'], own)
+        if bank_backend == 'native':
+            points = np.full((len(orig_id), len(self.distance_tupl), 2, 2), np.nan)
+            values = np.full((len(orig_id), len(self.distance_tupl), 2), np.nan)
+            for transect, result in zip(transects, results):
+                points[transect['ordinal']] = result['points']
+                values[transect['ordinal']] = result['values']
+            self.write_bank_points(orig_id, points, values)
+
+    def full_analysis(self, bank_backend='arcpy', sample_method='nearest', workers=None, scenarios=None, dem_path=None) -> None:
         """Runs the full analysis with all geoprocessing.
         Generates all the data in self.data
+
+        Args:
+            bank_backend (str, optional): 'arcpy' for self.add_river_bank2(), or 'native' for self.add_river_bank_native(). Defaults to 'arcpy'.
+            sample_method (str, optional): DEM sampling of the native backend, 'nearest' or 'bilinear'. Defaults to 'nearest'.
+            workers (int, optional): Run the stages after the import in this many processes with self.parallel_analysis(). Defaults to None, which runs them here.
+            scenarios (dict[int: str], optional): Return period as key and name or path of the water surface raster as value. Defaults to None = self.scenarios.
+            dem_path (str, optional): Path to the DEM if GDAL can't read self.dem in the gdb, for the native backend. Defaults to None.
+        """
+        names = self.prepare_analysis(scenarios)
+        recorder = self.recorder
+
+        if workers != None and workers > 1:
+            with recorder.stage('parallel_analysis'):
+                self.parallel_analysis(workers, bank_backend, sample_method, names, dem_path=dem_path)
+            return
+
+        with recorder.stage('river_bank'):
+            if bank_backend == 'native':
+                self.add_river_bank_native(method=sample_method, dem_path=dem_path)
+            else:
+                self.add_river_bank2()
+        
+        
+        river_set = self.segment_index() # segments for looping through rivers
+        num_rivers = len(river_set)
+        with recorder.stage('gradient_xsection'):
+            for count, river in enumerate(river_set):
+                recorder.progress("Adding gradient and xsection in river", count+1, num_rivers)
+                self.calculate_gradient(river)
+                self.add_xsection_data(river)
+        
+        print("Adding furthest water level from center")
+        with recorder.stage('longest_water'):
+            self.add_longest_water(names)
+
+    def prepare_analysis(self, scenarios=None) -> tuple[str]:
+        """Runs the geoprocessing of self.full_analysis() and imports the points, elevation and water surfaces to self.data,
+        so the bank sampling and the stages after it can run, like in pipeline.run().
+
+        Args:
+            scenarios (dict[int: str], optional): Return period as key and name or path of the water surface raster as value. Defaults to None = self.scenarios.
+
+        Returns:
+            tuple[str]: Names of the scenarios, like 'Q100'
         """
+        if scenarios != None:
+            self.scenarios = dict(scenarios)
+        names = tuple(f'Q{q}' for q in self.scenarios)
         print("Running geoprocessing tools")
+        recorder = self.recorder
         # arcpy.analysis.Select(self.river_feature, self.polygon, "objtype = 'ElvBekk'") 
-        arcpy.management.Dissolve(self.river_feature, self.polygon_dissolve)
+        with recorder.stage('dissolve'):
+            arcpy.management.Dissolve(self.river_feature, self.polygon_dissolve)
         # arcpy.management.Dissolve(self.polygon, self.polygon_dissolve)
-        arcpy.topographic.PolygonToCenterline(self.polygon_dissolve, self.centerline)
+        with recorder.stage('centerline'):
+            arcpy.topographic.PolygonToCenterline(self.polygon_dissolve, self.centerline)
         # arcpy.topographic.PolygonToCenterline(self.river_feature, self.centerline)
-        arcpy.management.GeneratePointsAlongLines(self.centerline, self.splitpoints, 'DISTANCE', f'{self.point_distance} meters')
-        arcpy.management.SplitLineAtPoint(self.centerline, self.splitpoints, self.splitline, '0,1 meters')
-        arcpy.management.GeneratePointsAlongLines(self.splitline, self.points_final, 'PERCENTAGE', Percentage=50)
-        arcpy.management.GenerateTransectsAlongLines(self.splitline, self.transects, f'{self.point_distance/2+0.01} meters', f'{self.transect_length} meters')
-        arcpy.analysis.Clip(self.transects, self.polygon_dissolve, self.transects_clipped)
-        # arcpy.analysis.Clip(self.transects, self.river_feature, self.transects_clipped)
-        arcpy.management.MultipartToSinglepart(self.transects_clipped, self.transects_sp)
-        arcpy.sa.ExtractValuesToPoints(self.points_final, self.dem, self.elevation)
+        with recorder.stage('split_centerline'):
+            arcpy.management.GeneratePointsAlongLines(self.centerline, self.splitpoints, 'DISTANCE', f'{self.point_distance} meters')
+            arcpy.management.SplitLineAtPoint(self.centerline, self.splitpoints, self.splitline, '0,1 meters')
+        with recorder.stage('river_points'):
+            arcpy.management.GeneratePointsAlongLines(self.splitline, self.points_final, 'PERCENTAGE', Percentage=50)
+        with recorder.stage('transects'):
+            arcpy.management.GenerateTransectsAlongLines(self.splitline, self.transects, f'{self.point_distance/2+0.01} meters', f'{self.transect_length} meters')
+            arcpy.analysis.Clip(self.transects, self.polygon_dissolve, self.transects_clipped)
+            # arcpy.analysis.Clip(self.transects, self.river_feature, self.transects_clipped)
+            arcpy.management.MultipartToSinglepart(self.transects_clipped, self.transects_sp)
+        with recorder.stage('extract_elevation'):
+            arcpy.sa.ExtractValuesToPoints(self.points_final, self.dem, self.elevation)
         
         
         print("importing data")
-        self.data = self.data_import(self.points_final, ('OBJECTID', 'Shape@XY', 'ORIG_FID_1', 'ORIG_SEQ', 'SHAPE_Length'), \
-                                                    ('ID', 'Shape@XY', 'River_Segment', 'River_Sequence', 'Length' ))
+        with recorder.stage('import_points'):
+            self.data = self.table_import(self.points_final, ('OBJECTID', 'Shape@XY', 'ORIG_FID_1', 'ORIG_SEQ', 'SHAPE_Length'), \
+                                                        ('ID', 'Shape@XY', 'River_Segment', 'River_Sequence', 'Length' ))
         
-        arcpy.sa.ExtractMultiValuesToPoints(self.points_final, [['wse100', 'wse100'], ['wse5', 'wse5']])
+        # all water surfaces are sampled in one pass, to fields wse{q}
+        with recorder.stage('extract_wse'):
+            arcpy.sa.ExtractMultiValuesToPoints(self.points_final, [[raster, f'wse{q}'] for q, raster in self.scenarios.items()])
     
         # add elevation to data table
         print("Adding elevation")
-        with arcpy.da.SearchCursor(self.elevation, ['RASTERVALU', 'ORIG_FID']) as cursor:
-            for row in cursor:
-                self.data[row[1]]['Elevation'] = row[0]
+        with recorder.stage('import_elevation'):
+            with arcpy.da.SearchCursor(self.elevation, ['RASTERVALU', 'ORIG_FID']) as cursor:
+                rows = list(cursor)
+            recorder.count('cursor_rows', len(rows))
+            self.data.add_field('Elevation')
+            self.data.columns['Elevation'][self.data.rows([row[1] for row in rows])] = np.array([row[0] for row in rows], dtype=np.float64)
+            self.segment_index()
                         
         print("Adding water surface elevation difference")
-        with arcpy.da.SearchCursor(self.points_final, ['wse100', 'wse5', 'ORIG_FID']) as cursor:
-            for row in cursor:
-                if row[0]:
-                    self.data[row[2]]['Q100_wse_diff'] = row[0] - self.data[row[2]]['Elevation']
-                else:
-                    self.data[row[2]]['Q100_wse_diff'] = None
-                if row[1]:
-                    self.data[row[2]]['Q5_wse_diff'] = row[1] - self.data[row[2]]['Elevation']
-                else:
-                    self.data[row[2]]['Q5_wse_diff'] = None
+        with recorder.stage('import_wse'):
+            with arcpy.da.SearchCursor(self.points_final, [f'wse{q}' for q in self.scenarios] + ['ORIG_FID']) as cursor:
+                rows = list(cursor)
+            recorder.count('cursor_rows', len(rows))
+            point_rows = self.data.rows([row[-1] for row in rows])
+            for i, q in enumerate(names):
+                wse = np.array([row[i] for row in rows], dtype=np.float64)
+                self.data.add_field(f'{q}_wse_diff')
+                # a water surface of 0 counts as NoData
+                self.data.columns[f'{q}_wse_diff'][point_rows] = np.where(wse != 0, wse - self.data.columns['Elevation'][point_rows], np.nan)
          
         self.distance_fields = tuple([f'river_side_{x}_{y}' for x in self.distance_tupl for y in ('r', 'l')]) + tuple([f'slope_{x}_{self.distance_tupl[i+1]}_{y}' for i ,x in enumerate(self.distance_tupl) if x < self.distance_tupl[-1] for y in ('r', 'l')])
         print("Adding NoData")
-        self.add_no_data(('Gradient', 'River_Segment', 'slope_area_r', 'slope_area_l', 'Q100_wse_diff', 'Q5_wse_diff', 'longest_water_Q5_l', 'longest_water_Q5_r', 'longest_water_Q100_r', 'longest_water_Q100_l') + (self.distance_fields))
-
-        self.add_river_bank2()
-        
-        
-        river_set = set() # set for looping through rivers
-        for row in self.data:
-            river_set.add(self.data[row]['River_Segment'])
-        num_rivers = len(river_set)
-        for count, river in enumerate(river_set):
-            print(f"Adding gradient in river {count+1}/{num_rivers}")    
-            self.calculate_gradient(river)
-            print(f"Adding xsection in river {count+1}/{num_rivers}") 
-            self.add_xsection_data(river)
-        
-        print("Adding furthest water level from center")
-        for point in self.data:
-            for q in ('Q100_wse_diff', 'Q5_wse_diff'):
-                if self.data[point][q] != None:
-                    for side in ('r', 'l'):
-                        for i, d in enumerate(self.distance_tupl):
-                            if self.data[point][f'river_side_{d}_{side}']:
-                                w_level = self.data[point]['Elevation'] + self.data[point][q]
-                                if self.data[point][f'river_side_{d}_{side}'] > w_level:
-                                    if d == 0:
-                                        self.data[point][f'longest_water_{q[:-9]}_{side}'] = d
-                                        break
-                                    else:
-                                        self.data[point][f'longest_water_{q[:-9]}_{side}'] = self.distance_tupl[i-1]
-                                        break 
-                                elif d == self.distance_tupl[-1]:
-                                    self.data[point][f'longest_water_{q[:-9]}_{side}'] = d                            
-
-                else:
-                    self.data[point][f'longest_water_{q[:-9]}_r'] = None     
-                    self.data[point][f'longest_water_{q[:-9]}_l'] = None   
-        
+        self.add_no_data(('Gradient', 'River_Segment', 'slope_area_r', 'slope_area_l') + tuple(f'{q}_wse_diff' for q in names) + tuple(f'longest_water_{q}_{side}' for q in names for side in ('l', 'r')) + (self.distance_fields))
+        return names
 
-
-                  
     def export(self) -> None:
         """Exports all fields found in arbitrary point in self.data. ID 1 as default
         """
         print("Exporting data")
         fields = [x for x in self.data[1]]
         self.data_export(self.output_data, fields)
-    
-    
-    
+
+
+# polygon edges for the bank sampling, set once in each worker process by init_worker()
+worker_edges = None
+
+
+def init_worker(edges) -> None:
+    """Stores data shared by all chunks in a worker process.
+
+    Args:
+        edges (np.ndarray): Edges of the dissolved river polygon, or None
+    """
+    global worker_edges
+    worker_edges = edges
+
+
+def analyze_chunk(task) -> dict:
+    """Runs the stages of River.parallel_analysis() on one chunk in a worker process.
+
+    Args:
+        task (dict): 'river' from River.subset(), 'scenarios', 'method' and 'dem_path', and 'transects' with 'orig_id', 'ends'
+        and 'ordinal' when the banks are sampled in the worker, or None
+
+    Returns:
+        dict: 'data' with the table of the chunk, and 'points' and 'values' from the bank sampling
+    """
+    river = task['river']
+    result = {'points': None, 'values': None}
+    if task['transects'] != None:
+        transects = task['transects']
+        result['points'], result['values'] = river.sample_banks(transects['ends'], worker_edges, task['method'], task['dem_path'])
+        river.set_bank_points(transects['orig_id'], result['points'], result['values'], transects['ordinal'])
+    for segment in river.segment_index():
+        river.calculate_gradient(segment)
+        river.add_xsection_data(segment)
+    river.add_longest_water(task['scenarios'])
+    river.data.cache = {}
+    result['data'] = river.data
+    return result
+
+
 if __name__ == "__main__":
     river = River("arguments")
     river.full_analysis()
     river.export() 
 
     
-arcpy.CheckInExtension("Spatial")
\ No newline at end of file
+if arcpy != None:
+    arcpy.CheckInExtension("Spatial")
\ No newline at end of file
@@ -0,0 +1,248 @@
+import re
+from collections.abc import MutableMapping
+import numpy as np
+
+SIDES = ('r', 'l')
+INTEGER_FIELDS = ('ID', 'River_Segment', 'River_Sequence')
+
+
+class River_table:
+    """Columnar store for the points along a river.
+    Values for each point are 1-D arrays in self.columns, with NaN for NoData.
+    Elevations and slopes across the river are arrays with shape (points, distances, 2) in
+    self.river_side and self.slope, where the last axis is the side, 0 = 'r' and 1 = 'l'.
+    self.bank_oid has the same shape, with the OBJECTID of each point on the river bank, or -1,
+    and self.bank_xy has their coordinates when they are computed without arcpy.
+
+    Indexing with a point ID gives a dict-like view with the old field names, such as
+    'river_side_{distance}_{side}', so code that works on one point at a time still works.
+    """
+
+    def __init__(self, ids: any, distances: tuple[int]) -> None:
+        """Create a table with no fields.
+
+        Args:
+            ids (any): Unique ID of every point, in the order of the feature class
+            distances (tuple[int]): Distances from the river for points across the river, ascending
+        """
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.index = {x: i for i, x in enumerate(self.ids.tolist())}
+        self.distances = tuple(distances)
+        self.distance_index = {x: i for i, x in enumerate(self.distances)}
+        num_points, num_dist = len(self.ids), len(self.distances)
+        self.river_side = np.full((num_points, num_dist, 2), np.nan)
+        self.slope = np.full((num_points, max(num_dist-1, 0), 2), np.nan)
+        self.bank_oid = None
+        self.bank_xy = None
+        # indexes built from the table, such as chainage, so they are dropped with it
+        self.cache = {}
+        self.columns = {}
+        self.objects = {}
+        self.integer = set()
+        self.fields = {}
+        self.keys = {}
+
+    def rows(self, ids: any) -> np.ndarray:
+        """Finds the row of points in the table.
+
+        Args:
+            ids (any): Iterable with point IDs
+
+        Returns:
+            np.ndarray: Row of each point
+        """
+        return np.array([self.index[x] for x in ids], dtype=np.int64)
+
+    def add_field(self, name: str, values: any = None, integer: bool = False) -> None:
+        """Adds a field to the table if it doesn't exist. Numeric fields get NoData for all points.
+
+        Args:
+            name (str): Field name
+            values (any, optional): Value for every point. Values that are not numbers are stored as objects. Defaults to None.
+            integer (bool, optional): Values are returned as int. Defaults to False, but always True for IDs, segments, sequences and longest water.
+        """
+        kind = self.key(name)
+        if values is not None:
+            values = list(values)
+            if all(isinstance(x, (int, float)) or x is None for x in values):
+                self.columns[name] = np.array(values, dtype=np.float64)
+            else:
+                self.objects[name] = values
+        elif kind[0] == 'column' and name not in self.columns and name not in self.objects:
+            self.columns[name] = np.full(len(self.ids), np.nan)
+        if integer or name in INTEGER_FIELDS or name.startswith('longest_water_'):
+            self.integer.add(name)
+        self.fields[name] = None
+
+    def take(self, rows: np.ndarray) -> 'River_table':
+        """Copies some points to a new table with the same fields. Indexes in self.cache are not copied.
+
+        Args:
+            rows (np.ndarray): Rows of the points, in the order they get in the new table
+
+        Returns:
+            River_table: Table with only the points in rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        table = River_table(self.ids[rows], self.distances)
+        table.river_side = self.river_side[rows]
+        table.slope = self.slope[rows]
+        if self.bank_oid is not None:
+            table.bank_oid = self.bank_oid[rows]
+        if self.bank_xy is not None:
+            table.bank_xy = self.bank_xy[rows]
+        table.columns = {name: values[rows] for name, values in self.columns.items()}
+        table.objects = {name: [values[x] for x in rows.tolist()] for name, values in self.objects.items()}
+        table.integer = set(self.integer)
+        table.fields = dict(self.fields)
+        table.keys = dict(self.keys)
+        return table
+
+    def take_distances(self, distances: tuple[int]) -> 'River_table':
+        """Copies the table with only some of the distances across the river, like a run with fewer or shorter transect points.
+        Slopes across the river are between the kept distances, so they are NoData until they are calculated again.
+        Indexes in self.cache don't depend on the distances and are shared.
+
+        Args:
+            distances (tuple[int]): Distances to keep, ascending, all in self.distances
+
+        Returns:
+            River_table: Table with the same points and only the distances
+        """
+        missing = [x for x in distances if x not in self.distance_index]
+        if len(missing) > 0:
+            raise ValueError(f"Distances {missing} are not in the table")
+        positions = np.array([self.distance_index[x] for x in distances], dtype=np.int64)
+        table = River_table(self.ids, distances)
+        table.river_side = self.river_side[:, positions]
+        if self.bank_oid is not None:
+            table.bank_oid = self.bank_oid[:, positions]
+        if self.bank_xy is not None:
+            table.bank_xy = self.bank_xy[:, positions]
+        table.columns = {name: values.copy() for name, values in self.columns.items()}
+        table.objects = {name: list(values) for name, values in self.objects.items()}
+        table.integer = set(self.integer)
+        # fields across the river are named by their distances
+        across = [f'river_side_{x}_{y}' for x in table.distances for y in SIDES]
+        across += [f'slope_{x}_{table.distances[i+1]}_{y}' for i, x in enumerate(table.distances[:-1]) for y in SIDES]
+        table.fields = dict.fromkeys([x for x in self.fields if self.key(x)[0] == 'column'] + across)
+        table.cache = dict(self.cache)
+        return table
+
+    def put(self, rows: np.ndarray, table: 'River_table', mask: np.ndarray = None) -> None:
+        """Writes points from a table made by self.take() back to their rows, adding fields the table has and this one doesn't.
+
+        Args:
+            rows (np.ndarray): Rows the table was taken from
+            table (River_table): Table with the same points as rows
+            mask (np.ndarray, optional): Only points where mask is True are written. Defaults to None, which writes all.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        mask = np.ones(len(rows), dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+        rows, positions = rows[mask], np.flatnonzero(mask)
+        self.river_side[rows] = table.river_side[positions]
+        self.slope[rows] = table.slope[positions]
+        if table.bank_oid is not None:
+            if self.bank_oid is None:
+                self.bank_oid = np.full(self.river_side.shape, -1, dtype=np.int64)
+            self.bank_oid[rows] = table.bank_oid[positions]
+        if table.bank_xy is not None:
+            if self.bank_xy is None:
+                self.bank_xy = np.full(self.river_side.shape + (2,), np.nan)
+            self.bank_xy[rows] = table.bank_xy[positions]
+        for name in table.fields:
+            if name in table.objects and name not in self.objects:
+                self.objects[name] = [None] * len(self.ids)
+            self.add_field(name, integer=name in table.integer)
+        for name, values in table.columns.items():
+            self.columns[name][rows] = values[positions]
+        for name, values in table.objects.items():
+            for row, position in zip(rows.tolist(), positions.tolist()):
+                self.objects[name][row] = values[position]
+
+    def key(self, name: str) -> tuple:
+        """Translates a field name to where the values are stored.
+
+        Args:
+            name (str): Field name
+
+        Returns:
+            tuple: ('river_side', distance index, side index), ('slope', distance index, side index) or ('column', name)
+        """
+        if name not in self.keys:
+            side = re.fullmatch(r'river_side_(\d+)_([rl])', name)
+            slope = re.fullmatch(r'slope_(\d+)_(\d+)_([rl])', name)
+            if side and int(side[1]) in self.distance_index:
+                self.keys[name] = ('river_side', self.distance_index[int(side[1])], SIDES.index(side[2]))
+            elif slope and int(slope[1]) in self.distance_index:
+                self.keys[name] = ('slope', self.distance_index[int(slope[1])], SIDES.index(slope[3]))
+            else:
+                self.keys[name] = ('column', name)
+        return self.keys[name]
+
+    def get(self, row: int, name: str) -> any:
+        """Returns the value of a field for the point in a row, with None for NoData."""
+        kind = self.key(name)
+        if kind[0] == 'river_side':
+            value = self.river_side[row, kind[1], kind[2]]
+        elif kind[0] == 'slope':
+            value = self.slope[row, kind[1], kind[2]]
+        elif name in self.objects:
+            return self.objects[name][row]
+        else:
+            value = self.columns[name][row]
+        if np.isnan(value):
+            return None
+        return int(value) if name in self.integer else float(value)
+
+    def set(self, row: int, name: str, value: any) -> None:
+        """Sets the value of a field for the point in a row. None is stored as NoData."""
+        self.add_field(name)
+        kind = self.key(name)
+        if name in self.objects:
+            self.objects[name][row] = value
+            return
+        value = np.nan if value is None else value
+        if kind[0] == 'river_side':
+            self.river_side[row, kind[1], kind[2]] = value
+        elif kind[0] == 'slope':
+            self.slope[row, kind[1], kind[2]] = value
+        else:
+            self.columns[name][row] = value
+
+    def __getitem__(self, point: int) -> 'Point_view':
+        return Point_view(self, self.index[point])
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, point: int) -> bool:
+        return point in self.index
+
+
+class Point_view(MutableMapping):
+    """Dict-like view of one point in a River_table, with the same field names as the old nested dicts."""
+
+    def __init__(self, table: River_table, row: int) -> None:
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, name: str) -> any:
+        if name not in self.table.fields:
+            raise KeyError(name)
+        return self.table.get(self.row, name)
+
+    def __setitem__(self, name: str, value: any) -> None:
+        self.table.set(self.row, name, value)
+
+    def __delitem__(self, name: str) -> None:
+        raise TypeError("Fields can't be removed from a single point")
+
+    def __iter__(self):
+        return iter(self.table.fields)
+
+    def __len__(self) -> int:
+        return len(self.table.fields)
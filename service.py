@@ -0,0 +1,200 @@
+"""
+Local HTTP service that answers critical point and flow path queries from a geometry_cache directory.
+The river data and flow raster are loaded once and kept in memory, so a query only runs
+River.find_critical_points() and Flood_path.analyze_scenarios(), and repeated queries are answered from memory.
+
+Start with:
+    python service.py path/to/cache --port 8765
+
+Queries, all GET with JSON responses:
+    /info                                       river name, scenarios and number of points
+    /critical?q=100,5&slope=10&dynamic=false    critical percentage of candidate bank points, by scenario
+    /paths?q=100&mode=duplicate_paths           flow paths of the critical points, by scenario. mode is merge, first_point or duplicate_paths
+"""
+import argparse
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from rasterio.transform import rowcol
+import geometry_cache
+import parameter_sweep
+
+MODES = ('merge', 'first_point', 'duplicate_paths')
+
+
+class Query_service:
+    def __init__(self, cache_dir: str, memo_size: int = 256, downstream: bool = False) -> None:
+        """Load a cache for queries.
+
+        Args:
+            cache_dir (str): Cache directory written by geometry_cache.save()
+            memo_size (int, optional): Number of query results kept in memory. Defaults to 256.
+            downstream (bool, optional): Build the downstream index if the cache doesn't have it. Defaults to False.
+        """
+        self.river, self.flood_path = geometry_cache.load(cache_dir)
+        if downstream and self.flood_path != None and self.flood_path.downstream == None:
+            self.flood_path.build_downstream_index()
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        # Flood_path keeps state from the last analysis, so analyses run one at a time
+        self.lock = threading.Lock()
+        self.devnull = open(os.devnull, 'w')
+        self.cells = {}
+        table = self.river.data
+        if self.flood_path != None and table.bank_oid is not None and table.bank_xy is not None:
+            oid = table.bank_oid.reshape(-1)
+            xy = table.bank_xy.reshape(-1, 2)
+            keep = (oid >= 0) & np.isfinite(xy).all(axis=1)
+            # bank points are in the crs of the river, which can differ from the flow raster
+            xy = parameter_sweep.raster_coordinates(self.river, self.flood_path, xy)
+            rows, cols = (np.asarray(x, dtype=np.int64) for x in rowcol(self.flood_path.transform, xy[keep, 0], xy[keep, 1]))
+            # points outside the flow raster can't be traced
+            inside = (rows >= 0) & (rows < self.flood_path.f_arr.shape[1]) & (cols >= 0) & (cols < self.flood_path.f_arr.shape[2])
+            self.cells = dict(zip(oid[keep][inside].tolist(), zip(rows[inside].tolist(), cols[inside].tolist())))
+
+    def info(self) -> dict:
+        """Returns the river name, scenarios and number of points."""
+        return {'river': self.river.river, 'scenarios': list(self.river.scenarios), 'points': len(self.river.data),
+                'bank_points': len(self.cells), 'flow_raster': self.flood_path != None}
+
+    def critical_points(self, q: list[int], slope: float = None, dynamic: bool = False) -> dict[int: dict[int: float]]:
+        """Finds candidate critical points with River.find_critical_points().
+
+        Args:
+            q (list[int]): Scenarios
+            slope (float, optional): Slope in cross-section that selects points as critical. Defaults to None.
+            dynamic (bool, optional): Use the gradient along the river as slope. Defaults to False.
+
+        Returns:
+            dict[int: dict[int: float]]: Scenario as key, and OBJECTID of bank points with critical percentage as value
+        """
+        return self.river.find_critical_points(q, slope, dynamic)
+
+    def flow_paths(self, q: list[int], slope: float = None, dynamic: bool = False, mode: str = 'merge') -> dict[int: dict[int: list]]:
+        """Traces the flow paths of the critical points of all scenarios at once with Flood_path.analyze_scenarios().
+
+        Args:
+            q (list[int]): Scenarios
+            slope (float, optional): Slope in cross-section that selects points as critical. Defaults to None.
+            dynamic (bool, optional): Use the gradient along the river as slope. Defaults to False.
+            mode (str, optional): 'merge', 'first_point' or 'duplicate_paths', see Flood_path.analyze(). Defaults to 'merge'.
+
+        Returns:
+            dict[int: dict[int: list]]: Scenario as key, and OBJECTID of bank points with critical percentage and path coordinates as value
+        """
+        if self.flood_path == None:
+            raise ValueError("The cache has no flow raster")
+        scenarios = self.critical_points(q, slope, dynamic)
+        # import_data() returns points in OBJECTID order, so the paths are merged in the same order
+        oids = sorted(set(x for crit in scenarios.values() for x in crit if x in self.cells))
+        points = {x: self.cells[x] for x in oids}
+        scenarios = {x: {y: crit[y] for y in crit if y in self.cells} for x, crit in scenarios.items()}
+        # the progress lines are for batch runs
+        with contextlib.redirect_stdout(self.devnull):
+            results = self.flood_path.analyze_scenarios(points, scenarios, mode == 'duplicate_paths', mode == 'first_point', as_arcpy=False)
+        return {x: {y: {'crit': path[1], 'coords': path[0].tolist()} for y, path in paths.items()} for x, paths in results.items()}
+
+    def query(self, path: str, params: dict[str: list[str]]) -> dict:
+        """Answers a query, from memory if it has been asked before.
+
+        Args:
+            path (str): '/info', '/critical' or '/paths'
+            params (dict[str: list[str]]): Query parameters from parse_qs()
+
+        Returns:
+            dict: Response, with scenarios and point IDs as keys
+        """
+        if path == '/info':
+            return self.info()
+        if path not in ('/critical', '/paths'):
+            raise KeyError(path)
+        q = tuple(int(x) for x in ','.join(params.get('q', [','.join(str(x) for x in self.river.scenarios)])).split(',') if x != '')
+        slope = float(params['slope'][0]) if 'slope' in params else None
+        dynamic = params.get('dynamic', ['false'])[0].lower() in ('1', 'true', 'yes')
+        mode = params.get('mode', ['merge'])[0]
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}")
+        unknown = [x for x in q if f'Q{x}_wse_diff' not in self.river.data.columns]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown scenarios {unknown}")
+        key = (path, q, slope, dynamic, mode if path == '/paths' else None)
+        with self.lock:
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                return self.memo[key]
+            if path == '/critical':
+                result = self.critical_points(q, slope, dynamic)
+            else:
+                result = self.flow_paths(q, slope, dynamic, mode)
+            self.memo[key] = result
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return result
+
+
+def make_handler(service: Query_service) -> type:
+    """Creates a request handler class that answers with a Query_service.
+
+    Args:
+        service (Query_service): Loaded service
+
+    Returns:
+        type: Subclass of BaseHTTPRequestHandler
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            start = time.perf_counter()
+            try:
+                status, body = 200, service.query(url.path, parse_qs(url.query))
+            except KeyError as e:
+                status, body = 404, {'error': f"Unknown query {e}"}
+            except ValueError as e:
+                status, body = 400, {'error': str(e)}
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('X-Query-Time', f'{time.perf_counter() - start:.6f}')
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+    return Handler
+
+
+def serve(cache_dir: str, host: str = '127.0.0.1', port: int = 8765, downstream: bool = False) -> None:
+    """Loads a cache and answers queries until stopped.
+
+    Args:
+        cache_dir (str): Cache directory written by geometry_cache.save()
+        host (str, optional): Address to listen on. Defaults to '127.0.0.1'.
+        port (int, optional): Port to listen on. Defaults to 8765.
+        downstream (bool, optional): Build the downstream index if the cache doesn't have it. Defaults to False.
+    """
+    print(f"Loading {cache_dir}")
+    service = Query_service(cache_dir, downstream=downstream)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Answering queries on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Critical point and flow path queries from a geometry cache")
+    parser.add_argument('cache_dir')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--downstream', action='store_true', help="build the downstream index at start")
+    args = parser.parse_args()
+    serve(args.cache_dir, args.host, args.port, args.downstream)
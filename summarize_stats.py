@@ -5,3 +5,7 @@ df = pd.read_csv('stats.csv')
 print(df.tail(30))
 summary = df.groupby('name').agg({'geo_time': ['mean', statistics.stdev], 'cp_time': ['mean', statistics.stdev]})
 print(summary)
+if 'cp_workers' in df:
+    scaling = df.groupby('cp_workers').agg({'trace_time': 'mean', 'resolve_time': 'mean', 'cp_time': 'mean'})
+    scaling['speedup'] = scaling['trace_time'].iloc[0] / scaling['trace_time']
+    print(scaling)
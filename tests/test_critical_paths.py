@@ -0,0 +1,178 @@
+import numpy as np
+import rasterio
+from affine import Affine
+import benchmark
+from critical_paths import Flood_path, trace_paths, trace_tiles
+from raster_tiles import Tiled_raster
+
+OFFSETS = {1: (0, 1), 2: (1, 1), 4: (1, 0), 8: (1, -1), 16: (0, -1), 32: (-1, -1), 64: (-1, 0), 128: (-1, 1)}
+
+
+def old_trace(raster: np.ndarray, row: int, col: int) -> list[tuple[int, int, int]]:
+    """The per-cell loop of the original Flood_path.analyze() with duplicate paths, one path at a time."""
+    path = [(row, col, raster[1, row, col])]
+    while path[-1][2] not in (3, 4):
+        row, col, _ = path[-1]
+        direction = raster[0, row, col]
+        if direction not in OFFSETS:
+            path.append((row, col, 4))
+            continue
+        row, col = row + OFFSETS[direction][0], col + OFFSETS[direction][1]
+        path.append((row, col, raster[1, row, col]))
+    return path
+
+
+def flow_raster(size: int = 48, seed: int = 0) -> np.ndarray:
+    """D8 raster of a noisy valley without flow loops, with a nodata border, a river, buildings, roads and a few invalid directions."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    dem = np.abs(x - size / 2) + 0.2 * y + rng.normal(0, 0.7, (size, size))
+    raster = np.zeros((2, size, size), dtype=np.uint8)
+    raster[0] = benchmark.d8_directions(dem)
+    raster[1, rng.random((size, size)) < 0.05] = 1
+    raster[1, rng.random((size, size)) < 0.05] = 2
+    raster[1, :, size // 2] = 3
+    raster[1, [0, -1], :] = 4
+    raster[1, :, [0, -1]] = 4
+    return raster
+
+
+def trace_list(trace: tuple, i: int) -> list[tuple[int, int, int]]:
+    rows, cols, targets, offsets = trace
+    part = slice(offsets[i], offsets[i+1])
+    return list(zip(rows[part].tolist(), cols[part].tolist(), targets[part].tolist()))
+
+
+def write_raster(path: str, raster: np.ndarray) -> None:
+    with rasterio.open(path, 'w', driver='GTiff', width=raster.shape[2], height=raster.shape[1], count=2, dtype=raster.dtype,
+                       transform=Affine(1, 0, 0, 0, -1, raster.shape[1])) as dataset:
+        dataset.write(raster)
+
+
+def test_trace_paths_matches_the_original_loop():
+    raster = flow_raster()
+    rows, cols = np.mgrid[1:47, 1:47]
+    rows, cols = rows.reshape(-1), cols.reshape(-1)
+    trace = trace_paths(raster, rows, cols)
+    for i, (row, col) in enumerate(zip(rows.tolist(), cols.tolist())):
+        assert trace_list(trace, i) == old_trace(raster, row, col)
+
+
+def test_flow_loop_ends_the_path():
+    raster = np.zeros((2, 4, 4), dtype=np.uint8)
+    raster[0] = 1
+    # (1, 1) and (1, 2) flow into each other, and (1, 0) flows into the loop
+    raster[0, 1, 1], raster[0, 1, 2] = 1, 16
+    rows, cols, targets, offsets = trace_paths(raster, [1, 1], [0, 2])
+    assert (np.diff(offsets) <= 8).all()
+    assert targets[offsets[1:] - 1].tolist() == [4, 4]
+    # the path stops in the loop and repeats its last cell
+    assert (rows[offsets[1:] - 1] == rows[offsets[1:] - 2]).all() and (cols[offsets[1:] - 1] == cols[offsets[1:] - 2]).all()
+
+
+def test_trace_tiles_matches_trace_paths_with_flow_loops(tmp_path):
+    rng = np.random.default_rng(1)
+    raster = np.zeros((2, 40, 40), dtype=np.uint8)
+    raster[0] = rng.choice(list(OFFSETS), (40, 40))
+    raster[1, rng.random((40, 40)) < 0.01] = 3
+    write_raster(str(tmp_path / 'flow.tif'), raster)
+    starts = rng.integers(0, 40, (500, 2))
+    with rasterio.open(str(tmp_path / 'flow.tif')) as dataset:
+        tiled = trace_tiles(Tiled_raster(dataset, 8, 2 * 8 * 8), starts[:, 0], starts[:, 1])
+    for x, y in zip(trace_paths(raster, starts[:, 0], starts[:, 1]), tiled):
+        assert np.array_equal(x, y)
+
+
+def test_trace_tiles_matches_trace_paths_with_eviction(tmp_path):
+    raster = flow_raster(60, seed=4)
+    write_raster(str(tmp_path / 'flow.tif'), raster)
+    rows, cols = np.mgrid[1:59:3, 1:59:3]
+    rows, cols = rows.reshape(-1), cols.reshape(-1)
+    expected = trace_paths(raster, rows, cols)
+    reloaded = False
+    # tile sizes that do and don't divide the raster, with caches of one tile up to a few
+    for tile_size in (4, 7, 16):
+        for tiles in (1, 2, 5):
+            with rasterio.open(str(tmp_path / 'flow.tif')) as dataset:
+                tiled_raster = Tiled_raster(dataset, tile_size, tiles * 2 * tile_size ** 2)
+                stats = {}
+                tiled = trace_tiles(tiled_raster, rows, cols, stats=stats)
+            for x, y in zip(expected, tiled):
+                assert np.array_equal(x, y)
+            assert stats['tile_loads'] <= stats['tile_load_bound']
+            reloaded |= stats['tile_loads'] > tiled_raster.tiles_x * tiled_raster.tiles_y
+    # some runs read tiles again after they were evicted
+    assert reloaded
+
+
+def old_resolve(traces: dict, crit_points: dict[int: int]) -> dict[int: list]:
+    """The resolve before paths were stored as pieces, with lists of cells and a scan through the stored paths
+    in place of Path_index. Returns the cells, critical percentage and critical positions of every path."""
+    keys, traced, offsets = traces['keys'].tolist(), traces['traced'], traces['offsets']
+    crit = (traces['targets'] == 1) | (traces['targets'] == 2)
+    paths = {}
+
+    def find(cell):
+        for key, path in paths.items():
+            if cell in path[0]:
+                return key, path[0].index(cell)
+        return None
+
+    for i, p in enumerate(keys):
+        if p not in crit_points or not traced[i]:
+            continue
+        cells = traces['cells'][offsets[i]:offsets[i+1]].tolist()
+        crit_pos = np.flatnonzero(crit[offsets[i]:offsets[i+1]]).tolist()
+        if traces['duplicate_paths']:
+            if len(crit_pos) > 0:
+                paths[p] = [cells, crit_points[p], crit_pos]
+            continue
+        hits = [find(x) for x in cells]
+        end = next((j for j, x in enumerate(hits) if x != None), len(cells) - 1)
+        path, crit_pos = cells[:end+1], [x for x in crit_pos if x <= end]
+        if traces['first_point'] or hits[end] == None:
+            if len(crit_pos) > 0:
+                paths[p] = [path, crit_points[p], crit_pos]
+            continue
+        idx, current = hits[end]
+        if paths[idx][1] > crit_points[p]:
+            other = paths[idx]
+            if current < other[2][-1]:
+                paths[p] = [path + other[0][current:], crit_points[p], crit_pos + [x - current + len(path) for x in other[2] if x > current]]
+            elif len(crit_pos) > 0:
+                paths[p] = [path, crit_points[p], crit_pos]
+                continue
+            else:
+                continue
+            if other[2][0] <= current:
+                other[0] = other[0][:current+1]
+                other[2] = [x for x in other[2] if x <= current]
+            else:
+                del paths[idx]
+        elif len(crit_pos) > 0:
+            paths[p] = [path, crit_points[p], crit_pos]
+    return paths
+
+
+def resolved_lists(resolved: dict) -> dict[int: list]:
+    offsets = resolved['offsets']
+    return {key: [resolved['cells'][offsets[i]:offsets[i+1]].tolist(), value, np.flatnonzero(resolved['critical'][offsets[i]:offsets[i+1]]).tolist()]
+            for i, (key, value) in enumerate(zip(resolved['keys'].tolist(), resolved['values'].tolist()))}
+
+
+def test_piece_resolve_matches_the_previous_resolve():
+    rng = np.random.default_rng(2)
+    raster = flow_raster(64, seed=3)
+    starts = rng.integers(1, 63, (400, 2))
+    points = {i: tuple(x) for i, x in enumerate(starts.tolist())}
+    # the second scenario has a subset of the candidates, and the third none
+    scenarios = {5: {x: int(rng.integers(1, 100)) for x in points}, 100: {x: int(rng.integers(1, 100)) for x in points if x % 3 == 0}, 200: {}}
+    for duplicate_paths, first_point in ((False, False), (True, False), (False, True)):
+        flood_path = Flood_path.from_array(raster, Affine(1, 0, 0, 0, -1, 64))
+        flood_path.analyze_scenarios(points, scenarios, duplicate_paths, first_point, as_arcpy=False)
+        for q in scenarios:
+            expected = old_resolve(flood_path.traces, scenarios[q])
+            assert resolved_lists(flood_path.resolved[q]) == expected
+            assert flood_path.scenario_num[q] == len(expected)
+        assert flood_path.scenario_num[200] == 0
+        assert len(flood_path.resolved[200]['cells']) == 0
@@ -0,0 +1,65 @@
+import contextlib
+import os
+import numpy as np
+import pytest
+import benchmark
+import parameter_sweep
+from critical_paths import Flood_path
+from river_table import River_table
+
+
+def synthetic(directory: str) -> dict:
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return benchmark.synthetic_river(128, 0, directory=directory)
+
+
+def native_river(data: dict, distances: tuple[int] = benchmark.DISTANCES) -> any:
+    """River from the synthetic data with its own table for the distances, where the steps that need arcpy give the synthetic transects instead."""
+    river = benchmark.make_river(data)
+    if distances != river.distance_tupl:
+        table = River_table(data['table'].ids, distances)
+        for name, values in data['table'].columns.items():
+            table.add_field(name, values.tolist())
+        river.distance_tupl = tuple(distances)
+        river.data = table
+        names = tuple(f'Q{q}' for q in river.scenarios)
+        river.add_no_data(('Gradient', 'slope_area_r', 'slope_area_l') + tuple(f'longest_water_{q}_{side}' for q in names for side in ('l', 'r')))
+        river.segment_index()
+    river.prepare_analysis = lambda scenarios=None: tuple(f'Q{q}' for q in river.scenarios)
+    river.read_transects = lambda: (data['orig_id'], data['ends'], data['edges'])
+    river.write_bank_points = lambda *args: None
+    return river
+
+
+def flood_path(data: dict) -> Flood_path:
+    return Flood_path.from_array(np.stack((data['direction'], data['classes'])), data['transform'])
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_sweep_row_matches_a_fresh_analysis(tmp_path, workers):
+    data = synthetic(str(tmp_path))
+    params = {'transect_space': 4, 'transect_width': 20, 'transect_point_space': 8, 'slope': None, 'dynamic': False}
+    # the sweep derives the grid point from the finest profile
+    river = native_river(data)
+    river.full_analysis('native')
+    rows = parameter_sweep.sweep_river(river, flood_path(data), [params], workers=workers)
+
+    fresh = native_river(data, parameter_sweep.point_distances(params['transect_width'], params['transect_point_space']))
+    fresh.full_analysis('native')
+    crit = fresh.find_critical_points(list(fresh.scenarios), params['slope'], params['dynamic'])
+    oid = fresh.data.bank_oid.reshape(-1)
+    xy = fresh.data.bank_xy.reshape(-1, 2)
+    keep = np.isin(oid, np.fromiter(set(x for q in crit for x in crit[q]), dtype=np.int64))
+    order = np.argsort(oid[keep])
+    fresh_path = flood_path(data)
+    fresh_path.analyze_scenarios(fresh_path.cell_index(oid[keep][order], xy[keep][order]), crit, duplicate_paths=True, as_arcpy=False)
+
+    assert [row['q'] for row in rows] == list(crit)
+    for row in rows:
+        q = row['q']
+        accuracy = fresh_path.scenario_accuracy[q]
+        assert row['candidates'] == len(crit[q])
+        assert row['critical'] == fresh_path.scenario_num[q]
+        assert row['build_inter'] == accuracy['build_inter'] and row['road_inter'] == accuracy['road_inter']
+        assert row['mean_crit'] == pytest.approx(np.nan if accuracy['mean_crit'] == None else accuracy['mean_crit'], nan_ok=True)
+    assert sum(row['critical'] for row in rows) > 0
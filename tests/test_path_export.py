@@ -0,0 +1,37 @@
+import sqlite3
+import struct
+import numpy as np
+import path_export
+
+
+def read_wkb(wkb: bytes) -> np.ndarray:
+    order, kind, count = struct.unpack('<BII', wkb[:9])
+    assert (order, kind) == (1, 2)
+    assert len(wkb) == 9 + count * 16
+    return np.frombuffer(wkb[9:], dtype='<f8').reshape(-1, 2)
+
+
+def test_one_vertex_lines_are_written_with_two_points():
+    # a path of one cell, one that repeats its only cell, and a normal path
+    coords = np.array([[1.0, 1.0], [2.0, 2.0], [2.0, 2.0], [0.0, 0.0], [1.0, 0.0], [2.0, 0.0], [2.0, 1.0]])
+    offsets = np.array([0, 1, 3, 7])
+    coords, offsets = path_export.simplify_lines(coords, offsets)
+    assert np.diff(offsets).tolist() == [1, 1, 3]
+    lines = [read_wkb(x) for x in path_export.linestring_wkb(coords, offsets)]
+    assert lines[0].tolist() == [[1.0, 1.0], [1.0, 1.0]]
+    assert lines[1].tolist() == [[2.0, 2.0], [2.0, 2.0]]
+    assert lines[2].tolist() == [[0.0, 0.0], [2.0, 0.0], [2.0, 1.0]]
+
+
+def test_gpkg_has_a_valid_line_for_every_path(tmp_path):
+    paths = {1: [np.array([[5.0, 5.0]]), 10], 2: [np.array([[0.0, 0.0], [0.0, 1.0]]), 20]}
+    path = str(tmp_path / 'paths.gpkg')
+    path_export.write_paths(paths, path)
+    with sqlite3.connect(path) as connection:
+        rows = connection.execute('SELECT geom, point_id FROM flow_paths ORDER BY point_id').fetchall()
+    connection.close()
+    # GeoPackage header with an envelope of 4 doubles before the WKB
+    lines = [read_wkb(geom[8 + 32:]) for geom, _ in rows]
+    assert [x for _, x in rows] == [1, 2]
+    assert lines[0].tolist() == [[5.0, 5.0], [5.0, 5.0]]
+    assert lines[1].tolist() == [[0.0, 0.0], [0.0, 1.0]]
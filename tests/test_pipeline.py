@@ -0,0 +1,57 @@
+import contextlib
+import os
+import numpy as np
+import pytest
+import benchmark
+import pipeline
+from critical_paths import Flood_path
+
+
+def synthetic(directory: str) -> dict:
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return benchmark.synthetic_river(128, 0, directory=directory)
+
+
+def native_river(data: dict) -> any:
+    """River from the synthetic data, where the steps that need arcpy give the synthetic transects instead."""
+    river = benchmark.make_river(data)
+    river.prepare_analysis = lambda scenarios=None: tuple(f'Q{q}' for q in river.scenarios)
+    river.read_transects = lambda: (data['orig_id'], data['ends'], data['edges'])
+    river.write_bank_points = lambda *args: None
+    return river
+
+
+def flood_path(data: dict) -> Flood_path:
+    return Flood_path.from_array(np.stack((data['direction'], data['classes'])), data['transform'])
+
+
+def same_table(a: any, b: any) -> bool:
+    return (np.array_equal(a.bank_oid, b.bank_oid) and np.array_equal(a.bank_xy, b.bank_xy, equal_nan=True)
+            and list(a.columns) == list(b.columns) and all(np.array_equal(a.columns[x], b.columns[x], equal_nan=True) for x in a.columns))
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_pipeline_matches_the_serial_analysis(tmp_path, workers):
+    data = synthetic(str(tmp_path))
+    serial = native_river(data)
+    serial.full_analysis('native')
+    crit = serial.find_critical_points(list(serial.scenarios))
+    oid = serial.data.bank_oid.reshape(-1)
+    xy = serial.data.bank_xy.reshape(-1, 2)
+    keep = np.isin(oid, np.fromiter(set(x for q in crit for x in crit[q]), dtype=np.int64))
+    serial_path = flood_path(data)
+    # in ID order, like Flood_path.import_data() reads them
+    order = np.argsort(oid[keep])
+    points = serial_path.cell_index(oid[keep][order], xy[keep][order])
+    expected = serial_path.analyze_scenarios(points, crit, duplicate_paths=True, as_arcpy=False)
+
+    river = native_river(data)
+    paths = pipeline.run(river, flood_path(data), duplicate_paths=True, workers=workers, batch_points=8, write_points=False, as_arcpy=False)
+    assert river.recorder.counters['pipeline_batches'] > 1
+    assert same_table(river.data, serial.data)
+    assert list(paths) == list(expected)
+    for q in expected:
+        assert list(paths[q]) == list(expected[q])
+        for key in expected[q]:
+            assert np.array_equal(paths[q][key][0], expected[q][key][0])
+            assert paths[q][key][1] == expected[q][key][1]